@@ -3,16 +3,72 @@
 #    Stewart Rutledge 2013
 
 import json
+import gzip
 import web
 import td
+from settings import config
+from StringIO import StringIO
 
-# Initiate Telldus library
-telldus = td.Telldus()
+# The Telldus instance of the process, with events from telldusd to track
+# device states, or the one owned by broker.py.
+if config['broker']:
+    import broker
+    telldus = broker.RemoteTelldus(config['broker_path'])
+else:
+    telldus = td.shared(events=True)
+
+# Fields of the /devices listing
+DEVICE_FIELDS = (
+    'id', 'name', 'model', 'protocol', 'house', 'unit', 'methods', 'type',
+    'state', 'changed'
+)
+
+# Page sizes of the /devices listing
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Smaller responses are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+# Seconds a request waits for its commands to be transmitted before handing
+# out the job ID instead.
+TRANSMIT_TIMEOUT = 30
+
+# Respond with a transmit job. Waits for it to finish unless the client asked
+# for ?async=1 or the job takes too long, then 202 is returned with the job ID
+# to poll at /jobs/<id>.
+def job_response(job):
+    query = web.input(async=None)
+
+    if query.get('async') or not job.wait(TRANSMIT_TIMEOUT):
+        web.ctx.status = '202 Accepted'
+        web.header('Location', '/jobs/%d' % job.id)
+        return json.dumps(job.as_dict())
+
+    return None
+
+# Who sent a command, for the audit log
+def source():
+    return web.ctx.get('ip')
+
+# Gzip the response body if the client accepts it
+def compress_response(body):
+    accept = web.ctx.env.get('HTTP_ACCEPT_ENCODING', '')
+    web.header('Vary', 'Accept-Encoding')
+
+    if 'gzip' not in accept or len(body) < GZIP_MIN_SIZE:
+        return body
+
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6)
+    gz.write(body)
+    gz.close()
+
+    web.header('Content-Encoding', 'gzip')
+    return buf.getvalue()
 
 class Device:
     def __init__(self):
-        from fnmatch import fnmatch
-
         # Set to JSON output
         web.header('Content-type', 'application/json')
 
@@ -25,20 +81,26 @@ class Device:
 
         # We have a device index
         if query.index:
-            # Initiate the device
+            # Reuse the registered device, or initiate it
             try:
-                self._d = td.Device(telldus, index=int(query.index))
+                dev_id = telldus.get_device_by_index(int(query.index))
+                if dev_id:
+                    device = telldus.get_device(dev_id)
+                else:
+                    device = td.Device(telldus, index=int(query.index))
             except(td.TDDeviceError), e:
                 web.internalerror()
                 return json.dumps(dict(error=str(e)))
 
-        # We have a device name
+        # We have a device name, exact matches first and then by prefix
         if query.name:
-            # Find the device
-            for device in telldus.Devices():
-                if fnmatch(device.name, '%s*' % query.name):
-                    break
-                device = None
+            try:
+                device = telldus.find_device(query.name)
+            except(td.TDAmbiguousNameError), e:
+                raise web.conflict(json.dumps(dict(
+                    error = e.errstr,
+                    devices = e.device_ids
+                )))
 
         # Use the device
         if not device:
@@ -50,12 +112,12 @@ class Device:
     def GET(self, method=None):
         # Default is to turn something on
         if method == 'on' or not method:
-            self._d.turn_on()
-            return web.ok()
+            job = telldus.submit([(self._d, 'on')], source=source())
+            return job_response(job) or web.ok()
 
         if method == 'off':
-            self._d.turn_off()
-            return web.ok()
+            job = telldus.submit([(self._d, 'off')], source=source())
+            return job_response(job) or web.ok()
 
         # TODO: Test this so it doesn't clash with the web.input() call in 
         # __init__()
@@ -87,11 +149,15 @@ class Device:
                 raise web.notfound()
 
         if method == 'learn':
-            try:
-                self._d.learn()
-            except(td.TDDeviceError), e:
+            job = telldus.submit([(self._d, 'learn')], source=source())
+            response = job_response(job)
+            if response:
+                return response
+
+            error = job.results[0].get('error')
+            if error:
                 web.internalerror()
-                return json.dumps(dict(error=str(e)))
+                return json.dumps(dict(error=repr(error)))
             return web.ok()
 
     def DELETE(self):
@@ -103,3 +169,150 @@ class Device:
 
         if res is True:
             return web.ok()
+
+# All devices in one response, from a snapshot of the device caches.
+#   ?fields=id,name,state  only these fields
+#   ?limit=100             page size
+#   ?cursor=12             devices with IDs above 12, see "next" in responses
+class Devices:
+    def GET(self):
+        web.header('Content-type', 'application/json')
+
+        query = web.input(
+            fields = None,
+            limit = DEFAULT_PAGE_SIZE,
+            cursor = 0
+        )
+
+        fields = DEVICE_FIELDS
+        if query.fields:
+            fields = [f for f in query.fields.split(',') if f]
+            if not fields or set(fields) - set(DEVICE_FIELDS):
+                raise web.badrequest()
+
+        try:
+            limit = min(int(query.limit), MAX_PAGE_SIZE)
+            cursor = int(query.cursor)
+        except(ValueError):
+            raise web.badrequest()
+        if limit < 1:
+            raise web.badrequest()
+
+        devices = [d for d in telldus.snapshot() if d['id'] > cursor]
+        page = devices[:limit]
+
+        next_cursor = None
+        if len(devices) > limit:
+            next_cursor = page[-1]['id']
+
+        body = json.dumps(dict(
+            devices = [
+                dict((field, device[field]) for field in fields)
+                for device in page
+            ],
+            next = next_cursor
+        ))
+        return compress_response(body)
+
+# Groups are addressed like devices. /group/on and /group/off send the command
+# to every member in one transmit job, /group/members lists them.
+class Group(Device):
+    def GET(self, method=None):
+        if self._d.type != td.TYPE_GROUP:
+            raise web.notfound()
+
+        if method == 'members':
+            return json.dumps(dict(
+                id = self._d.id,
+                members = [member_id for member_id, c in self._d.members]
+            ))
+
+        job = telldus.run_group(
+            self._d.id,
+            method or 'on',
+            source = source()
+        )
+        return job_response(job) or json.dumps(job.as_dict())
+
+# Scenes are addressed like devices. /scene runs the scene, /scene/members
+# lists the members and their actions.
+class Scene(Device):
+    def GET(self, method=None):
+        if self._d.type != td.TYPE_SCENE:
+            raise web.notfound()
+
+        if method == 'members':
+            return json.dumps(dict(
+                id = self._d.id,
+                members = [
+                    dict(id=member_id, method=command)
+                    for member_id, command in self._d.members
+                ]
+            ))
+
+        job = telldus.run_scene(self._d.id, source=source())
+        return job_response(job) or json.dumps(job.as_dict())
+
+# Run several device commands in one request. Takes a JSON body like
+#   {"commands": [{"id": 3, "method": "off"}, {"name": "Lampa", "method": "on"}]}
+# and answers with one result per device. Only the last command given for a
+# device is sent. Batches are queued behind interactive commands.
+class Batch:
+    def POST(self):
+        web.header('Content-type', 'application/json')
+
+        try:
+            commands = json.loads(web.data())['commands']
+        except(ValueError, KeyError, TypeError):
+            raise web.badrequest()
+        if not isinstance(commands, list):
+            raise web.badrequest()
+
+        plan = []
+        errors = []
+        for command in commands:
+            try:
+                method = command.get('method', 'on')
+                if method not in td.COMMANDS:
+                    raise web.badrequest()
+
+                if command.get('id'):
+                    device = telldus.get_device(int(command['id']))
+                    plan.append((device, method))
+                    continue
+
+                if not command.get('name'):
+                    raise web.badrequest()
+
+                device = telldus.find_device(command['name'])
+                if not device:
+                    raise td.TDDeviceError('Device not found')
+                plan.append((device, method))
+            except(AttributeError, ValueError):
+                raise web.badrequest()
+            except(td.TDDeviceError), e:
+                errors.append(dict(
+                    id = command.get('id'),
+                    name = command.get('name'),
+                    method = method,
+                    success = False,
+                    error = e.errstr
+                ))
+
+        job = telldus.submit(plan, td.PRIORITY_BULK, source())
+        response = job_response(job)
+        if response:
+            return response
+
+        return json.dumps(dict(results = job.results + errors))
+
+# Poll a transmit job
+class Job:
+    def GET(self, job_id):
+        web.header('Content-type', 'application/json')
+
+        job = telldus.transmitter.job(int(job_id))
+        if not job:
+            raise web.notfound()
+
+        return json.dumps(job.as_dict())
@@ -0,0 +1,517 @@
+# Kraft event loop server
+#
+# An alternative to the threaded web.py server for many long lived clients.
+# One thread runs an asyncore loop over all connections, requests to the
+# web.py application run on a bounded pool of worker threads, and /events
+# streams are fed by a single thread watching the state table. An idle
+# connection costs a socket and a buffer, not a thread.
+#
+#   python asyncserver.py [[host:]port] [workers]
+
+import os
+import sys
+import errno
+import socket
+import logging
+import asyncore
+from collections import deque
+from threading import Thread, Lock
+from Queue import Queue, Full
+from StringIO import StringIO
+from urllib import unquote
+from urlparse import parse_qs
+from time import time
+
+import web
+import kraft
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 8080
+
+# Threads running requests, and requests waiting for one before new requests
+# are answered with 503.
+DEFAULT_WORKERS = 8
+MAX_PENDING = 256
+
+# Limits of a request
+MAX_HEADER = 64 * 1024
+MAX_BODY = 1024 * 1024
+
+# Seconds before idle keep-alive connections are closed, and between looking
+# for them.
+IDLE_TIMEOUT = 300
+SWEEP_INTERVAL = 10
+
+RECV_SIZE = 64 * 1024
+
+# Event messages kept for streams that connect while the watcher is ahead
+RECENT_EVENTS = 1000
+
+_REASONS = {
+    400: 'Bad Request',
+    413: 'Request Entity Too Large',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+    503: 'Service Unavailable',
+}
+
+# The asyncore map plus a queue of calls from other threads, run by the loop
+# thread after a byte on the wake pipe.
+class EventLoop(object):
+    def __init__(self):
+        self.map = {}
+        self._calls = deque()
+        self._lock = Lock()
+
+        read_fd, self._wake_fd = os.pipe()
+        _set_nonblocking(self._wake_fd)
+        _Waker(self, read_fd)
+
+    # Run func(*args) in the loop thread, from any thread
+    def call_soon(self, func, *args):
+        with self._lock:
+            self._calls.append((func, args))
+
+        try:
+            os.write(self._wake_fd, 'x')
+        except(OSError), e:
+            # A full pipe will wake the loop all the same
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _run_calls(self):
+        with self._lock:
+            calls = list(self._calls)
+            self._calls.clear()
+
+        # One failing call must not keep the rest from running, or the
+        # waker from being read again
+        for func, args in calls:
+            try:
+                func(*args)
+            except(Exception):
+                log.exception('Call from another thread failed')
+
+    def run(self):
+        swept = time()
+        while self.map:
+            asyncore.loop(timeout=1.0, map=self.map, count=1)
+
+            if time() - swept > SWEEP_INTERVAL:
+                swept = time()
+                for dispatcher in self.map.values():
+                    if isinstance(dispatcher, HTTPConnection):
+                        dispatcher.close_if_idle(swept)
+
+def _set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class _Waker(asyncore.file_dispatcher):
+    def __init__(self, loop, fd):
+        asyncore.file_dispatcher.__init__(self, fd, map=loop.map)
+        self._loop = loop
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except(OSError, socket.error):
+            pass
+        self._loop._run_calls()
+
+# Worker threads for anything that may block, with a bounded queue
+class WorkerPool(object):
+    def __init__(self, loop, size=DEFAULT_WORKERS, max_pending=MAX_PENDING):
+        self._loop = loop
+        self._queue = Queue(max_pending)
+
+        for i in range(size):
+            thread = Thread(target=self._work, name='worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    # Run func(*args) on a worker, then callback(result, error) in the loop.
+    # Returns False when too many calls are waiting already.
+    def submit(self, callback, func, *args):
+        try:
+            self._queue.put_nowait((callback, func, args))
+        except(Full):
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            callback, func, args = self._queue.get()
+            try:
+                result, error = func(*args), None
+            except(Exception), e:
+                result, error = None, e
+            self._loop.call_soon(callback, result, error)
+
+# Call a WSGI application and collect the whole response
+def run_wsgi(application, environ):
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+
+    result = application(environ, start_response)
+    try:
+        body = ''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    return response[0], response[1], body
+
+# Server-Sent Events for every /events client from one thread waiting on the
+# state table. Messages go out to each stream once, in version order.
+class EventStreams(object):
+    def __init__(self, loop, pool, telldus):
+        self._loop = loop
+        self._pool = pool
+        self._telldus = telldus
+        self._streams = set()
+        self._recent = deque(maxlen=RECENT_EVENTS)
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = Thread(target=self._watch, name='event-streams')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self):
+        states = self._telldus.states
+        version = states.version
+
+        while True:
+            if states.wait(version, kraft.EVENTS_KEEPALIVE) == version:
+                self._loop.call_soon(self._keepalive)
+                continue
+
+            messages = []
+            for entry in states.since(version):
+                messages.append((entry['version'], kraft.event_message(entry)))
+                version = max(version, entry['version'])
+            self._loop.call_soon(self._broadcast, messages)
+
+    def _keepalive(self):
+        for stream in self._streams:
+            stream.write(': keepalive\n\n')
+
+    def _broadcast(self, messages):
+        self._recent.extend(messages)
+        for stream in self._streams:
+            stream.send_events(messages)
+
+    # Messages for changes after since, built on a worker since names may
+    # have to be asked for.
+    def _backlog(self, since):
+        messages = []
+        for entry in self._telldus.states.since(since):
+            messages.append((entry['version'], kraft.event_message(entry)))
+        return messages
+
+    def open(self, conn, since):
+        if since is None:
+            since = self._telldus.states.version
+
+        def opened(messages, error):
+            if error is not None:
+                conn.respond_error(500)
+                return
+            if not conn.connected:
+                return
+
+            conn.start_stream(since)
+            conn.send_events(messages)
+            conn.send_events(self._recent)
+            self._streams.add(conn)
+
+        if not self._pool.submit(opened, self._backlog, since):
+            conn.respond_error(503)
+
+    def close(self, conn):
+        self._streams.discard(conn)
+
+class HTTPConnection(asyncore.dispatcher):
+    def __init__(self, sock, addr, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.loop.map)
+        self.server = server
+        self.addr = addr
+
+        self._in = ''
+        self._out = deque()
+        self._busy = False
+        self._keep_alive = False
+        self._stream_version = None
+        self._close_when_done = False
+        self._active = time()
+
+    ## Input
+
+    def readable(self):
+        return len(self._in) < MAX_HEADER + MAX_BODY
+
+    def handle_read(self):
+        data = self.recv(RECV_SIZE)
+        if not data:
+            return
+
+        self._active = time()
+        if self._stream_version is None:
+            self._in += data
+            self._next_request()
+
+    # Start on the next complete request in the buffer, one at a time
+    def _next_request(self):
+        if self._busy or self._close_when_done or not self._in:
+            return
+
+        end = self._in.find('\r\n\r\n')
+        if end < 0:
+            if len(self._in) > MAX_HEADER:
+                self.respond_error(431)
+            return
+
+        try:
+            method, target, version, headers = _parse_head(self._in[:end])
+            length = int(headers.get('content-length') or 0)
+        except(ValueError):
+            self.respond_error(400)
+            return
+
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            self.respond_error(501)
+            return
+        if length > MAX_BODY:
+            self.respond_error(413)
+            return
+        if len(self._in) < end + 4 + length:
+            return
+
+        body = self._in[end + 4:end + 4 + length]
+        self._in = self._in[end + 4 + length:]
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self._keep_alive = connection != 'close'
+        else:
+            self._keep_alive = connection == 'keep-alive'
+
+        path, _, query = target.partition('?')
+        self._busy = True
+
+        if method == 'GET' and path == '/events':
+            params = parse_qs(query)
+            since = params.get('since', [headers.get('last-event-id')])[0]
+            try:
+                since = since and int(since)
+            except(ValueError):
+                self.respond_error(400)
+                return
+            self.server.streams.open(self, since)
+            return
+
+        environ = self.server.environ(
+            method, path, query, version, headers, body, self.addr
+        )
+        submitted = self.server.pool.submit(
+            self._respond,
+            run_wsgi,
+            self.server.application,
+            environ
+        )
+        if not submitted:
+            self.respond_error(503)
+
+    ## Output
+
+    def writable(self):
+        return bool(self._out)
+
+    def write(self, data):
+        if self.connected:
+            self._out.append(data)
+
+    def handle_write(self):
+        while self._out:
+            data = self._out[0]
+            sent = self.send(data)
+            if sent < len(data):
+                self._out[0] = data[sent:]
+                return
+            self._out.popleft()
+
+        if self._close_when_done:
+            self.close()
+
+    def _respond(self, response, error):
+        if not self.connected:
+            return
+        if error is not None:
+            self.respond_error(500)
+            return
+
+        status, headers, body = response
+        self._send_response(status, headers, body)
+
+    def _send_response(self, status, headers, body):
+        lines = ['HTTP/1.1 %s' % status]
+        for name, value in headers:
+            if name.lower() not in ('content-length', 'connection'):
+                lines.append('%s: %s' % (name, value))
+        lines.append('Content-Length: %d' % len(body))
+        if not self._keep_alive:
+            lines.append('Connection: close')
+        self.write('\r\n'.join(lines) + '\r\n\r\n' + body)
+
+        self._busy = False
+        self._active = time()
+        if self._keep_alive:
+            self._next_request()
+        else:
+            self._close_when_done = True
+
+    def respond_error(self, code):
+        self._keep_alive = False
+        self._send_response(
+            '%d %s' % (code, _REASONS[code]),
+            [('Content-Type', 'text/plain')],
+            _REASONS[code]
+        )
+
+    ## Event streams
+
+    def start_stream(self, since):
+        self._stream_version = since
+        self._in = ''
+        self.write(
+            'HTTP/1.1 200 OK\r\n'
+            'Content-Type: text/event-stream\r\n'
+            'Cache-Control: no-cache\r\n'
+            'Connection: close\r\n\r\n'
+            'retry: 5000\n\n'
+        )
+
+    def send_events(self, messages):
+        for version, message in messages:
+            if version > self._stream_version:
+                self.write(message)
+                self._stream_version = version
+
+    ## Closing
+
+    def close_if_idle(self, now):
+        if (not self._busy and self._stream_version is None and
+                now - self._active > IDLE_TIMEOUT):
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.close()
+
+    def close(self):
+        self.server.streams.close(self)
+        asyncore.dispatcher.close(self)
+
+def _parse_head(head):
+    lines = head.split('\r\n')
+    method, target, version = lines[0].split(' ', 2)
+
+    headers = {}
+    for line in lines[1:]:
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+class HTTPServer(asyncore.dispatcher):
+    def __init__(self, application, address, workers=DEFAULT_WORKERS,
+                 telldus=None):
+        self.loop = EventLoop()
+        asyncore.dispatcher.__init__(self, map=self.loop.map)
+
+        self.application = application
+        self.pool = WorkerPool(self.loop, workers)
+        self.streams = EventStreams(self.loop, self.pool,
+                                    telldus or kraft.telldus)
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(1024)
+        self.server_name = socket.getfqdn(address[0])
+        self.server_port = self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            HTTPConnection(pair[0], pair[1], self)
+
+    def handle_error(self):
+        log.exception('Accepting a connection failed')
+
+    def environ(self, method, path, query, version, headers, body, addr):
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server_name,
+            'SERVER_PORT': str(self.server_port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': addr and addr[0] or '',
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = value
+        return environ
+
+    def serve_forever(self):
+        self.streams.start()
+        self.loop.run()
+
+# Same arguments as the web.py server, [host:]port
+def main(args):
+    host, port = DEFAULT_HOST, DEFAULT_PORT
+    if args:
+        if ':' in args[0]:
+            host, port = args[0].rsplit(':', 1)
+        else:
+            port = args[0]
+        port = int(port)
+
+    workers = DEFAULT_WORKERS
+    if len(args) > 1:
+        workers = int(args[1])
+
+    logging.basicConfig()
+    application = web.httpserver.StaticMiddleware(kraft.app.wsgifunc())
+    server = HTTPServer(application, (host, port), workers)
+    print 'http://%s:%d/' % (host, port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
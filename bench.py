@@ -0,0 +1,452 @@
+# Kraft benchmarks
+#
+# Micro-benchmarks for the td.py binding layer compare the old wrappers,
+# setting up ctypes on every call, with td.Telldus and its symbols typed once
+# at load time. They run against libtelldus-core when it is installed and
+# telldusd answers, otherwise against a stub library built with the C
+# compiler in CC, so both sides call real ctypes functions.
+#
+# The suite runs td.py, api.py and kraft.py against fakecore.FakeCore at
+# 10, 100 and 1000 devices, so no Tellstick or telldusd is needed either.
+# Startup cases time fresh processes up to their first responses.
+# Every run is appended to bench_results.jsonl with the git version and
+# compared to the last run with the same latency.
+#
+#   python bench.py binding [iterations]
+#   python bench.py suite [latency in ms] [rounds]
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from subprocess import Popen, PIPE
+from time import time
+from itertools import count
+from timeit import default_timer as timer
+from platform import system as OS
+from ctypes import c_int, c_char_p, c_void_p, CDLL
+from ctypes.util import find_library
+
+import td
+import fakecore
+from settings import config
+
+DEFAULT_ITERATIONS = 100000
+
+# Device counts and rounds of every case in the suite
+SUITE_SIZES = (10, 100, 1000)
+DEFAULT_ROUNDS = 20
+
+# Copies of every frame in the raw events case, remotes repeat each frame
+RAW_REPEATS = 3
+
+# Fresh processes started per device count for the startup cases
+STARTUP_RUNS = 5
+
+# Slower by this fraction than the last run is reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'bench_results.jsonl')
+
+# The wrappers as they were before the signature table, typing the symbol
+# and asking for the OS on every call.
+def per_call_get_name(tdso, device_id):
+    func = tdso.tdGetName
+    func.restype = c_void_p
+
+    name_p = func(device_id)
+    name = c_char_p(name_p).value
+
+    if OS() != 'Darwin':
+        tdso.tdReleaseString(name_p)
+
+    return name
+
+def per_call_get_parameter(tdso, device_id, key, default_value):
+    func = tdso.tdGetDeviceParameter
+    func.restype = c_void_p
+    func.argtypes = [c_int, c_char_p, c_char_p]
+
+    value_p = func(device_id, key, default_value)
+    value = c_char_p(value_p).value
+
+    if OS() != 'Darwin':
+        tdso.tdReleaseString(value_p)
+
+    return value
+
+# Stub libtelldus-core with one device. Strings are allocated and freed like
+# telldus-core does, every other symbol returns 0.
+STUB_SOURCE = '''
+#include <stdlib.h>
+#include <string.h>
+
+void tdReleaseString(char *string) { free(string); }
+int tdGetNumberOfDevices(void) { return 1; }
+int tdGetDeviceId(int index) { return index == 0 ? 1 : -1; }
+char *tdGetName(int id) { return strdup("Lampa 1"); }
+char *tdGetDeviceParameter(int id, const char *key, const char *value) {
+    return strdup(strcmp(key, "house") == 0 ? "1488" : value);
+}
+'''
+STUB_SYMBOLS = (
+    'tdReleaseString', 'tdGetNumberOfDevices', 'tdGetDeviceId', 'tdGetName',
+    'tdGetDeviceParameter'
+)
+
+def build_stub(directory):
+    source = os.path.join(directory, 'stub.c')
+    library = os.path.join(directory, 'libtelldus-stub.so')
+
+    with open(source, 'w') as f:
+        f.write(STUB_SOURCE)
+        for symbol in sorted(td._SIGNATURES):
+            if symbol not in STUB_SYMBOLS:
+                f.write('int %s() { return 0; }\n' % symbol)
+
+    p = Popen(
+        [os.environ.get('CC', 'cc'), '-shared', '-fPIC', '-O2', '-o',
+         library, source],
+        stdout=PIPE,
+        stderr=PIPE
+    )
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise OSError(err.strip())
+    return CDLL(library)
+
+# libtelldus-core if it loads and telldusd has a device, else the stub
+def binding_library():
+    path = find_library('telldus-core')
+    if path:
+        try:
+            library = CDLL(path)
+            library.tdInit()
+            if library.tdGetNumberOfDevices() > 0:
+                return library, 'libtelldus-core'
+        except(OSError, AttributeError):
+            pass
+
+    # The library stays loaded after its file is gone
+    scratch = tempfile.mkdtemp(prefix='kraft-bench-')
+    try:
+        return build_stub(scratch), 'stub library'
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def run(name, func, iterations):
+    start = timer()
+    for i in xrange(iterations):
+        func()
+    elapsed = timer() - start
+
+    print '%-24s %8.3f us/call' % (name, elapsed / iterations * 1e6)
+    return elapsed
+
+def bench_binding(iterations):
+    try:
+        library, name = binding_library()
+    except(OSError), e:
+        print 'Needs libtelldus-core or a C compiler for the stub: %s' % e
+        sys.exit(1)
+    print 'against %s' % name
+
+    # Timing wrappers would be measured too, leave them out
+    telldus = td.Telldus(library=library, instrument=False)
+    tdso = telldus.tdso
+    device_id = telldus.get_device_by_index(0)
+
+    cases = (
+        (
+            'tdGetName',
+            lambda: per_call_get_name(tdso, device_id),
+            lambda: telldus._get_name(device_id)
+        ),
+        (
+            'tdGetDeviceParameter',
+            lambda: per_call_get_parameter(tdso, device_id, 'house', ''),
+            lambda: telldus._get_device_parameter(device_id, 'house', '')
+        ),
+    )
+
+    for symbol, old, new in cases:
+        print symbol
+        before = run('  per-call ctypes setup', old, iterations)
+        after = run('  signature table', new, iterations)
+        print '  %-22s %8.1f%%' % ('saving', (1 - after / before) * 100)
+
+## The suite
+
+# Mean milliseconds and fake library calls per round of func, after one
+# round to fill the caches.
+def measure(core, func, rounds):
+    func()
+
+    calls = core.total_calls()
+    start = timer()
+    for i in xrange(rounds):
+        func()
+    elapsed = timer() - start
+
+    return dict(
+        ms = elapsed / rounds * 1e3,
+        calls = (core.total_calls() - calls) // rounds
+    )
+
+def read_properties(devices):
+    for device in devices:
+        device.name
+        device.model
+        device.protocol
+        device.house
+        device.unit
+        device.methods
+        device.type
+
+# Cases at one device count, against a fresh Telldus instance that api and
+# kraft are pointed at.
+def bench_size(kraft, size, latency, rounds):
+    import api
+
+    core = fakecore.FakeCore(devices=size, latency=latency)
+    telldus = td.Telldus(library=core, events=True)
+    kraft.telldus = api.telldus = telldus
+    kraft.page_cache['catalog_version'] = None
+
+    name = 'Lampa %d' % (size // 2)
+    commands = [(device_id, 'on') for device_id in sorted(core.devices)]
+    results = {}
+
+    results['devices_cold'] = measure(
+        core,
+        lambda: list(td.Telldus(library=core).Devices()),
+        rounds
+    )
+    results['devices_warm'] = measure(
+        core,
+        lambda: list(telldus.Devices()),
+        rounds
+    )
+
+    devices = list(telldus.Devices())
+    results['properties'] = measure(
+        core,
+        lambda: read_properties(devices),
+        rounds
+    )
+
+    results['find_device'] = measure(
+        core,
+        lambda: telldus.find_device(name),
+        rounds
+    )
+    results['api_lookup'] = measure(
+        core,
+        lambda: kraft.app.request('/device/model?name=%s' % name.replace(' ', '+')),
+        rounds
+    )
+
+    results['page_render'] = measure(
+        core,
+        lambda: kraft.Kraft().render(dict(kraft.page_cache)),
+        rounds
+    )
+    results['page_cached'] = measure(
+        core,
+        lambda: kraft.app.request('/'),
+        rounds
+    )
+
+    results['bulk_commands'] = measure(
+        core,
+        lambda: telldus.execute_batch(commands, source='bench'),
+        rounds
+    )
+
+    # One frame per device and round, each heard RAW_REPEATS times
+    frame_rounds = count()
+    def raw_frames():
+        house = next(frame_rounds)
+        for unit in xrange(size):
+            frame = ('class:command;protocol:arctech;model:selflearning;'
+                     'house:%d;unit:%d;group:0;method:turnon;' % (house, unit))
+            for i in xrange(RAW_REPEATS):
+                core.fire_raw_event(frame)
+
+    results['raw_events'] = measure(core, raw_frames, rounds)
+
+    telldus.unregister_events()
+    return results
+
+# Run in a new interpreter, prints milliseconds until kraft is imported and
+# until the first API request and the first page are answered.
+STARTUP_SCRIPT = '''
+import sys, json
+from timeit import default_timer as timer
+start = timer()
+
+import td, fakecore
+from settings import config
+config['catalog_path'] = sys.argv[1]
+config['series_path'] = sys.argv[2]
+core = fakecore.FakeCore(devices=int(sys.argv[3]), latency=float(sys.argv[4]))
+td.default_library = core
+
+import kraft
+imported = timer()
+kraft.app.request('/device/model?name=Lampa+1')
+api = timer()
+kraft.app.request('/')
+page = timer()
+
+print json.dumps(dict(
+    startup_import = (imported - start) * 1e3,
+    startup_first_api = (api - start) * 1e3,
+    startup_first_page = (page - start) * 1e3,
+    calls = core.total_calls()
+))
+'''
+
+# Startup cases, the median of runs fresh processes sharing one catalog so
+# all but the first come up from a stored catalog like a restart does.
+def bench_startup(scratch, size, latency, runs=STARTUP_RUNS):
+    here = os.path.dirname(os.path.abspath(__file__))
+    args = [
+        sys.executable, '-c', STARTUP_SCRIPT,
+        os.path.join(scratch, 'startup-%d.db' % size),
+        os.path.join(scratch, 'startup-series'),
+        str(size),
+        repr(latency)
+    ]
+
+    samples = []
+    for i in xrange(runs):
+        p = Popen(args, stdout=PIPE, stderr=PIPE, cwd=here)
+        out, err = p.communicate()
+        lines = out.strip().splitlines()
+        if p.returncode != 0 or not lines:
+            raise RuntimeError('Startup run failed:\n%s' % err)
+        samples.append(json.loads(lines[-1]))
+
+    results = {}
+    for case in ('startup_import', 'startup_first_api', 'startup_first_page'):
+        times = sorted(sample[case] for sample in samples)
+        results[case] = dict(
+            ms = times[len(times) // 2],
+            calls = sorted(sample['calls'] for sample in samples)[
+                len(samples) // 2
+            ]
+        )
+    return results
+
+def git_version():
+    try:
+        p = Popen(
+            ['git', 'describe', '--always', '--dirty'],
+            stdout=PIPE,
+            stderr=PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        out, err = p.communicate()
+    except(OSError):
+        return 'unknown'
+    return out.strip() or 'unknown'
+
+def load_results(path):
+    runs = []
+    if not os.path.exists(path):
+        return runs
+
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                runs.append(json.loads(line))
+    return runs
+
+def report(run, previous):
+    print 'version %s, latency %.3f ms' % (run['version'], run['latency'])
+    if previous:
+        print 'compared to %s' % previous['version']
+
+    for size in sorted(run['results'], key=int):
+        print
+        print '%d devices' % int(size)
+        for case, result in sorted(run['results'][size].items()):
+            line = '  %-16s %10.3f ms %8d calls' % (
+                case, result['ms'], result['calls']
+            )
+
+            try:
+                before = previous['results'][size][case]['ms']
+            except(TypeError, KeyError):
+                before = None
+
+            if before:
+                change = result['ms'] / before - 1
+                line += ' %+7.1f%%' % (change * 100)
+                if change > REGRESSION_THRESHOLD:
+                    line += ' REGRESSION'
+            print line
+
+def bench_suite(latency=0.0, rounds=DEFAULT_ROUNDS, sizes=SUITE_SIZES,
+                results_path=RESULTS_PATH):
+    # kraft opens its catalog and series store on import, keep them out of
+    # the way and start it with an empty fake.
+    scratch = tempfile.mkdtemp(prefix='kraft-bench-')
+    config['catalog_path'] = os.path.join(scratch, 'kraft.db')
+    config['series_path'] = os.path.join(scratch, 'series')
+    td.default_library = fakecore.FakeCore(devices=0)
+
+    try:
+        import kraft
+
+        results = {}
+        for size in sizes:
+            results[str(size)] = bench_size(kraft, size, latency, rounds)
+            results[str(size)].update(bench_startup(scratch, size, latency))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    run = dict(
+        version = git_version(),
+        time = int(time()),
+        latency = latency * 1e3,
+        rounds = rounds,
+        results = results
+    )
+
+    previous = None
+    for entry in load_results(results_path):
+        if entry.get('latency') == run['latency']:
+            previous = entry
+
+    report(run, previous)
+
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(run, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    command = 'binding'
+    if len(sys.argv) > 1:
+        command = sys.argv[1]
+
+    if command == 'binding':
+        iterations = DEFAULT_ITERATIONS
+        if len(sys.argv) > 2:
+            iterations = int(sys.argv[2])
+        bench_binding(iterations)
+    elif command == 'suite':
+        latency = 0.0
+        rounds = DEFAULT_ROUNDS
+        if len(sys.argv) > 2:
+            latency = float(sys.argv[2]) / 1e3
+        if len(sys.argv) > 3:
+            rounds = int(sys.argv[3])
+        bench_suite(latency, rounds)
+    else:
+        print 'Usage: %s binding [iterations] | suite [latency ms] [rounds]' % (
+            sys.argv[0]
+        )
+        sys.exit(1)
@@ -0,0 +1,608 @@
+# Kraft telldus broker
+#
+# Every web.py process loading telldus-core runs its own tdInit, caches and
+# transmit queue, and they all compete for telldusd. The broker is one process
+# owning the only td.Telldus, with the device catalog, audit log and sensor
+# series, and web processes reach it over a Unix socket through
+# RemoteTelldus, which stands in for td.Telldus in api.py and kraft.py.
+#
+#   python broker.py [socket path]
+#
+# Enable it for the web processes with the broker setting.
+#
+# Frames are a 4 byte big-endian length followed by a JSON array. Requests are
+# [request id, method, args...] and responses [request id, result] or
+# [request id, null, [error type, message, data]]. A client may send any
+# number of requests before reading, they are answered in order.
+
+import os
+import sys
+import json
+import errno
+import socket
+import struct
+import SocketServer
+from threading import local
+from time import time
+
+import td
+import metrics
+
+# Frame header, length of the JSON that follows
+HEADER = struct.Struct('!I')
+
+# Frames larger than this are a broken client
+MAX_FRAME = 16 * 1024 * 1024
+
+# Seconds the remote catalog and state versions are reused, the index page
+# reads them several times per request.
+STATUS_TTL = 0.5
+
+class BrokerError(td.TDError):
+    def __init__(self, errstr):
+        self.errstr = errstr
+
+    def __str__(self):
+        return repr(self.errstr)
+
+def send_frames(sock, messages):
+    data = []
+    for message in messages:
+        body = json.dumps(message, separators=(',', ':'))
+        data.append(HEADER.pack(len(body)))
+        data.append(body)
+    sock.sendall(''.join(data))
+
+# Read one frame from a file object, None at end of stream
+def read_frame(rfile):
+    header = rfile.read(HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise BrokerError('Truncated frame header')
+
+    size = HEADER.unpack(header)[0]
+    if size > MAX_FRAME:
+        raise BrokerError('Frame of %d bytes is too large' % size)
+
+    body = rfile.read(size)
+    if len(body) < size:
+        raise BrokerError('Truncated frame')
+    return json.loads(body)
+
+# Everything the web processes need from the Telldus instance, as methods
+# taking and returning JSON values.
+class Broker(object):
+    def __init__(self, telldus, scheduler=None, rules=None):
+        self.telldus = telldus
+        self.scheduler = scheduler
+        self.rules = rules
+
+    def dispatch(self, method, args):
+        handler = getattr(self, 'do_' + str(method), None)
+        if handler is None:
+            raise ValueError('Unknown method "%s"' % method)
+        return handler(*args)
+
+    def device_info(self, device):
+        entry = self.telldus.get_metadata(device.id)
+        entry.update(
+            id = device.id,
+            methods = device.methods,
+            type = device.type,
+            state = device.state
+        )
+        return entry
+
+    # The library call metrics of the broker, in the Prometheus text format
+    def do_metrics(self):
+        if not metrics.enabled:
+            return ''
+        return metrics.registry.render()
+
+    def do_status(self):
+        return dict(
+            catalog_version = self.telldus.catalog_version,
+            catalog_changed = self.telldus.catalog_changed,
+            state_version = self.telldus.states.version,
+            metadata_ttl = self.telldus.metadata_ttl
+        )
+
+    # The snapshot, unless the client has the one for these versions
+    def do_snapshot(self, versions=None):
+        devices = self.telldus.snapshot()
+        current = self.telldus._snapshot[0]
+        if versions is not None and tuple(versions) == current:
+            devices = None
+        return [current, self.do_status(), devices]
+
+    # Like api.Device, an index without a device creates one
+    def do_device_by_index(self, index):
+        dev_id = self.telldus.get_device_by_index(index)
+        if not dev_id:
+            dev_id = td.Device(self.telldus, index=index).id
+        return dev_id
+
+    def do_device(self, device_id):
+        return self.device_info(self.telldus.get_device(device_id))
+
+    def do_find_device(self, name):
+        device = self.telldus.find_device(name)
+        return device and self.device_info(device)
+
+    def do_parameter(self, device_id, parameter, default_value=None):
+        device = self.telldus.get_device(device_id)
+        return device.get_parameter(parameter, default_value)
+
+    def do_remove(self, device_id):
+        return self.telldus.get_device(device_id).remove()
+
+    def do_metadata(self, device_id, field=None):
+        return self.telldus.get_metadata(device_id, field)
+
+    def do_members(self, device_id):
+        return self.telldus.get_members(device_id)
+
+    def do_submit(self, commands, priority, source):
+        job = self.telldus.submit(commands, priority, source)
+        return job.as_dict()
+
+    def do_run_group(self, device_id, command, priority, source):
+        job = self.telldus.run_group(device_id, command, priority, source)
+        return job.as_dict()
+
+    def do_run_scene(self, device_id, priority, source):
+        return self.telldus.run_scene(device_id, priority, source).as_dict()
+
+    def do_job(self, job_id, timeout=None):
+        job = self.telldus.transmitter.job(job_id)
+        if job is None:
+            return None
+        if timeout:
+            job.wait(timeout)
+        return job.as_dict()
+
+    def do_since(self, version):
+        return self.telldus.states.since(version)
+
+    def do_wait(self, version, timeout):
+        return self.telldus.states.wait(version, timeout)
+
+    def _get_scheduler(self):
+        if self.scheduler is None:
+            raise BrokerError('The broker runs no scheduler')
+        return self.scheduler
+
+    def do_schedules(self):
+        return self._get_scheduler().schedules()
+
+    def do_get_schedule(self, schedule_id):
+        return self._get_scheduler().get(schedule_id)
+
+    def do_add_schedule(self, entry):
+        return self._get_scheduler().add(entry)
+
+    def do_update_schedule(self, schedule_id, fields):
+        return self._get_scheduler().update(schedule_id, fields)
+
+    def do_remove_schedule(self, schedule_id):
+        return self._get_scheduler().remove(schedule_id)
+
+    def _get_rules(self):
+        if self.rules is None:
+            raise BrokerError('The broker runs no rule engine')
+        return self.rules
+
+    def do_rules(self):
+        return self._get_rules().rules()
+
+    def do_get_rule(self, rule_id):
+        return self._get_rules().get(rule_id)
+
+    def do_add_rule(self, rule):
+        return self._get_rules().add(rule)
+
+    def do_update_rule(self, rule_id, fields):
+        return self._get_rules().update(rule_id, fields)
+
+    def do_remove_rule(self, rule_id):
+        return self._get_rules().remove(rule_id)
+
+# Errors are sent as [type, message, data] and raised again by the client
+def error_response(e):
+    if isinstance(e, td.TDAmbiguousNameError):
+        return ['ambiguous', e.errstr, e.device_ids]
+    if isinstance(e, td.TDDeviceError):
+        return ['device', e.errstr, None]
+    if isinstance(e, td.TDError):
+        return ['td', e.errstr, None]
+    if isinstance(e, (ValueError, TypeError, KeyError)):
+        return ['value', str(e), None]
+    return ['internal', repr(e), None]
+
+def raise_error(error):
+    kind, message, data = error
+    if kind == 'ambiguous':
+        raise td.TDAmbiguousNameError(message, data)
+    if kind == 'device':
+        raise td.TDDeviceError(message)
+    if kind == 'td':
+        raise td.TDError(message)
+    if kind == 'value':
+        raise ValueError(message)
+    raise BrokerError(message)
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        while True:
+            try:
+                request = read_frame(self.rfile)
+            except(BrokerError, ValueError):
+                return
+            if request is None:
+                return
+
+            request_id, method, args = request[0], request[1], request[2:]
+            try:
+                response = [request_id, broker.dispatch(method, args)]
+            except(Exception), e:
+                response = [request_id, None, error_response(e)]
+
+            try:
+                send_frames(self.request, [response])
+            except(socket.error):
+                return
+
+# Remove a socket left behind by a broker that died, it refuses connections.
+# Raises BrokerError when a running broker answers on it, that one must not be
+# taken over.
+def claim_socket(path):
+    if not os.path.exists(path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except(socket.error), e:
+        if e.errno != errno.ECONNREFUSED:
+            raise
+        os.remove(path)
+    else:
+        raise BrokerError('A broker is already running at %s' % path)
+    finally:
+        probe.close()
+
+class BrokerServer(SocketServer.ThreadingMixIn,
+                   SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, broker):
+        self.broker = broker
+
+        claim_socket(path)
+        SocketServer.UnixStreamServer.__init__(self, path, _Handler)
+
+# A connection per thread to the broker. Requests of a thread go out one
+# after another on its connection, or several at once with pipeline().
+class BrokerClient(object):
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self._local = local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except(socket.error), e:
+                sock.close()
+                raise BrokerError('Broker at %s: %s' % (self.path, e))
+
+            conn = (sock, sock.makefile('rb'), [0])
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            conn[1].close()
+            conn[0].close()
+
+    def call(self, method, *args):
+        return self.pipeline([(method,) + args])[0]
+
+    # Send all calls, given as (method, args...), in one write and read their
+    # results. The first error is raised once all responses are in.
+    def pipeline(self, calls):
+        sock, rfile, ids = self._connection()
+
+        requests = []
+        for call in calls:
+            ids[0] += 1
+            requests.append([ids[0]] + list(call))
+
+        try:
+            send_frames(sock, requests)
+            responses = [read_frame(rfile) for request in requests]
+        except(socket.error, BrokerError), e:
+            self.close()
+            raise BrokerError('Broker at %s: %s' % (self.path, e))
+
+        results = []
+        error = None
+        for request, response in zip(requests, responses):
+            if response is None or response[0] != request[0]:
+                self.close()
+                raise BrokerError('Broker at %s: out of sync' % self.path)
+
+            if len(response) > 2 and error is None:
+                error = response[2]
+            results.append(response[1])
+
+        if error is not None:
+            raise_error(error)
+        return results
+
+## Stand-ins for the td.py objects used by the web layer
+
+class RemoteDevice(object):
+    __slots__ = (
+        '_td', 'id', 'name', 'model', 'protocol', 'house', 'unit', 'methods',
+        'type', 'state'
+    )
+
+    def __init__(self, telldus, info):
+        self._td = telldus
+        for field in RemoteDevice.__slots__[1:]:
+            setattr(self, field, info.get(field))
+
+    @property
+    def type_name(self):
+        return td.TYPE_NAMES.get(self.type, 'unknown')
+
+    @property
+    def members(self):
+        return self._td.get_members(self.id)
+
+    def get_parameter(self, parameter=None, default_value=None):
+        return self._td.client.call('parameter', self.id, parameter,
+                                    default_value)
+
+    def remove(self):
+        return self._td.client.call('remove', self.id)
+
+class RemoteJob(object):
+    def __init__(self, telldus, job):
+        self._td = telldus
+        self._job = job
+
+    @property
+    def id(self):
+        return self._job['id']
+
+    @property
+    def status(self):
+        return self._job['status']
+
+    @property
+    def results(self):
+        return self._job['results']
+
+    def wait(self, timeout=None):
+        if self.status != 'done':
+            job = self._td.client.call('job', self.id, timeout)
+            if job is not None:
+                self._job = job
+        return self.status == 'done'
+
+    def as_dict(self):
+        return dict(self._job)
+
+class RemoteTransmitter(object):
+    def __init__(self, telldus):
+        self._td = telldus
+
+    def job(self, job_id):
+        job = self._td.client.call('job', job_id)
+        return job and RemoteJob(self._td, job)
+
+class RemoteStates(object):
+    def __init__(self, telldus):
+        self._td = telldus
+
+    @property
+    def version(self):
+        return self._td.client.call('status')['state_version']
+
+    def since(self, version=0):
+        return self._td.client.call('since', version)
+
+    def wait(self, version, timeout=None):
+        return self._td.client.call('wait', version, timeout)
+
+# Stands in for schedule.Scheduler, schedules run in the broker
+class RemoteScheduler(object):
+    def __init__(self, telldus):
+        self._td = telldus
+
+    def schedules(self):
+        return self._td.client.call('schedules')
+
+    def get(self, schedule_id):
+        return self._td.client.call('get_schedule', schedule_id)
+
+    def add(self, entry):
+        return self._td.client.call('add_schedule', entry)
+
+    def update(self, schedule_id, fields):
+        return self._td.client.call('update_schedule', schedule_id, fields)
+
+    def remove(self, schedule_id):
+        return self._td.client.call('remove_schedule', schedule_id)
+
+# Stands in for rules.RuleEngine, rules run in the broker
+class RemoteRules(object):
+    def __init__(self, telldus):
+        self._td = telldus
+
+    def rules(self):
+        return self._td.client.call('rules')
+
+    def get(self, rule_id):
+        return self._td.client.call('get_rule', rule_id)
+
+    def add(self, rule):
+        return self._td.client.call('add_rule', rule)
+
+    def update(self, rule_id, fields):
+        return self._td.client.call('update_rule', rule_id, fields)
+
+    def remove(self, rule_id):
+        return self._td.client.call('remove_rule', rule_id)
+
+# The parts of td.Telldus that api.py and kraft.py use, answered by the
+# broker. Listeners can't be subscribed from here, they run in the broker.
+class RemoteTelldus(object):
+    def __init__(self, path, timeout=None):
+        self.client = BrokerClient(path, timeout)
+        self.states = RemoteStates(self)
+        self.transmitter = RemoteTransmitter(self)
+
+        # Last status and when it was fetched, and the last snapshot
+        self._status = (0, None)
+        self._snapshot = (None, None)
+
+    def _get_status(self):
+        fetched, status = self._status
+        if status is None or time() - fetched > STATUS_TTL:
+            status = self.client.call('status')
+            self._status = (time(), status)
+        return status
+
+    @property
+    def catalog_version(self):
+        return self._get_status()['catalog_version']
+
+    @property
+    def catalog_changed(self):
+        return self._get_status()['catalog_changed']
+
+    @property
+    def metadata_ttl(self):
+        return self._get_status()['metadata_ttl']
+
+    def snapshot(self):
+        versions, devices = self._snapshot
+        current, status, changed = self.client.call('snapshot', versions)
+        self._status = (time(), status)
+
+        if changed is not None:
+            devices = changed
+            self._snapshot = (current, devices)
+        return devices
+
+    def get_metadata(self, device_id, field=None):
+        return self.client.call('metadata', device_id, field)
+
+    def get_members(self, device_id):
+        return [tuple(m) for m in self.client.call('members', device_id)]
+
+    def get_device_by_index(self, index=0):
+        return self.client.call('device_by_index', index)
+
+    def get_device(self, device_id):
+        return RemoteDevice(self, self.client.call('device', device_id))
+
+    def find_device(self, name):
+        info = self.client.call('find_device', name)
+        return info and RemoteDevice(self, info)
+
+    def submit(self, commands, priority=td.PRIORITY_INTERACTIVE, source=None):
+        plan = []
+        for device, command in commands:
+            if isinstance(device, RemoteDevice):
+                device = device.id
+            plan.append((device, command))
+
+        job = self.client.call('submit', plan, priority, source)
+        return RemoteJob(self, job)
+
+    def run_group(self, device_id, command='on',
+                  priority=td.PRIORITY_INTERACTIVE, source=None):
+        job = self.client.call('run_group', device_id, command, priority,
+                               source)
+        return RemoteJob(self, job)
+
+    def run_scene(self, device_id, priority=td.PRIORITY_INTERACTIVE,
+                  source=None):
+        job = self.client.call('run_scene', device_id, priority, source)
+        return RemoteJob(self, job)
+
+    def subscribe(self, listener):
+        raise BrokerError('Listeners run in the broker process')
+
+    # Library call metrics are recorded in the broker
+    def metrics(self):
+        return self.client.call('metrics')
+
+# Run the broker with the same catalog, audit log and series store as a
+# standalone kraft.py would.
+def serve(path):
+    from settings import Settings
+    settings = Settings().config
+
+    import db
+    import rules
+    import timeseries
+    import schedule
+
+    # Fail before loading the library when another broker runs
+    path = path or settings['broker_path']
+    claim_socket(path)
+
+    # Decided before the Telldus instance is created, like in kraft.py
+    metrics.enabled = settings['metrics']
+    telldus = td.shared(events=True)
+
+    pool = db.ConnectionPool(settings['catalog_path'])
+    catalog = db.Catalog(pool)
+    telldus.seed(catalog.devices())
+    catalog.start_sync(telldus)
+
+    audit = db.AuditLog(pool)
+    audit.start()
+    telldus.subscribe(audit.listener)
+
+    series = timeseries.SeriesStore(settings['series_path'])
+    series.start()
+    telldus.subscribe(series.listener)
+
+    scheduler = schedule.Scheduler(
+        telldus,
+        db.Schedules(pool),
+        settings['latitude'],
+        settings['longitude']
+    )
+    scheduler.start()
+
+    engine = rules.RuleEngine(telldus, db.Rules(pool))
+    engine.start()
+
+    server = BrokerServer(
+        path,
+        Broker(telldus, scheduler, engine)
+    )
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(server.server_address)
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig()
+    serve(len(sys.argv) > 1 and sys.argv[1] or None)
@@ -1,12 +1,659 @@
-from web import database
+# Kraft device catalog
+#
+# Keeps devices, groups and device parameters in SQLite so that the web UI can
+# come up from the catalog without asking telldusd about every device. The
+# catalog is synced from a td.Telldus instance in the background.
 
-db = database(dbn='sqlite', db='telldus.db')
+import os
+import json
+import errno
+import fcntl
+import logging
+import sqlite3
+from Queue import Queue, Empty
+from threading import Thread, Lock, Condition, Event
+from contextlib import contextmanager
+from time import time, sleep
 
-def initialize_db():
-    db.query('create table Device(name STRING, did INTEGER, house INTEGER, protocol STRING);')
+import td
 
-def add_device(name,did,house,protocol):
-    try:
-        db.insert(name,did,house,protocol)
-    except:
-        raise
+log = logging.getLogger(__name__)
+
+# Connections kept open by default
+DEFAULT_POOL_SIZE = 4
+
+# Seconds between background syncs, only done when the catalog changed
+DEFAULT_SYNC_INTERVAL = 60
+
+# Audit log buffering. Entries are written in batches at least every flush
+# interval, producers wait up to the timeout when the buffer is full and the
+# entry is dropped after that.
+DEFAULT_AUDIT_BUFFER = 10000
+DEFAULT_AUDIT_BATCH = 500
+DEFAULT_AUDIT_FLUSH_INTERVAL = 1.0
+DEFAULT_AUDIT_TIMEOUT = 0.5
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS devices (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL DEFAULT '',
+        model TEXT,
+        protocol TEXT,
+        type TEXT,
+        methods INTEGER,
+        updated REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS devices_name ON devices (name)',
+    '''CREATE TABLE IF NOT EXISTS parameters (
+        device_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (device_id, key)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS group_members (
+        group_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        device_id INTEGER NOT NULL,
+        method TEXT,
+        PRIMARY KEY (group_id, position)
+    )''',
+    '''CREATE INDEX IF NOT EXISTS group_members_device
+        ON group_members (device_id)''',
+    '''CREATE TABLE IF NOT EXISTS audit_log (
+        id INTEGER PRIMARY KEY,
+        time REAL NOT NULL,
+        device_id INTEGER,
+        event TEXT NOT NULL,
+        method TEXT,
+        success INTEGER,
+        source TEXT,
+        data TEXT
+    )''',
+    '''CREATE INDEX IF NOT EXISTS audit_log_device_time
+        ON audit_log (device_id, time)''',
+    'CREATE INDEX IF NOT EXISTS audit_log_time ON audit_log (time)',
+    '''CREATE TABLE IF NOT EXISTS schedules (
+        id INTEGER PRIMARY KEY,
+        device_id INTEGER NOT NULL,
+        command TEXT NOT NULL,
+        time TEXT NOT NULL,
+        time_offset INTEGER NOT NULL DEFAULT 0,
+        days TEXT NOT NULL,
+        enabled INTEGER NOT NULL DEFAULT 1,
+        catch_up INTEGER NOT NULL DEFAULT 0,
+        last_run REAL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS rules (
+        id INTEGER PRIMARY KEY,
+        rule TEXT NOT NULL
+    )''',
+)
+
+# Statements are kept as constants so sqlite3 reuses their prepared form from
+# its per-connection statement cache.
+_UPSERT_DEVICE = '''INSERT OR REPLACE INTO devices
+    (id, name, model, protocol, type, methods, updated)
+    VALUES (?, ?, ?, ?, ?, ?, ?)'''
+_UPSERT_PARAMETER = '''INSERT OR REPLACE INTO parameters
+    (device_id, key, value) VALUES (?, ?, ?)'''
+_INSERT_MEMBER = '''INSERT INTO group_members
+    (group_id, position, device_id, method) VALUES (?, ?, ?, ?)'''
+_DELETE_MEMBERS = 'DELETE FROM group_members WHERE group_id = ?'
+_DELETE_DEVICE = 'DELETE FROM devices WHERE id = ?'
+_DELETE_PARAMETERS = 'DELETE FROM parameters WHERE device_id = ?'
+_SELECT_DEVICES = '''SELECT id, name, model, protocol, type, methods
+    FROM devices ORDER BY id'''
+_SELECT_PARAMETERS = 'SELECT device_id, key, value FROM parameters'
+_SELECT_MEMBERS = '''SELECT device_id, method FROM group_members
+    WHERE group_id = ? ORDER BY position'''
+_INSERT_AUDIT = '''INSERT INTO audit_log
+    (time, device_id, event, method, success, source, data)
+    VALUES (?, ?, ?, ?, ?, ?, ?)'''
+_SELECT_AUDIT = '''SELECT time, device_id, event, method, success, source,
+    data FROM audit_log'''
+_SELECT_SCHEDULES = '''SELECT id, device_id, command, time, time_offset,
+    days, enabled, catch_up, last_run FROM schedules ORDER BY id'''
+_INSERT_SCHEDULE = '''INSERT INTO schedules
+    (device_id, command, time, time_offset, days, enabled, catch_up, last_run)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+_UPDATE_SCHEDULE = '''UPDATE schedules SET device_id = ?, command = ?,
+    time = ?, time_offset = ?, days = ?, enabled = ?, catch_up = ?,
+    last_run = ? WHERE id = ?'''
+_DELETE_SCHEDULE = 'DELETE FROM schedules WHERE id = ?'
+_UPDATE_LAST_RUN = 'UPDATE schedules SET last_run = ? WHERE id = ?'
+_SELECT_RULES = 'SELECT id, rule FROM rules ORDER BY id'
+_INSERT_RULE = 'INSERT INTO rules (rule) VALUES (?)'
+_UPDATE_RULE = 'UPDATE rules SET rule = ? WHERE id = ?'
+_DELETE_RULE = 'DELETE FROM rules WHERE id = ?'
+
+# Parameters stored with every device
+DEVICE_PARAMETERS = ('house', 'unit')
+
+# Names come from the C-API as UTF-8 encoded str, sqlite3 wants unicode.
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+# Small pool of connections for threaded web.py workers. Connections are
+# created when needed, up to size, and in WAL mode so readers don't block the
+# writer.
+class ConnectionPool(object):
+    def __init__(self, path, size=DEFAULT_POOL_SIZE):
+        self.path = path
+        self.size = size
+
+        self._idle = Queue()
+        self._created = 0
+        self._lock = Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout = 30,
+            check_same_thread = False,
+            cached_statements = 100
+        )
+        # Get UTF-8 encoded str back, like the C-API gives us
+        conn.text_factory = str
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except(Empty):
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._connect()
+            except:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    # Use as "with pool.connection() as conn:", commits when the block is
+    # done and rolls back if it raised.
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def initialize(self, schema=SCHEMA):
+        with self.connection() as conn:
+            for statement in schema:
+                conn.execute(statement)
+
+# Devices, groups and parameters. Device entries are dicts shaped like the
+# ones from td.Telldus.snapshot().
+class Catalog(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.pool.initialize()
+
+        self.synced = None
+        self._synced_version = None
+        self._thread = None
+        self._stopped = Event()
+
+    # All stored devices sorted by ID
+    def devices(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute(_SELECT_DEVICES).fetchall()
+            params = conn.execute(_SELECT_PARAMETERS).fetchall()
+
+        parameters = {}
+        for device_id, key, value in params:
+            parameters.setdefault(device_id, {})[key] = value
+
+        devices = []
+        for device_id, name, model, protocol, type_name, methods in rows:
+            device = dict(
+                id = device_id,
+                name = name,
+                model = model,
+                protocol = protocol,
+                type = type_name,
+                methods = methods
+            )
+            for key in DEVICE_PARAMETERS:
+                device[key] = parameters.get(device_id, {}).get(key, '')
+            devices.append(device)
+        return devices
+
+    # Stored members of a group or scene as a list of (device id, method)
+    def members(self, group_id):
+        with self.pool.connection() as conn:
+            return conn.execute(_SELECT_MEMBERS, (group_id,)).fetchall()
+
+    # Insert or update devices in one transaction
+    def upsert_devices(self, devices):
+        now = time()
+
+        device_rows = []
+        parameter_rows = []
+        for device in devices:
+            device_rows.append((
+                device['id'],
+                _text(device.get('name') or ''),
+                _text(device.get('model')),
+                _text(device.get('protocol')),
+                device.get('type'),
+                device.get('methods'),
+                now
+            ))
+            for key in DEVICE_PARAMETERS:
+                parameter_rows.append((
+                    device['id'],
+                    key,
+                    _text(device.get(key) or '')
+                ))
+
+        with self.pool.connection() as conn:
+            conn.executemany(_UPSERT_DEVICE, device_rows)
+            conn.executemany(_UPSERT_PARAMETER, parameter_rows)
+
+    # Replace members of groups, members is a dict of group id => list of
+    # (device id, method)
+    def set_members(self, members):
+        rows = []
+        for group_id, group_members in members.items():
+            for position, (device_id, method) in enumerate(group_members):
+                rows.append((group_id, position, device_id, method))
+
+        with self.pool.connection() as conn:
+            conn.executemany(
+                _DELETE_MEMBERS,
+                [(group_id,) for group_id in members]
+            )
+            conn.executemany(_INSERT_MEMBER, rows)
+
+    def remove_devices(self, device_ids):
+        rows = [(device_id,) for device_id in device_ids]
+        with self.pool.connection() as conn:
+            conn.executemany(_DELETE_DEVICE, rows)
+            conn.executemany(_DELETE_PARAMETERS, rows)
+            conn.executemany(_DELETE_MEMBERS, rows)
+
+    # Make the catalog match what telldus knows. With refresh all metadata is
+    # fetched from telldusd again instead of taken from its caches.
+    def sync(self, telldus, refresh=False):
+        if refresh:
+            telldus.refresh_metadata()
+
+        devices = telldus.snapshot()
+        version = telldus.catalog_version
+
+        members = {}
+        for device in devices:
+            if device['type'] in ('Group', 'Scene'):
+                members[device['id']] = telldus.get_members(device['id'])
+
+        current = set(device['id'] for device in devices)
+        stored = set(device['id'] for device in self.devices())
+
+        self.upsert_devices(devices)
+        self.remove_devices(stored - current)
+        self.set_members(members)
+
+        self._synced_version = version
+        self.synced = time()
+
+    # Sync now with fresh metadata from telldusd, then every interval seconds
+    # as long as the catalog version of telldus has changed.
+    def start_sync(self, telldus, interval=DEFAULT_SYNC_INTERVAL):
+        if self._thread is not None:
+            return
+
+        self._thread = Thread(
+            target = self._sync_loop,
+            args = (telldus, interval),
+            name = 'catalog-sync'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _sync_loop(self, telldus, interval):
+        refresh = True
+        while not self._stopped.is_set():
+            if refresh or telldus.catalog_version != self._synced_version:
+                try:
+                    self.sync(telldus, refresh)
+                    refresh = False
+                except(Exception):
+                    log.exception('Catalog sync failed')
+            self._stopped.wait(interval)
+
+    # End the sync thread, waiting up to timeout seconds for it
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+
+        self._stopped.set()
+        self._thread.join(timeout)
+
+# Append-only history of commands and telldusd events. Entries are buffered
+# in memory and written by a background thread, many per transaction, so
+# nobody sending a command waits for the disk.
+class AuditLog(object):
+    def __init__(self, pool, max_buffer=DEFAULT_AUDIT_BUFFER,
+                 batch=DEFAULT_AUDIT_BATCH,
+                 flush_interval=DEFAULT_AUDIT_FLUSH_INTERVAL,
+                 timeout=DEFAULT_AUDIT_TIMEOUT):
+        self.pool = pool
+        self.pool.initialize()
+
+        self.max_buffer = max_buffer
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+
+        # Entries not yet written, and entries dropped because the buffer
+        # stayed full
+        self.dropped = 0
+        self._buffer = []
+        self._condition = Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = Thread(target=self._flush_loop, name='audit-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Queue an entry. Waits for room when the buffer is full and returns
+    # False if the entry had to be dropped.
+    def append(self, event, device_id=None, method=None, success=None,
+               source=None, data=None, when=None):
+        row = (
+            when or time(),
+            device_id,
+            event,
+            None if method is None else str(method),
+            None if success is None else int(bool(success)),
+            _text(source),
+            _text(data)
+        )
+
+        with self._condition:
+            if len(self._buffer) >= self.max_buffer:
+                self._condition.notify_all()
+                self._condition.wait(self.timeout)
+
+                if len(self._buffer) >= self.max_buffer:
+                    self.dropped += 1
+                    return False
+
+            self._buffer.append(row)
+            if len(self._buffer) >= self.batch:
+                self._condition.notify_all()
+        return True
+
+    # For td.Telldus.subscribe
+    def listener(self, event, device_id, entry):
+        if event == 'command':
+            self.append(
+                event,
+                device_id,
+                method = entry['method'],
+                success = entry['success'],
+                source = entry['source'],
+                when = entry['time']
+            )
+        elif event == 'state':
+            self.append(
+                event,
+                device_id,
+                method = entry['state'] or entry['method'],
+                source = 'telldusd',
+                data = entry['data'],
+                when = entry['changed']
+            )
+        elif event == 'sensor':
+            # Sensors have IDs of their own, not device IDs
+            self.append(
+                event,
+                device_id,
+                method = td.SENSOR_TYPES.get(
+                    entry['data_type'],
+                    entry['data_type']
+                ),
+                source = 'telldusd',
+                data = str(entry['value']),
+                when = entry['timestamp']
+            )
+        else:
+            self.append(
+                event,
+                device_id,
+                source = 'telldusd',
+                when = entry['changed']
+            )
+
+    # For processes that only log the commands they send, telldusd events
+    # reach every process and are logged by the owner, see OwnerLock.
+    def command_listener(self, event, device_id, entry):
+        if event == 'command':
+            self.listener(event, device_id, entry)
+
+    # Write everything buffered in one transaction
+    def flush(self):
+        with self._condition:
+            rows = self._buffer
+            self._buffer = []
+            self._condition.notify_all()
+
+        if rows:
+            with self.pool.connection() as conn:
+                conn.executemany(_INSERT_AUDIT, rows)
+        return len(rows)
+
+    def _flush_loop(self):
+        while not self._stopped:
+            with self._condition:
+                if len(self._buffer) < self.batch and not self._stopped:
+                    self._condition.wait(self.flush_interval)
+
+            try:
+                self.flush()
+            except(Exception):
+                # Keep going, the entries of this batch are lost
+                sleep(self.flush_interval)
+
+    # Write what is buffered and end the writer thread, waiting up to timeout
+    # seconds for it
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    # Entries for a device and/or time range, newest first
+    def query(self, device_id=None, start=None, end=None, limit=100):
+        where = []
+        args = []
+        if device_id is not None:
+            where.append('device_id = ?')
+            args.append(device_id)
+        if start is not None:
+            where.append('time >= ?')
+            args.append(start)
+        if end is not None:
+            where.append('time < ?')
+            args.append(end)
+
+        sql = _SELECT_AUDIT
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time DESC LIMIT ?'
+        args.append(limit)
+
+        with self.pool.connection() as conn:
+            rows = conn.execute(sql, args).fetchall()
+
+        entries = []
+        for when, dev_id, event, method, success, source, data in rows:
+            entries.append(dict(
+                time = when,
+                device_id = dev_id,
+                event = event,
+                method = method,
+                success = None if success is None else bool(success),
+                source = source,
+                data = data
+            ))
+        return entries
+
+# Timed commands run by schedule.Scheduler. Entries are dicts with id,
+# device_id, command, time, offset, days as a list of weekdays with Monday as
+# 0, enabled, catch_up and last_run.
+class Schedules(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.pool.initialize()
+
+    def all(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute(_SELECT_SCHEDULES).fetchall()
+
+        entries = []
+        for row in rows:
+            entries.append(dict(
+                id = row[0],
+                device_id = row[1],
+                command = row[2],
+                time = row[3],
+                offset = row[4],
+                days = [int(day) for day in row[5]],
+                enabled = bool(row[6]),
+                catch_up = row[7],
+                last_run = row[8]
+            ))
+        return entries
+
+    def _row(self, entry):
+        return [
+            entry['device_id'],
+            entry['command'],
+            entry['time'],
+            entry['offset'],
+            ''.join(str(day) for day in sorted(entry['days'])),
+            int(entry['enabled']),
+            entry['catch_up'],
+            entry.get('last_run')
+        ]
+
+    # Store a new entry and return its ID
+    def add(self, entry):
+        with self.pool.connection() as conn:
+            return conn.execute(_INSERT_SCHEDULE, self._row(entry)).lastrowid
+
+    def update(self, entry):
+        with self.pool.connection() as conn:
+            conn.execute(_UPDATE_SCHEDULE, self._row(entry) + [entry['id']])
+
+    def remove(self, schedule_id):
+        with self.pool.connection() as conn:
+            return conn.execute(_DELETE_SCHEDULE, (schedule_id,)).rowcount > 0
+
+    # Mark several entries as run at when, in one transaction
+    def set_last_run(self, schedule_ids, when):
+        with self.pool.connection() as conn:
+            conn.executemany(
+                _UPDATE_LAST_RUN,
+                [(when, schedule_id) for schedule_id in schedule_ids]
+            )
+
+# Automations run by rules.RuleEngine. Rules are stored as JSON, their shape
+# is up to the engine.
+class Rules(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.pool.initialize()
+
+    # List of (rule ID, rule dict)
+    def all(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute(_SELECT_RULES).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    # Store a new rule and return its ID
+    def add(self, rule):
+        with self.pool.connection() as conn:
+            return conn.execute(_INSERT_RULE, (json.dumps(rule),)).lastrowid
+
+    def update(self, rule_id, rule):
+        with self.pool.connection() as conn:
+            conn.execute(_UPDATE_RULE, (json.dumps(rule), rule_id))
+
+    def remove(self, rule_id):
+        with self.pool.connection() as conn:
+            return conn.execute(_DELETE_RULE, (rule_id,)).rowcount > 0
+
+# Changes refused by a process that doesn't own the background work
+class ReadOnlyError(td.TDError):
+    def __init__(self, errstr):
+        self.errstr = errstr
+
+    def __str__(self):
+        return repr(self.errstr)
+
+# Of several processes sharing a catalog the one holding an exclusive lock on
+# path owns the work that must only happen once, like catalog syncs, logging
+# telldusd events and running schedules and rules. The lock goes with the
+# process, another can take over once it exits.
+class OwnerLock(object):
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._pid = None
+
+    @property
+    def owned(self):
+        return self._pid == os.getpid()
+
+    # Try to become the owner, returns whether this process is
+    def acquire(self):
+        if self.owned:
+            return True
+
+        # A lock inherited over fork is the parent's
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except(IOError), e:
+            lock_file.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+
+        self._file = lock_file
+        self._pid = os.getpid()
+        return True
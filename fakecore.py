@@ -0,0 +1,279 @@
+# Fake telldus-core
+#
+# A Python stand-in for libtelldus-core that td.Telldus can load instead of
+# the shared library, for benchmarks and for trying things out without a
+# Tellstick:
+#
+#   >>> import td, fakecore
+#   >>> t = td.Telldus(library=fakecore.FakeCore(devices=100, latency=0.001))
+#
+# Symbols take the same arguments as their ctypes counterparts and char*
+# results are handed out as addresses of buffers that tdReleaseString frees,
+# so td.py runs its normal code paths. Every call can be delayed by latency
+# seconds to simulate the round trip to telldusd.
+
+from ctypes import create_string_buffer, addressof
+from time import time, sleep
+
+import td
+
+# Parameters given to generated devices
+DEFAULT_MODEL = 'selflearning-switch'
+DEFAULT_PROTOCOL = 'arctech'
+
+# A symbol of the fake library. Like a ctypes function it has restype and
+# argtypes, which are set by td.Telldus but not used.
+class _Symbol(object):
+    __slots__ = ('name', 'restype', 'argtypes', 'calls', '_func', '_core')
+
+    def __init__(self, core, name, func):
+        self.name = name
+        self.restype = None
+        self.argtypes = None
+        self.calls = 0
+        self._func = func
+        self._core = core
+
+    def __call__(self, *args):
+        self.calls += 1
+        if self._core.latency:
+            sleep(self._core.latency)
+        return self._func(*args)
+
+class FakeCore(object):
+    def __init__(self, devices=10, latency=0.0, sensors=0):
+        self.latency = latency
+
+        # device id => dict(name, model, protocol, type, parameters, last)
+        self.devices = {}
+        self._next_id = 1
+        for i in range(devices):
+            device_id = self.tdAddDevice()
+            device = self.devices[device_id]
+            device['name'] = 'Lampa %d' % device_id
+            device['model'] = DEFAULT_MODEL
+            device['protocol'] = DEFAULT_PROTOCOL
+            device['parameters'].update(
+                house = str(1000 + device_id),
+                unit = '1'
+            )
+
+        # (protocol, model, id) => {data type: (value, timestamp)}
+        self.sensors = {}
+        for i in range(sensors):
+            self.sensors[('fineoffset', 'temperaturehumidity', 100 + i)] = {
+                td.TELLSTICK_TEMPERATURE: ('21.5', int(time())),
+                td.TELLSTICK_HUMIDITY: ('40', int(time())),
+            }
+        self._sensor_iter = None
+
+        # Live char* results, address => buffer
+        self._strings = {}
+
+        # callback id => (kind, callback)
+        self._callbacks = {}
+        self._next_callback = 1
+
+    # Symbols are looked up like on a CDLL and created once
+    def __getattr__(self, name):
+        func = getattr(type(self), '_' + name, None)
+        if not name.startswith('td') or func is None:
+            raise AttributeError(name)
+
+        symbol = _Symbol(self, name, func.__get__(self))
+        setattr(self, name, symbol)
+        return symbol
+
+    # Number of calls made per symbol
+    def calls(self):
+        counts = {}
+        for name, value in self.__dict__.items():
+            # Symbols may be wrapped by metrics.instrument
+            value = getattr(value, 'func', value)
+            if isinstance(value, _Symbol):
+                counts[name] = value.calls
+        return counts
+
+    def total_calls(self):
+        return sum(self.calls().values())
+
+    def _string(self, value):
+        buf = create_string_buffer(value or '')
+        address = addressof(buf)
+        self._strings[address] = buf
+        return address
+
+    ## Simulating events from telldusd
+
+    def fire_device_event(self, device_id, method, data=None):
+        for kind, callback in self._callbacks.values():
+            if kind == 'device':
+                callback(device_id, method, data, 0, None)
+
+    def fire_device_change_event(self, device_id, change_event,
+                                 change_type=0):
+        for kind, callback in self._callbacks.values():
+            if kind == 'change':
+                callback(device_id, change_event, change_type, 0, None)
+
+    def fire_sensor_event(self, protocol, model, sensor_id, data_type, value,
+                          timestamp=None):
+        timestamp = timestamp or int(time())
+        values = self.sensors.setdefault((protocol, model, sensor_id), {})
+        values[data_type] = (str(value), timestamp)
+
+        for kind, callback in self._callbacks.values():
+            if kind == 'sensor':
+                callback(protocol, model, sensor_id, data_type, str(value),
+                         timestamp, 0, None)
+
+    def fire_raw_event(self, data, controller_id=1):
+        for kind, callback in self._callbacks.values():
+            if kind == 'raw':
+                callback(data, controller_id, 0, None)
+
+    ## The C-API
+
+    def _tdInit(self):
+        return None
+
+    def _tdReleaseString(self, address):
+        self._strings.pop(address, None)
+
+    def _tdAddDevice(self):
+        device_id = self._next_id
+        self._next_id += 1
+        self.devices[device_id] = dict(
+            name = '',
+            model = '',
+            protocol = '',
+            type = td.TYPE_DEVICE,
+            parameters = {},
+            last = td.METHOD_TURNOFF
+        )
+        return device_id
+
+    def _tdRemoveDevice(self, device_id):
+        return self.devices.pop(device_id, None) is not None
+
+    def _tdGetNumberOfDevices(self):
+        return len(self.devices)
+
+    def _tdGetDeviceId(self, device_index):
+        ids = sorted(self.devices)
+        if 0 <= device_index < len(ids):
+            return ids[device_index]
+        return -1
+
+    def _tdGetName(self, device_id):
+        return self._string(self.devices.get(device_id, {}).get('name'))
+
+    def _tdSetName(self, device_id, name):
+        if device_id not in self.devices:
+            return False
+        self.devices[device_id]['name'] = name
+        return True
+
+    def _tdGetDeviceParameter(self, device_id, key, default_value):
+        parameters = self.devices.get(device_id, {}).get('parameters', {})
+        return self._string(parameters.get(key, default_value))
+
+    def _tdSetDeviceParameter(self, device_id, key, value):
+        if device_id not in self.devices:
+            return False
+        self.devices[device_id]['parameters'][key] = value
+        return True
+
+    def _tdGetProtocol(self, device_id):
+        return self._string(self.devices.get(device_id, {}).get('protocol'))
+
+    def _tdSetProtocol(self, device_id, protocol):
+        if device_id not in self.devices:
+            return False
+        self.devices[device_id]['protocol'] = protocol
+        return True
+
+    def _tdGetModel(self, device_id):
+        return self._string(self.devices.get(device_id, {}).get('model'))
+
+    def _tdSetModel(self, device_id, model):
+        if device_id not in self.devices:
+            return False
+        self.devices[device_id]['model'] = model
+        return True
+
+    def _tdGetDeviceType(self, device_id):
+        return self.devices.get(device_id, {}).get('type', td.TYPE_DEVICE)
+
+    def _tdMethods(self, device_id, methods):
+        supported = td.METHOD_TURNON | td.METHOD_TURNOFF | td.METHOD_LEARN
+        return methods & supported
+
+    def _send(self, device_id, method):
+        if device_id not in self.devices:
+            return -3 # TELLSTICK_ERROR_DEVICE_NOT_FOUND
+        self.devices[device_id]['last'] = method
+        self.fire_device_event(device_id, method)
+        return td.TELLSTICK_SUCCESS
+
+    def _tdTurnOn(self, device_id):
+        return self._send(device_id, td.METHOD_TURNON)
+
+    def _tdTurnOff(self, device_id):
+        return self._send(device_id, td.METHOD_TURNOFF)
+
+    def _tdLearn(self, device_id):
+        return self._send(device_id, td.METHOD_LEARN)
+
+    def _tdLastSentCommand(self, device_id, methods):
+        return self.devices.get(device_id, {}).get('last', 0) & methods
+
+    def _register(self, kind, callback):
+        callback_id = self._next_callback
+        self._next_callback += 1
+        self._callbacks[callback_id] = (kind, callback)
+        return callback_id
+
+    def _tdRegisterDeviceEvent(self, callback, context):
+        return self._register('device', callback)
+
+    def _tdRegisterDeviceChangeEvent(self, callback, context):
+        return self._register('change', callback)
+
+    def _tdRegisterSensorEvent(self, callback, context):
+        return self._register('sensor', callback)
+
+    def _tdRegisterRawDeviceEvent(self, callback, context):
+        return self._register('raw', callback)
+
+    def _tdUnregisterCallback(self, callback_id):
+        if self._callbacks.pop(callback_id, None) is None:
+            return -1
+        return td.TELLSTICK_SUCCESS
+
+    # Output arguments come in as byref() objects
+    def _tdSensor(self, protocol, protocol_len, model, model_len, sensor_id,
+                  data_types):
+        if self._sensor_iter is None:
+            self._sensor_iter = iter(sorted(self.sensors.items()))
+
+        try:
+            key, values = next(self._sensor_iter)
+        except(StopIteration):
+            self._sensor_iter = None
+            return -1 # TELLSTICK_ERROR_DEVICE_NOT_FOUND
+
+        protocol.value = key[0][:protocol_len - 1]
+        model.value = key[1][:model_len - 1]
+        sensor_id._obj.value = key[2]
+        data_types._obj.value = sum(values)
+        return td.TELLSTICK_SUCCESS
+
+    def _tdSensorValue(self, protocol, model, sensor_id, data_type, value,
+                       value_len, timestamp):
+        values = self.sensors.get((protocol, model, sensor_id), {})
+        if data_type not in values:
+            return -1
+        value.value = values[data_type][0][:value_len - 1]
+        timestamp._obj.value = values[data_type][1]
+        return td.TELLSTICK_SUCCESS
@@ -1,53 +1,596 @@
 # Kraft web interface
 
+import os
+import atexit
 import gettext
+import json
 import web
+from datetime import datetime
+from threading import Lock
+from time import time
 from settings import Settings
 s = Settings()
 settings = s.config
 
+# Instrumentation has to be decided before api creates its Telldus instance
+import metrics
+metrics.enabled = settings['metrics']
+
 import api
 import td
 
-# Initiate Telldus library
-telldus = td.Telldus()
+# The Telldus instance of api, shared by the whole process. With a broker it
+# owns the library, the catalog sync, the audit log and the series store, and
+# this process only reads them.
+telldus = api.telldus
+
+# Seconds between keepalive comments on idle event streams
+EVENTS_KEEPALIVE = 25
+
+# Event streams open at once. Under the threaded web.py server every stream
+# holds one of its threads for as long as the client stays, so a few idle
+# tablets would leave none for requests. asyncserver.py answers /events on
+# its own and serves any number of streams.
+MAX_EVENT_STREAMS = 4
+
+# Seconds a refused event stream is asked to wait before trying again
+EVENTS_RETRY_AFTER = 60
+
+# Seconds to wait for each background thread at exit
+STOP_TIMEOUT = 5
+
+# Seconds between attempts of a process to take over from the owner
+OWNER_RETRY = 10
+
+## Background work
+#
+# Nothing runs at import. The first request of each process opens the
+# catalog, audit log and series store, starts schedules and rules and warms
+# up the library in the background, so servers forking workers after
+# importing kraft get it going in every worker instead of leaving them with
+# threads that didn't survive the fork.
+#
+# Without a broker only the owner of several processes, see db.OwnerLock,
+# syncs the catalog, logs telldusd events, rolls up sensor readings and runs
+# schedules and rules. The others log the commands they send, read the rest
+# and take over once the owner exits. Run broker.py to manage schedules and
+# rules from every process.
+pool = None
+catalog = None
+audit = None
+series = None
+scheduler = None
+engine = None
+owner = None
+
+_start_lock = Lock()
+_started = dict(pid=None, tried=0, listeners=[], services=[])
+
+def start():
+    pid = os.getpid()
+    if _started['pid'] == pid and (
+            owner is None or owner.owned or
+            time() - _started['tried'] < OWNER_RETRY):
+        return
+
+    with _start_lock:
+        if _started['pid'] != pid:
+            _start_process()
+            _started['pid'] = pid
+
+        if owner is not None and not owner.owned:
+            _started['tried'] = time()
+            if owner.acquire():
+                _start_owner()
+
+# Flush the audit log and series and end the background threads of this
+# process before the interpreter shuts down under them
+def stop():
+    if _started['pid'] != os.getpid():
+        return
+
+    for service in reversed(_started['services']):
+        service.stop(STOP_TIMEOUT)
+    _started['services'] = []
+atexit.register(stop)
+
+def _subscribe(listener):
+    telldus.subscribe(listener)
+    _started['listeners'].append(listener)
+
+def _unsubscribe(listener):
+    telldus.unsubscribe(listener)
+    _started['listeners'].remove(listener)
+
+def _start_process():
+    global pool, catalog, audit, series, scheduler, engine, owner
+    import db
+    import timeseries
+
+    # Listeners and services of a parent process, their threads are gone
+    for listener in list(_started['listeners']):
+        _unsubscribe(listener)
+    _started['services'] = []
+
+    pool = db.ConnectionPool(settings['catalog_path'])
+    catalog = db.Catalog(pool)
+    audit = db.AuditLog(pool)
+    series = timeseries.SeriesStore(settings['series_path'])
+
+    if settings['broker']:
+        import broker
+        scheduler = broker.RemoteScheduler(telldus)
+        engine = broker.RemoteRules(telldus)
+        return
+
+    import rules
+    import schedule
+
+    # Come up from the stored device catalog
+    telldus.seed(catalog.devices())
+
+    # Commands sent from this process, events are left to the owner
+    audit.start()
+    _subscribe(audit.command_listener)
+    _started['services'] = [audit]
+
+    scheduler = schedule.ReadOnlyScheduler(
+        telldus,
+        db.Schedules(pool),
+        settings['latitude'],
+        settings['longitude']
+    )
+    engine = rules.ReadOnlyRules(telldus, db.Rules(pool))
+
+    # A lock inherited from the parent is let go of on the first try
+    if owner is None:
+        owner = db.OwnerLock(settings['catalog_path'] + '.lock')
+
+    # Load the library and fill the caches so later requests don't wait for
+    # telldusd
+    if settings['warm_up']:
+        telldus.warm_up()
+
+def _start_owner():
+    global scheduler, engine
+    import db
+    import rules
+    import schedule
+
+    catalog.start_sync(telldus)
+
+    # History of telldusd events too from now on
+    _subscribe(audit.listener)
+    _unsubscribe(audit.command_listener)
 
-# Prepare localization
-gettext.install('messages', settings['i18n_path'], unicode=True)
-gettext.translation(
-    'messages', 
-    settings['i18n_path'], 
-    languages=[
-        settings['locale']
-    ]
-).install(True)
+    # Rollups of sensor readings
+    series.start()
+    _subscribe(series.listener)
+
+    running = schedule.Scheduler(
+        telldus,
+        db.Schedules(pool),
+        settings['latitude'],
+        settings['longitude']
+    )
+    running.start()
+    scheduler = running
+
+    running = rules.RuleEngine(telldus, db.Rules(pool))
+    running.start()
+    _started['listeners'].append(running.listener)
+    engine = running
+
+    _started['services'] += [catalog, series, scheduler, engine]
+
+# Localization and templates are prepared on the first page render, API
+# requests need neither.
+_render = None
+
+def templates():
+    global _render
+    if _render is None:
+        translation = gettext.translation(
+            'messages',
+            settings['i18n_path'],
+            languages=[
+                settings['locale']
+            ]
+        )
+        translation.install(True)
+
+        # Templates are compiled once, pages get their variables as arguments
+        _render = web.template.render(
+            settings['template_path'],
+            base='base',
+            globals = {
+                '_': translation.ugettext,
+            }
+        )
+    return _render
 
 urls = (
     '/', 'Kraft',
     '/device/(off|on|learn|parameter|model|protocol)', 'api.Device',
     '/device', 'api.Device',
+    '/events', 'Events',
+    '/changes', 'Changes',
+    '/history', 'History',
+    '/sensors/([0-9]+)/series', 'SensorSeries',
+    '/devices', 'api.Devices',
+    '/devices/batch', 'api.Batch',
+    '/jobs/([0-9]+)', 'api.Job',
+    '/group/(off|on|members)', 'api.Group',
+    '/group', 'api.Group',
+    '/scene/(members)', 'api.Scene',
+    '/scene', 'api.Scene',
+    '/metrics', 'Metrics',
+    '/schedules', 'Schedules',
+    '/schedules/([0-9]+)', 'Schedule',
+    '/rules', 'Rules',
+    '/rules/([0-9]+)', 'Rule',
+)
+
+# The rendered index page, valid as long as the device catalog version is the
+# same and the page is not older than the metadata cache TTL.
+# Started is part of the ETag since catalog versions restart with the process.
+started = time()
+page_cache = dict(
+    catalog_version = None,
+    rendered = 0,
+    etag = None,
+    body = None
 )
 
 class Kraft:
-    def __init__(self):
-        self._devices = []
-        for device in telldus.Devices():
-            self._devices.append(device)
+    def GET(self):
+        page = page_cache
+        max_age = telldus.metadata_ttl
+
+        if (page['catalog_version'] != telldus.catalog_version or
+                max_age is not None and
+                time() - page['rendered'] > max_age):
+            self.render(page)
+
+        web.modified(
+            date = datetime.utcfromtimestamp(telldus.catalog_changed),
+            etag = page['etag']
+        )
+        return page['body']
+
+    def render(self, page):
+        # Changes after this version are picked up by the page from /events
+        version = telldus.states.version
+
+        devices = [web.storage(device) for device in telldus.snapshot()]
+
+        body = unicode(templates().index(devices, version))
 
+        # Rendering may have filled the metadata cache, which counts as a
+        # catalog change, so the version is taken afterwards.
+        page['catalog_version'] = telldus.catalog_version
+        page['rendered'] = time()
+        page['etag'] = '%x-%d' % (started, telldus.catalog_version)
+        page['body'] = body
+
+# A state table entry as sent to clients, with the device name for devices
+# that still exist.
+def change_entry(entry):
+    change = dict(entry)
+    if not entry['removed']:
+        try:
+            change['name'] = telldus.get_metadata(entry['id'], 'name')
+        except(td.TDError):
+            change['name'] = None
+    return change
+
+# Changes since the version a client has seen, ?since=<version>
+class Changes:
     def GET(self):
-        tpl = web.template.render(
-            settings['template_path'],
-            base='base',
-            globals = {
-                'devices': self._devices,
-                '_': _, # _ is automatically created by gettext.install()
-            }
+        web.header('Content-type', 'application/json')
+
+        query = web.input(since=0)
+        try:
+            since = int(query.since)
+        except(ValueError):
+            raise web.badrequest()
+
+        version = telldus.states.version
+        return json.dumps(dict(
+            version = version,
+            changes = [
+                change_entry(entry) for entry in telldus.states.since(since)
+            ]
+        ))
+
+# Server-Sent Events stream of device state and metadata changes. Clients
+# resume from ?since=<version> or the Last-Event-ID header, otherwise they
+# only get changes made after connecting. Beyond MAX_EVENT_STREAMS clients
+# get 503, those pages don't follow changes.
+event_streams = dict(open=0)
+_event_streams_lock = Lock()
+
+class Events:
+    def GET(self):
+        query = web.input(since=None)
+        since = query.since or web.ctx.env.get('HTTP_LAST_EVENT_ID')
+
+        try:
+            if since is None:
+                since = telldus.states.version
+            since = int(since)
+        except(ValueError):
+            raise web.badrequest()
+
+        with _event_streams_lock:
+            if event_streams['open'] >= MAX_EVENT_STREAMS:
+                raise web.HTTPError(
+                    '503 Service Unavailable',
+                    {'Retry-After': str(EVENTS_RETRY_AFTER)},
+                    'Too many event streams, serve Kraft with asyncserver.py'
+                )
+            event_streams['open'] += 1
+
+        web.header('Content-type', 'text/event-stream')
+        web.header('Cache-Control', 'no-cache')
+        return self.stream(since)
+
+    # web.py takes the first message before it answers, the stream is
+    # counted until it is closed or dropped
+    def stream(self, version):
+        try:
+            yield 'retry: 5000\n\n'
+
+            while True:
+                if telldus.states.wait(version, EVENTS_KEEPALIVE) == version:
+                    yield ': keepalive\n\n'
+                    continue
+
+                for entry in telldus.states.since(version):
+                    yield event_message(entry)
+                    version = max(version, entry['version'])
+        finally:
+            with _event_streams_lock:
+                event_streams['open'] -= 1
+
+# A state table entry as a Server-Sent Events message
+def event_message(entry):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (
+        entry['version'],
+        entry['event'],
+        json.dumps(change_entry(entry))
+    )
+
+# Audit log entries, newest first
+#   ?device=3           only this device
+#   ?from=...&to=...    time range as Unix timestamps
+#   ?limit=100
+class History:
+    def GET(self):
+        web.header('Content-type', 'application/json')
+
+        query = web.input(device=None, limit=100)
+        try:
+            device_id = query.device and int(query.device)
+            start = query.get('from') and float(query.get('from'))
+            end = query.get('to') and float(query.get('to'))
+            limit = min(int(query.limit), 1000)
+        except(ValueError):
+            raise web.badrequest()
+
+        return json.dumps(dict(entries = audit.query(
+            device_id = device_id or None,
+            start = start or None,
+            end = end or None,
+            limit = limit
+        )))
+
+# Steps accepted by /sensors/<id>/series besides plain seconds
+SERIES_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+}
+
+def parse_step(step):
+    if step[-1:] in SERIES_UNITS:
+        return int(step[:-1]) * SERIES_UNITS[step[-1]]
+    return int(step)
+
+# Sensor readings rolled up per step
+#   ?type=temperature|humidity
+#   ?from=...&to=...    time range as Unix timestamps, default the last day
+#   ?step=1h            seconds, or with an s, m, h or d suffix
+class SensorSeries:
+    def GET(self, sensor_id):
+        web.header('Content-type', 'application/json')
+
+        now = time()
+        query = web.input(type='temperature', step='5m')
+
+        data_types = dict((v, k) for k, v in td.SENSOR_TYPES.items())
+        if query.type not in data_types:
+            raise web.badrequest()
+
+        try:
+            start = float(query.get('from') or now - 86400)
+            end = float(query.get('to') or now)
+            step = parse_step(query.step)
+        except(ValueError):
+            raise web.badrequest()
+        # Also turns away NaN
+        if step < 1 or not start < end:
+            raise web.badrequest()
+
+        result = series.query(
+            int(sensor_id),
+            data_types[query.type],
+            start,
+            end,
+            step,
+            now
         )
-        return tpl.index()
+        result.update(id=int(sensor_id), type=query.type)
+        return json.dumps(result)
+
+# Library call and request timings in the Prometheus text format
+class Metrics:
+    def GET(self):
+        if not metrics.enabled:
+            raise web.notfound()
+
+        web.header('Content-type', 'text/plain; version=0.0.4')
+        text = metrics.registry.render()
+
+        # Library calls happen in the broker, its metrics follow ours
+        if settings['broker']:
+            try:
+                text += telldus.metrics()
+            except(td.TDError):
+                pass
+        return text
+
+# Read a JSON object from the request body
+def json_input():
+    try:
+        data = json.loads(web.data())
+    except(ValueError):
+        raise web.badrequest()
+
+    if not isinstance(data, dict):
+        raise web.badrequest()
+    return data
+
+# Schedules and rules can't be changed here, they run in another process or
+# the broker is down
+def unavailable(e):
+    return web.HTTPError(
+        '503 Service Unavailable',
+        {'Content-type': 'application/json'},
+        json.dumps(dict(error=e.errstr))
+    )
+
+# Timed commands, see schedule.validate for the fields of a schedule
+#   GET     all schedules with their next run
+#   POST    a new schedule
+class Schedules:
+    def GET(self):
+        web.header('Content-type', 'application/json')
+        return json.dumps(dict(schedules = scheduler.schedules()))
+
+    def POST(self):
+        web.header('Content-type', 'application/json')
+
+        try:
+            entry = scheduler.add(json_input())
+        except(ValueError), e:
+            raise web.badrequest(json.dumps(dict(error=str(e))))
+        except(td.TDError), e:
+            raise unavailable(e)
+
+        web.ctx.status = '201 Created'
+        web.header('Location', '/schedules/%d' % entry['id'])
+        return json.dumps(entry)
+
+class Schedule:
+    def GET(self, schedule_id):
+        web.header('Content-type', 'application/json')
+
+        entry = scheduler.get(int(schedule_id))
+        if not entry:
+            raise web.notfound()
+        return json.dumps(entry)
+
+    # Change the fields given
+    def PUT(self, schedule_id):
+        web.header('Content-type', 'application/json')
+
+        try:
+            entry = scheduler.update(int(schedule_id), json_input())
+        except(ValueError), e:
+            raise web.badrequest(json.dumps(dict(error=str(e))))
+        except(td.TDError), e:
+            raise unavailable(e)
+
+        if not entry:
+            raise web.notfound()
+        return json.dumps(entry)
+
+    def DELETE(self, schedule_id):
+        try:
+            removed = scheduler.remove(int(schedule_id))
+        except(td.TDError), e:
+            raise unavailable(e)
+
+        if not removed:
+            raise web.notfound()
+        return web.ok()
+
+# Automations, see rules.validate for the fields of a rule
+#   GET     all rules with their state
+#   POST    a new rule
+class Rules:
+    def GET(self):
+        web.header('Content-type', 'application/json')
+        return json.dumps(dict(rules = engine.rules()))
+
+    def POST(self):
+        web.header('Content-type', 'application/json')
+
+        try:
+            rule = engine.add(json_input())
+        except(ValueError), e:
+            raise web.badrequest(json.dumps(dict(error=str(e))))
+        except(td.TDError), e:
+            raise unavailable(e)
+
+        web.ctx.status = '201 Created'
+        web.header('Location', '/rules/%d' % rule['id'])
+        return json.dumps(rule)
+
+class Rule:
+    def GET(self, rule_id):
+        web.header('Content-type', 'application/json')
+
+        rule = engine.get(int(rule_id))
+        if not rule:
+            raise web.notfound()
+        return json.dumps(rule)
+
+    # Change the fields given, the state of the rule starts over
+    def PUT(self, rule_id):
+        web.header('Content-type', 'application/json')
+
+        try:
+            rule = engine.update(int(rule_id), json_input())
+        except(ValueError), e:
+            raise web.badrequest(json.dumps(dict(error=str(e))))
+        except(td.TDError), e:
+            raise unavailable(e)
+
+        if not rule:
+            raise web.notfound()
+        return json.dumps(rule)
+
+    def DELETE(self, rule_id):
+        try:
+            removed = engine.remove(int(rule_id))
+        except(td.TDError), e:
+            raise unavailable(e)
+
+        if not removed:
+            raise web.notfound()
+        return web.ok()
 
 app = web.application(urls, globals())
+app.add_processor(web.loadhook(start))
+if metrics.enabled:
+    app.add_processor(metrics.request_processor)
 
 if __name__ == '__main__':
+    import logging
+    logging.basicConfig()
     app.run()
 
 if __name__.startswith('_mod_wsgi_'):
@@ -0,0 +1,488 @@
+# Kraft load test
+#
+# Drives the whole application with a mix of requests, or with requests
+# replayed from a server log, and reports requests per second and latency
+# percentiles. Unless a URL is given kraft.py runs against
+# fakecore.FakeCore, in-process through its WSGI function or on a local
+# socket through asyncserver.py.
+#
+#   python loadtest.py [--target inprocess|socket|URL] [--devices N]
+#                      [--latency ms] [--concurrency N[,N...]]
+#                      [--requests N] [--rate per second]
+#                      [--mix name:weight,...] [--replay log]
+#                      [--transmit-rate per second]
+#
+# Without a rate every client sends its next request as soon as the last one
+# is answered. With a rate requests arrive on a fixed schedule no matter how
+# far behind the server is, and their latency counts from when they were due,
+# which is what users of a slow server see.
+#
+# Commands wait for the transmitter like they would for the radio, at four
+# a second unless --transmit-rate says otherwise. Raise it to measure the web
+# side on its own.
+#
+# Logs of the web.py server and Common Log Format logs can be replayed, only
+# the method and path of each request are used. Device IDs in the log should
+# exist among the fake devices, set --devices to match.
+
+import os
+import re
+import sys
+import json
+import random
+import shutil
+import argparse
+import httplib
+import tempfile
+from collections import defaultdict
+from math import ceil
+from threading import Thread, Lock, local
+from Queue import Queue
+from StringIO import StringIO
+from urllib import unquote, quote_plus
+from urlparse import urlsplit
+from timeit import default_timer as timer
+from time import time, sleep
+
+# Requests of the default mix, {name} is a random device name
+REQUESTS = {
+    'index': '/',
+    'device': '/device?name={name}',
+    'on': '/device/on?name={name}',
+    'off': '/device/off?name={name}',
+    'devices': '/devices',
+}
+DEFAULT_MIX = 'index:2,device:4,on:2,off:2'
+
+DEFAULT_REQUESTS = 2000
+DEFAULT_CONCURRENCY = '1,4,16'
+DEFAULT_DEVICES = 100
+
+# Throughput lower than at the previous concurrency by this fraction is
+# reported as a scaling cliff
+CLIFF_THRESHOLD = 0.1
+
+# Streams never finish, they are left out of replays
+STREAMING_PATHS = ('/events',)
+
+# Request line of web.py server logs, "HTTP/1.1 GET /path", and of Common Log
+# Format, "GET /path HTTP/1.1"
+_LOG_REQUEST = re.compile(
+    r'"(?:HTTP/[0-9.]+ )?([A-Z]+) (/[^ "]*)(?: HTTP/[0-9.]+)?"'
+)
+
+PERCENTILES = (50, 95, 99)
+
+## Clients, request() returns the HTTP status or raises
+
+# Calls the WSGI function in this process, no sockets or HTTP parsing
+class InProcessClient(object):
+    def __init__(self, application):
+        import asyncserver
+
+        self.application = application
+        self._run_wsgi = asyncserver.run_wsgi
+
+    def request(self, method, path):
+        path, _, query = path.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_LENGTH': '0',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(''),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        status, headers, body = self._run_wsgi(self.application, environ)
+        return int(status.split(' ', 1)[0])
+
+# One keep-alive connection per client thread
+class HTTPClient(object):
+    def __init__(self, host, port, timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._local = local()
+
+    def request(self, method, path):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+            self._local.conn = conn
+
+        try:
+            conn.request(method, path)
+            response = conn.getresponse()
+            response.read()
+        except(Exception):
+            conn.close()
+            self._local.conn = None
+            raise
+
+        if response.getheader('connection', '').lower() == 'close':
+            conn.close()
+            self._local.conn = None
+        return response.status
+
+# Start kraft.py against a fake telldus-core in a scratch directory. Returns
+# the scratch directory, which is removed after the run.
+def fake_kraft(devices, latency, transmit_rate=None):
+    import td
+    import fakecore
+    from settings import config
+
+    scratch = tempfile.mkdtemp(prefix='kraft-loadtest-')
+    config['catalog_path'] = os.path.join(scratch, 'kraft.db')
+    config['series_path'] = os.path.join(scratch, 'series')
+    td.default_library = fakecore.FakeCore(devices=devices, latency=latency)
+
+    # api.py shares the instance created here
+    if transmit_rate:
+        td.shared(events=True, transmit_rate=transmit_rate)
+    return scratch
+
+def make_client(target, workers):
+    if target == 'inprocess':
+        import kraft
+        return InProcessClient(kraft.app.wsgifunc())
+
+    if target == 'socket':
+        import kraft
+        import asyncserver
+
+        server = asyncserver.HTTPServer(kraft.app.wsgifunc(),
+                                        ('127.0.0.1', 0), workers)
+        thread = Thread(target=server.serve_forever, name='loadtest-server')
+        thread.daemon = True
+        thread.start()
+        return HTTPClient('127.0.0.1', server.server_port)
+
+    url = urlsplit(target)
+    if url.scheme != 'http' or not url.hostname:
+        raise ValueError('Target must be inprocess, socket or an http URL')
+    return HTTPClient(url.hostname, url.port or 80)
+
+## Requests
+
+# Device names for the mix, from the target itself
+def device_names():
+    import kraft
+
+    names = [device['name'] for device in kraft.telldus.snapshot()]
+    return [name for name in names if name]
+
+def remote_device_names(url):
+    url = urlsplit(url)
+    conn = httplib.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    conn.request('GET', '/devices?fields=name&limit=1000')
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+
+    if response.status != 200:
+        raise ValueError('No device list from %s: %d' % (
+            url.geturl(), response.status
+        ))
+    return [device['name'] for device in json.loads(data)['devices']
+            if device['name']]
+
+# Parse a mix like "index:2,on:1" into a list of (name, weight)
+def parse_mix(spec):
+    mix = []
+    for part in spec.split(','):
+        name, _, weight = part.partition(':')
+        if name not in REQUESTS:
+            raise ValueError('Unknown request "%s", one of %s' % (
+                name, ', '.join(sorted(REQUESTS))
+            ))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+# count requests as (kind, method, path) picked by weight from the mix
+def generate(mix, names, count, seed=0):
+    rand = random.Random(seed)
+    total = sum(weight for name, weight in mix)
+    if not names:
+        names = ['']
+
+    requests = []
+    for i in xrange(count):
+        pick = rand.random() * total
+        for name, weight in mix:
+            pick -= weight
+            if pick < 0:
+                break
+
+        device_name = rand.choice(names)
+        if isinstance(device_name, unicode):
+            device_name = device_name.encode('utf-8')
+        path = REQUESTS[name].replace('{name}', quote_plus(device_name))
+        requests.append((name, 'GET', path))
+    return requests
+
+# Requests of a server log as (kind, method, path), the kind is the path
+# without the query with numbers replaced like /metrics does.
+def load_log(f):
+    requests = []
+    for line in f:
+        match = _LOG_REQUEST.search(line)
+        if not match:
+            continue
+
+        method, path = match.groups()
+        route = path.split('?', 1)[0]
+        if route in STREAMING_PATHS:
+            continue
+
+        kind = '/'.join(
+            part.isdigit() and ':id' or part for part in route.split('/')
+        )
+        requests.append((kind, method, path))
+    return requests
+
+## Running
+
+def percentile(latencies, p):
+    if not latencies:
+        return None
+    rank = int(ceil(p / 100.0 * len(latencies))) - 1
+    return latencies[min(max(rank, 0), len(latencies) - 1)]
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    summary = dict(count = len(latencies))
+    if latencies:
+        for p in PERCENTILES:
+            summary['p%d' % p] = percentile(latencies, p) * 1e3
+        summary['max'] = latencies[-1] * 1e3
+    return summary
+
+# Send the requests from concurrency client threads. With a rate they are
+# due at fixed intervals and wait in a queue for a free client. Returns the
+# results of the run as a dict.
+def run(client, requests, concurrency, rate=None):
+    latencies = defaultdict(list)
+    statuses = defaultdict(int)
+    errors = []
+    lock = Lock()
+    queue = Queue()
+
+    def worker():
+        local_latencies = defaultdict(list)
+        local_statuses = defaultdict(int)
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+
+            due, kind, method, path = item
+            start = due or timer()
+            try:
+                status = client.request(method, path)
+            except(Exception), e:
+                with lock:
+                    errors.append('%s %s: %s' % (method, path, e))
+                continue
+
+            local_latencies[kind].append(timer() - start)
+            local_statuses[status] += 1
+
+        with lock:
+            for kind, values in local_latencies.items():
+                latencies[kind].extend(values)
+            for status, count in local_statuses.items():
+                statuses[status] += count
+
+    threads = [Thread(target=worker) for i in xrange(concurrency)]
+    started = timer()
+    for thread in threads:
+        thread.start()
+
+    for i, (kind, method, path) in enumerate(requests):
+        due = None
+        if rate:
+            due = started + i / rate
+            delay = due - timer()
+            if delay > 0:
+                sleep(delay)
+        queue.put((due, kind, method, path))
+
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = timer() - started
+
+    everything = []
+    for values in latencies.values():
+        everything.extend(values)
+
+    return dict(
+        concurrency = concurrency,
+        rate = rate,
+        requests = len(requests),
+        seconds = elapsed,
+        rps = len(everything) / elapsed,
+        statuses = dict((str(k), v) for k, v in statuses.items()),
+        errors = len(errors) + sum(
+            count for status, count in statuses.items() if status >= 500
+        ),
+        failures = errors[:10],
+        latency = summarize(everything),
+        kinds = dict(
+            (kind, summarize(values)) for kind, values in latencies.items()
+        )
+    )
+
+def _latency_line(name, summary):
+    if not summary['count']:
+        return '  %-16s %8d requests' % (name, 0)
+    return '  %-16s %8d requests %s ms' % (
+        name,
+        summary['count'],
+        '  '.join('p%d %8.2f' % (p, summary['p%d' % p]) for p in PERCENTILES)
+        + '  max %8.2f' % summary['max']
+    )
+
+def report(result):
+    print 'concurrency %d%s: %d requests in %.2f s, %.1f req/s, %d errors' % (
+        result['concurrency'],
+        result['rate'] and ', %.1f req/s offered' % result['rate'] or '',
+        result['requests'],
+        result['seconds'],
+        result['rps'],
+        result['errors']
+    )
+    print '  statuses %s' % ', '.join(
+        '%s: %d' % item for item in sorted(result['statuses'].items())
+    )
+    print _latency_line('all', result['latency'])
+    for kind, summary in sorted(result['kinds'].items()):
+        print _latency_line(kind, summary)
+    for failure in result['failures']:
+        print '  failed %s' % failure
+    print
+
+# Throughput and tail latency over the concurrency levels
+def report_scaling(results):
+    print '%12s %10s %10s' % ('concurrency', 'req/s', 'p99 ms')
+
+    previous = None
+    for result in results:
+        line = '%12d %10.1f %10.2f' % (
+            result['concurrency'],
+            result['rps'],
+            result['latency'].get('p99') or 0
+        )
+        if (previous and result['rps'] <
+                previous['rps'] * (1 - CLIFF_THRESHOLD)):
+            line += ' CLIFF'
+        print line
+        previous = result
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Load test kraft.py with a request mix or a server log'
+    )
+    parser.add_argument('--target', default='inprocess',
+                        help='inprocess, socket or the URL of a server')
+    parser.add_argument('--devices', type=int, default=DEFAULT_DEVICES,
+                        help='fake devices, not used with a URL')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='ms per fake library call')
+    parser.add_argument('--transmit-rate', type=float, default=None,
+                        help='fake commands sent per second')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='asyncserver workers with the socket target')
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY,
+                        help='clients, several separated by commas')
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS,
+                        help='requests per concurrency level')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='requests per second, default as fast as '
+                             'answered')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='requests and weights, from %s' % ', '.join(
+                            sorted(REQUESTS)))
+    parser.add_argument('--replay', default=None,
+                        help='server log to replay instead of the mix')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='append results as JSON lines to this file')
+    options = parser.parse_args(args)
+
+    try:
+        levels = [int(level) for level in options.concurrency.split(',')]
+        mix = parse_mix(options.mix)
+    except(ValueError), e:
+        parser.error(str(e))
+
+    local_target = options.target in ('inprocess', 'socket')
+    scratch = None
+    if local_target:
+        scratch = fake_kraft(options.devices, options.latency / 1e3,
+                             options.transmit_rate)
+
+    try:
+        client = make_client(options.target, options.workers)
+
+        if options.replay:
+            with open(options.replay) as f:
+                requests = load_log(f)
+            if not requests:
+                parser.error('No requests in %s' % options.replay)
+        else:
+            if local_target:
+                names = device_names()
+            else:
+                names = remote_device_names(options.target)
+            requests = generate(mix, names, options.requests, options.seed)
+
+        # One untimed pass over a few requests to load the library and fill
+        # the caches
+        for kind, method, path in requests[:10]:
+            try:
+                client.request(method, path)
+            except(Exception):
+                pass
+
+        results = []
+        for concurrency in levels:
+            result = run(client, requests, concurrency, options.rate)
+            report(result)
+            results.append(result)
+
+        if len(results) > 1:
+            report_scaling(results)
+    finally:
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    if options.output:
+        with open(options.output, 'a') as f:
+            for result in results:
+                result = dict(
+                    result,
+                    time = int(time()),
+                    target = options.target,
+                    devices = local_target and options.devices or None,
+                    latency_ms = options.latency,
+                    replay = options.replay
+                )
+                f.write(json.dumps(result, sort_keys=True) + '\n')
+
+    return sum(result['errors'] for result in results) and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,192 @@
+# Kraft metrics
+#
+# Latency histograms and error counts for calls into libtelldus-core and for
+# web requests, served in the Prometheus text format at /metrics.
+#
+# Instrumentation is decided when a td.Telldus is created, with enabled off
+# the library symbols are used as they are and nothing is recorded.
+
+from bisect import bisect_left
+from threading import Lock
+from timeit import default_timer as timer
+
+# Set from the metrics setting before any td.Telldus is created
+enabled = True
+
+# Upper bounds of histogram buckets in seconds. RF commands take a good part
+# of a second, metadata reads should be well under a millisecond.
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+# Path label of requests no route matches
+OTHER_PATH = 'other'
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # One more than buckets, for values above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    # Cumulative (upper bound, count) pairs, ending with +Inf
+    def cumulative(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+
+        pairs = []
+        running = 0
+        for bound, n in zip(self.buckets, counts):
+            running += n
+            pairs.append(('%g' % bound, running))
+        pairs.append(('+Inf', count))
+        return pairs, total, count
+
+class Registry(object):
+    def __init__(self):
+        # name => (type, help text)
+        self._families = {}
+        # name => {label tuple: Histogram or counter value}
+        self._series = {}
+        self._lock = Lock()
+
+    def _family(self, name, kind, text):
+        if name not in self._families:
+            with self._lock:
+                if name not in self._families:
+                    self._series[name] = {}
+                    self._families[name] = (kind, text)
+        return self._series[name]
+
+    # The histogram for one set of labels, given as (name, value) pairs
+    def histogram(self, name, text, labels=()):
+        series = self._family(name, 'histogram', text)
+        histogram = series.get(labels)
+        if histogram is None:
+            with self._lock:
+                histogram = series.setdefault(labels, Histogram())
+        return histogram
+
+    def inc(self, name, text, labels=(), value=1):
+        series = self._family(name, 'counter', text)
+        with self._lock:
+            series[labels] = series.get(labels, 0) + value
+
+    def render(self):
+        lines = []
+        for name in sorted(self._families):
+            kind, text = self._families[name]
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            for labels, value in sorted(self._series[name].items()):
+                if kind == 'counter':
+                    lines.append('%s%s %d' % (name, format_labels(labels),
+                                               value))
+                    continue
+
+                pairs, total, count = value.cumulative()
+                for bound, n in pairs:
+                    lines.append('%s_bucket%s %d' % (
+                        name, format_labels(labels + (('le', bound),)), n
+                    ))
+                lines.append('%s_sum%s %.6f' % (name, format_labels(labels),
+                                                total))
+                lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                                count))
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append('%s="%s"' % (key, value.replace('\n', '\\n')))
+    return '{%s}' % ','.join(pairs)
+
+# Shared by every td.Telldus and the web application
+registry = Registry()
+
+# Wrap a typed library function, the function is kept as func of the
+# wrapper. Integer results below TELLSTICK_SUCCESS are error codes and
+# counted as such, the call count is the _count of the histogram.
+def instrument(symbol, func, registry=registry):
+    histogram = registry.histogram(
+        'kraft_ffi_call_seconds',
+        'Time spent in libtelldus-core calls.',
+        (('symbol', symbol),)
+    )
+
+    def call(*args):
+        start = timer()
+        result = func(*args)
+        histogram.observe(timer() - start)
+
+        if type(result) is int and result < 0:
+            registry.inc(
+                'kraft_ffi_errors_total',
+                'libtelldus-core calls returning an error code.',
+                (('symbol', symbol), ('code', result))
+            )
+        return result
+
+    call.__name__ = symbol
+    call.func = func
+    return call
+
+# The URL pattern of the route matching path, so that requests are labelled
+# by a fixed set of paths
+def route(app, path):
+    import web
+
+    for pattern, what in app.mapping:
+        if web.utils.re_compile(r'^%s\Z' % pattern).match(path):
+            return pattern
+    return OTHER_PATH
+
+# web.py processor timing every request by method, route and status. web is
+# imported here so that td.py and the tools using it don't need web.py.
+def request_processor(handler):
+    import web
+
+    start = timer()
+    status = None
+    try:
+        return handler()
+    except(web.HTTPError):
+        raise
+    except:
+        # Turned into an internal error by web.py further up
+        status = '500'
+        raise
+    finally:
+        path = OTHER_PATH
+        if web.ctx.get('app_stack'):
+            path = route(web.ctx.app_stack[-1], web.ctx.path)
+        status = status or web.ctx.status.split(' ', 1)[0]
+
+        registry.histogram(
+            'kraft_http_request_seconds',
+            'Time spent handling web requests.',
+            (('method', web.ctx.method), ('path', path))
+        ).observe(timer() - start)
+        registry.inc(
+            'kraft_http_requests_total',
+            'Web requests by response status.',
+            (('method', web.ctx.method), ('path', path), ('status', status))
+        )
@@ -0,0 +1,291 @@
+# Kraft device provisioning
+#
+# Import and export of the device list as a JSON or CSV manifest. An import
+# is compared with the devices telldusd already has and only the differences
+# are applied, every field set is a call to telldusd which rewrites its
+# config file.
+#
+#   python provision.py export [manifest.json|manifest.csv]
+#   python provision.py import manifest.json [--dry-run] [--remove]
+#
+# A manifest entry has name, protocol, model, house and unit, and optionally
+# the id of the device to update and a parameters object of other device
+# parameters. In CSV, columns besides those are parameters. Entries without an
+# id are matched to devices by name.
+
+import os
+import sys
+import csv
+import json
+
+import td
+
+# Manifest columns, in the order they are set on a device. Models depend on
+# the protocol and the name is set last so a device shows up complete.
+FIELDS = ('protocol', 'model', 'house', 'unit', 'name')
+EXPORT_FIELDS = ('id', 'name', 'protocol', 'model', 'house', 'unit')
+
+class ProvisionError(td.TDError):
+    def __init__(self, errstr):
+        self.errstr = errstr
+
+    def __str__(self):
+        return repr(self.errstr)
+
+# The C-API wants UTF-8 encoded str
+def _value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _format(path, format=None):
+    if format:
+        return format
+    if path and path.lower().endswith('.csv'):
+        return 'csv'
+    return 'json'
+
+def _entry(raw):
+    entry = dict(parameters={})
+    for key, value in raw.items():
+        key = _value(key)
+        if key == 'id':
+            entry['id'] = value and int(value) or None
+        elif key == 'parameters':
+            for param, param_value in (value or {}).items():
+                entry['parameters'][_value(param)] = _value(param_value)
+        elif key in FIELDS:
+            entry[key] = _value(value)
+        elif value not in (None, ''):
+            entry['parameters'][key] = _value(value)
+    return entry
+
+# Read a manifest, a JSON list of entries or an object with a devices list,
+# or CSV with a header row. Returns a list of entry dicts.
+def load_manifest(f, format='json'):
+    if format == 'csv':
+        rows = list(csv.DictReader(f))
+    else:
+        rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = rows.get('devices', [])
+
+    entries = []
+    for i, row in enumerate(rows):
+        try:
+            entries.append(_entry(row))
+        except(AttributeError, ValueError, TypeError), e:
+            raise ProvisionError('Manifest entry %d: %s' % (i + 1, e))
+    return entries
+
+def export_manifest(telldus, f, format='json'):
+    devices = []
+    for device in telldus.snapshot():
+        devices.append(dict(
+            (field, device.get(field)) for field in EXPORT_FIELDS
+        ))
+
+    if format == 'csv':
+        writer = csv.DictWriter(f, EXPORT_FIELDS)
+        writer.writerow(dict(zip(EXPORT_FIELDS, EXPORT_FIELDS)))
+        for device in devices:
+            writer.writerow(dict(
+                (field, _value(device[field])) for field in EXPORT_FIELDS
+            ))
+    else:
+        json.dump(dict(devices=devices), f, indent=2, sort_keys=True)
+        f.write('\n')
+    return len(devices)
+
+# Compare a manifest with the devices of telldus. Returns a list of actions,
+# ('add', None, fields), ('update', device id, changed fields) and with remove
+# ('remove', device id, None) for devices missing from the manifest. Fields
+# are a dict of FIELDS and a parameters dict.
+def plan(telldus, entries, remove=False):
+    # Compare with what telldusd has now, not what we cached
+    telldus.refresh_metadata()
+    current = dict((device['id'], device) for device in telldus.snapshot())
+
+    names = {}
+    for device_id, device in current.items():
+        names.setdefault(td.normalize_name(device['name']), []).append(
+            device_id
+        )
+
+    actions = []
+    seen = set()
+    for i, entry in enumerate(entries):
+        device_id = entry.get('id')
+        if device_id is None and entry.get('name'):
+            ids = names.get(td.normalize_name(entry['name']), [])
+            if len(ids) > 1:
+                raise ProvisionError(
+                    'Manifest entry %d: name "%s" matches devices %s' % (
+                        i + 1, entry['name'], ids
+                    )
+                )
+            device_id = ids and ids[0] or None
+
+        if device_id is not None and device_id in seen:
+            raise ProvisionError(
+                'Manifest entry %d: device %d is listed twice' % (
+                    i + 1, device_id
+                )
+            )
+
+        if device_id is None or device_id not in current:
+            fields = dict(
+                (field, entry[field]) for field in FIELDS if entry.get(field)
+            )
+            fields['parameters'] = dict(entry['parameters'])
+            actions.append(('add', None, fields))
+            continue
+
+        seen.add(device_id)
+        device = current[device_id]
+
+        changes = {}
+        for field in FIELDS:
+            if field in entry and entry[field] != _value(device.get(field)):
+                changes[field] = entry[field]
+
+        parameters = {}
+        for param, value in entry['parameters'].items():
+            if telldus._get_device_parameter(device_id, param, '') != value:
+                parameters[param] = value
+
+        if changes or parameters:
+            changes['parameters'] = parameters
+            actions.append(('update', device_id, changes))
+
+    if remove:
+        for device_id in sorted(set(current) - seen):
+            actions.append(('remove', device_id, None))
+    return actions
+
+def _set_fields(telldus, device, fields):
+    for field in FIELDS:
+        if field not in fields:
+            continue
+
+        if field in ('house', 'unit'):
+            ok = device.set_parameter(field, fields[field])
+        elif field == 'name':
+            ok = telldus._set_name(device.id, fields[field])
+        elif field == 'model':
+            ok = telldus._set_model(device.id, fields[field])
+        else:
+            ok = telldus._set_protocol(device.id, fields[field])
+
+        if not ok:
+            raise td.TDDeviceError(
+                'Could not set %s of device %d' % (field, device.id)
+            )
+
+    for param, value in sorted(fields.get('parameters', {}).items()):
+        if not device.set_parameter(param, value):
+            raise td.TDDeviceError(
+                'Could not set parameter %s of device %d' % (param, device.id)
+            )
+
+# Carry out actions from plan(). progress is called with the number of
+# actions done, the total and the action after each one. Returns the IDs
+# added, updated and removed and a list of errors, a failed action doesn't
+# stop the rest.
+def apply(telldus, actions, progress=None):
+    result = dict(added=[], updated=[], removed=[], errors=[])
+
+    for done, action in enumerate(actions):
+        kind, device_id, fields = action
+        try:
+            if kind == 'add':
+                device_id = telldus._add_device()
+                if device_id < 1:
+                    raise td.TDDeviceError('Failed to create new device')
+                telldus.recount_devices()
+
+                _set_fields(telldus, telldus.get_device(device_id), fields)
+                result['added'].append(device_id)
+            elif kind == 'update':
+                _set_fields(telldus, telldus.get_device(device_id), fields)
+                result['updated'].append(device_id)
+            elif kind == 'remove':
+                telldus.get_device(device_id).remove()
+                result['removed'].append(device_id)
+        except(td.TDError, ValueError), e:
+            result['errors'].append(dict(
+                action = kind,
+                id = device_id,
+                error = getattr(e, 'errstr', str(e))
+            ))
+
+        if progress is not None:
+            progress(done + 1, len(actions), action)
+
+    return result
+
+def describe(action):
+    kind, device_id, fields = action
+    if kind == 'remove':
+        return 'remove %d' % device_id
+
+    changes = dict(fields)
+    changes.update(changes.pop('parameters', {}))
+    text = ', '.join('%s=%s' % item for item in sorted(changes.items()))
+    if kind == 'add':
+        return 'add %s' % text
+    return 'update %d %s' % (device_id, text)
+
+def _print_progress(done, total, action):
+    print '[%d/%d] %s' % (done, total, describe(action))
+
+def main(args):
+    if not args or args[0] not in ('import', 'export'):
+        print 'Usage: %s export [manifest]' % sys.argv[0]
+        print '       %s import manifest [--dry-run] [--remove]' % (
+            sys.argv[0]
+        )
+        return 1
+
+    telldus = td.Telldus()
+    paths = [arg for arg in args[1:] if not arg.startswith('--')]
+    path = paths and paths[0] or None
+
+    if args[0] == 'export':
+        if path:
+            with open(path, 'wb') as f:
+                count = export_manifest(telldus, f, _format(path))
+            print 'Exported %d devices to %s' % (count, path)
+        else:
+            export_manifest(telldus, sys.stdout)
+        return 0
+
+    if not path or not os.path.exists(path):
+        print 'No manifest %s' % path
+        return 1
+
+    with open(path, 'rb') as f:
+        entries = load_manifest(f, _format(path))
+    actions = plan(telldus, entries, '--remove' in args)
+
+    if '--dry-run' in args:
+        for action in actions:
+            print describe(action)
+        print '%d changes' % len(actions)
+        return 0
+
+    result = apply(telldus, actions, _print_progress)
+    print '%d added, %d updated, %d removed, %d failed' % (
+        len(result['added']),
+        len(result['updated']),
+        len(result['removed']),
+        len(result['errors'])
+    )
+    for error in result['errors']:
+        print 'Failed to %(action)s %(id)s: %(error)s' % error
+    return result['errors'] and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
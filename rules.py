@@ -0,0 +1,384 @@
+# Kraft rules
+#
+# Automations run on telldusd events, like "below 18 degrees in the bedroom,
+# turn on the heater" or "when the remote sends on, run the evening scene".
+# Rules are stored with db.Rules and indexed by the sensor or device they
+# watch, so an event only evaluates the rules that depend on it.
+#
+# A rule has a trigger under when, actions under then and optionally else:
+#
+#   {"when": {"sensor": 135, "type": "temperature", "below": 18,
+#             "hysteresis": 0.5},
+#    "then": [{"device": 4, "command": "on"}],
+#    "else": [{"device": 4, "command": "off"}]}
+#
+#   {"when": {"device": 7, "state": "on"}, "then": [{"scene": 12}]}
+#
+# Sensor triggers fire then when the value crosses the threshold and else
+# once it is back past the threshold by more than the hysteresis. Device
+# triggers fire then on every matching event. Either way a rule fires at most
+# once per debounce seconds, which keeps RF repeats from causing storms.
+
+import logging
+from threading import Thread, Lock
+from Queue import Queue, Full
+from time import time
+
+import db
+import td
+
+# Default seconds between two firings of a rule
+DEFAULT_DEBOUNCE = 10
+
+# Default margin a sensor value must move back past the threshold by
+DEFAULT_HYSTERESIS = 0.5
+
+# States a device trigger can wait for
+TRIGGER_STATES = ('on', 'off')
+
+# Fired rules waiting for their actions to be queued, more are dropped
+MAX_PENDING = 1000
+
+log = logging.getLogger(__name__)
+
+def _actions(actions):
+    if isinstance(actions, dict):
+        actions = [actions]
+    if not isinstance(actions, list):
+        raise ValueError('Actions must be a list')
+
+    checked = []
+    for action in actions:
+        if 'scene' in action:
+            checked.append(dict(scene=int(action['scene'])))
+            continue
+
+        command = str(action.get('command', 'on'))
+        if command not in ('on', 'off'):
+            raise ValueError('Unknown command "%s"' % command)
+
+        if 'group' in action:
+            checked.append(dict(group=int(action['group']), command=command))
+        elif 'device' in action:
+            checked.append(dict(device=int(action['device']),
+                                command=command))
+        else:
+            raise ValueError('Actions need a device, group or scene')
+    return checked
+
+# Check and normalize a rule from a client, raises ValueError
+def validate(rule):
+    data_types = dict((v, k) for k, v in td.SENSOR_TYPES.items())
+
+    try:
+        when = rule['when']
+        checked = {
+            'name': rule.get('name') or '',
+            'enabled': bool(rule.get('enabled', True)),
+            'debounce': float(rule.get('debounce', DEFAULT_DEBOUNCE)),
+            'then': _actions(rule['then']),
+            'else': _actions(rule.get('else', [])),
+        }
+
+        if 'sensor' in when:
+            if ('below' in when) == ('above' in when):
+                raise ValueError('Sensor triggers need below or above')
+            data_type = str(when.get('type', 'temperature'))
+            if data_type not in data_types:
+                raise ValueError('Unknown sensor type "%s"' % data_type)
+
+            trigger = dict(
+                sensor = int(when['sensor']),
+                type = data_type,
+                hysteresis = float(when.get('hysteresis',
+                                            DEFAULT_HYSTERESIS))
+            )
+            if 'below' in when:
+                trigger['below'] = float(when['below'])
+            else:
+                trigger['above'] = float(when['above'])
+        elif 'device' in when:
+            trigger = dict(device=int(when['device']))
+            if when.get('state') is not None:
+                trigger['state'] = str(when['state'])
+                if trigger['state'] not in TRIGGER_STATES:
+                    raise ValueError('Unknown state "%s"' % trigger['state'])
+            if checked['else']:
+                raise ValueError('Device triggers have no else')
+        else:
+            raise ValueError('Triggers need a sensor or a device')
+    except(KeyError, TypeError, AttributeError, UnicodeError), e:
+        raise ValueError('Invalid rule: %s' % e)
+
+    if checked['debounce'] < 0:
+        raise ValueError('debounce must not be negative')
+    if trigger.get('hysteresis', 0) < 0:
+        raise ValueError('hysteresis must not be negative')
+
+    checked['when'] = trigger
+    return checked
+
+# The input a trigger depends on, key of the rule index
+def _input(trigger):
+    if 'sensor' in trigger:
+        data_types = dict((v, k) for k, v in td.SENSOR_TYPES.items())
+        return ('sensor', trigger['sensor'], data_types[trigger['type']])
+    return ('device', trigger['device'])
+
+# A rule with its runtime state. Active is whether the sensor condition holds,
+# None until the first reading.
+class Rule(object):
+    __slots__ = ('id', 'definition', 'active', 'fired', 'suppressed')
+
+    def __init__(self, rule_id, definition):
+        self.id = rule_id
+        self.definition = definition
+        self.active = None
+        self.fired = None
+        self.suppressed = 0
+
+    # The actions to run for a sensor value, or None
+    def evaluate_sensor(self, value):
+        trigger = self.definition['when']
+        if 'below' in trigger:
+            holds = value < trigger['below']
+            clears = value > trigger['below'] + trigger['hysteresis']
+        else:
+            holds = value > trigger['above']
+            clears = value < trigger['above'] - trigger['hysteresis']
+
+        if holds and self.active is not True:
+            return self._transition(True, self.definition['then'])
+        if clears and self.active is not False:
+            # Nothing to undo on the first reading
+            if self.active is None:
+                self.active = False
+                return None
+            return self._transition(False, self.definition['else'])
+        return None
+
+    def evaluate_device(self, state):
+        wanted = self.definition['when'].get('state')
+        if wanted is not None and state != wanted:
+            return None
+        return self._transition(None, self.definition['then'])
+
+    # Take a new state unless the rule fired within its debounce time, then
+    # the state stays and the next event tries again.
+    def _transition(self, active, actions):
+        now = time()
+        if (self.fired is not None and
+                now - self.fired < self.definition['debounce']):
+            self.suppressed += 1
+            return None
+
+        self.active = active
+        if not actions:
+            return None
+        self.fired = now
+        return actions
+
+    def as_dict(self):
+        rule = dict(self.definition)
+        rule.update(
+            id = self.id,
+            active = self.active,
+            fired = self.fired,
+            suppressed = self.suppressed
+        )
+        return rule
+
+# Evaluates rules on events of a td.Telldus, see Telldus.subscribe. Events
+# arrive in the telldus-core callback thread, which must not call the C-API,
+# so the listener only evaluates rules and a thread of the engine runs the
+# actions.
+class RuleEngine(object):
+    def __init__(self, telldus, store):
+        self.telldus = telldus
+        self.store = store
+
+        # Rule ID => Rule, and input key => set of rule IDs
+        self._rules = {}
+        self._index = {}
+        self._lock = Lock()
+        self._thread = None
+
+        # (rule ID, actions) of fired rules, and how many were dropped
+        self._pending = Queue(MAX_PENDING)
+        self.dropped = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            for rule_id, definition in self.store.all():
+                try:
+                    self._add(Rule(rule_id, validate(definition)))
+                except(ValueError):
+                    continue
+
+        self._thread = Thread(target=self._run, name='rules')
+        self._thread.daemon = True
+        self._thread.start()
+        self.telldus.subscribe(self.listener)
+
+    # Stop evaluating events and end the thread once the actions already
+    # queued have run, waiting up to timeout seconds for it
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+
+        self.telldus.unsubscribe(self.listener)
+        self._pending.put((None, None))
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            rule_id, actions = self._pending.get()
+            if rule_id is None:
+                return
+            try:
+                self.run(rule_id, actions)
+            except(Exception):
+                log.exception('Actions of rule %d failed', rule_id)
+
+    def _add(self, rule):
+        self._rules[rule.id] = rule
+        if rule.definition['enabled']:
+            key = _input(rule.definition['when'])
+            self._index.setdefault(key, set()).add(rule.id)
+
+    def _remove(self, rule_id):
+        rule = self._rules.pop(rule_id, None)
+        if rule is None:
+            return None
+
+        key = _input(rule.definition['when'])
+        ids = self._index.get(key)
+        if ids is not None:
+            ids.discard(rule_id)
+            if not ids:
+                del self._index[key]
+        return rule
+
+    def listener(self, event, device_id, entry):
+        if event == 'sensor':
+            key = ('sensor', device_id, entry['data_type'])
+        elif event == 'state':
+            key = ('device', device_id)
+        else:
+            return
+
+        with self._lock:
+            for rule_id in self._index.get(key, ()):
+                rule = self._rules[rule_id]
+                if event == 'sensor':
+                    actions = rule.evaluate_sensor(entry['value'])
+                else:
+                    actions = rule.evaluate_device(entry['state'])
+
+                if actions:
+                    try:
+                        self._pending.put_nowait((rule.id, actions))
+                    except(Full):
+                        self.dropped += 1
+
+    # Queue the actions of a rule on the transmitter, devices as one job
+    def run(self, rule_id, actions):
+        source = 'rule:%d' % rule_id
+
+        plan = []
+        for action in actions:
+            if 'scene' in action:
+                self.telldus.run_scene(action['scene'],
+                                       td.PRIORITY_SCHEDULED, source)
+            elif 'group' in action:
+                self.telldus.run_group(action['group'], action['command'],
+                                       td.PRIORITY_SCHEDULED, source)
+            else:
+                plan.append((action['device'], action['command']))
+
+        if plan:
+            self.telldus.submit(plan, td.PRIORITY_SCHEDULED, source)
+
+    ## Managing rules, handed out as dicts with their runtime state
+
+    def rules(self):
+        with self._lock:
+            rules = sorted(self._rules.values(), key=lambda rule: rule.id)
+            return [rule.as_dict() for rule in rules]
+
+    def get(self, rule_id):
+        with self._lock:
+            rule = self._rules.get(rule_id)
+            return rule and rule.as_dict()
+
+    # Store a new rule from client input, raises ValueError
+    def add(self, definition):
+        definition = validate(definition)
+        rule = Rule(self.store.add(definition), definition)
+
+        with self._lock:
+            self._add(rule)
+            return rule.as_dict()
+
+    # Replace a rule, its state starts over. Returns None for unknown IDs.
+    def update(self, rule_id, definition):
+        with self._lock:
+            current = self._rules.get(rule_id)
+        if current is None:
+            return None
+
+        fields = current.as_dict()
+        fields.update(definition)
+        definition = validate(fields)
+        self.store.update(rule_id, definition)
+
+        with self._lock:
+            self._remove(rule_id)
+            rule = Rule(rule_id, definition)
+            self._add(rule)
+            return rule.as_dict()
+
+    def remove(self, rule_id):
+        if not self.store.remove(rule_id):
+            return False
+
+        with self._lock:
+            self._remove(rule_id)
+        return True
+
+# Stands in for the RuleEngine of another process, see db.OwnerLock. Lists
+# the stored rules without their state and refuses changes.
+class ReadOnlyRules(RuleEngine):
+    def start(self):
+        pass
+
+    def _stored(self):
+        stored = []
+        for rule_id, definition in self.store.all():
+            try:
+                stored.append(Rule(rule_id, validate(definition)))
+            except(ValueError):
+                continue
+        return stored
+
+    def rules(self):
+        rules = sorted(self._stored(), key=lambda rule: rule.id)
+        return [rule.as_dict() for rule in rules]
+
+    def get(self, rule_id):
+        for rule in self._stored():
+            if rule.id == rule_id:
+                return rule.as_dict()
+        return None
+
+    def add(self, definition):
+        raise db.ReadOnlyError('Rules are run by another process')
+
+    def update(self, rule_id, definition):
+        raise db.ReadOnlyError('Rules are run by another process')
+
+    def remove(self, rule_id):
+        raise db.ReadOnlyError('Rules are run by another process')
@@ -0,0 +1,357 @@
+# Kraft scheduler
+#
+# Timed on/off commands, stored with db.Schedules. Upcoming runs are kept in
+# a heap so the scheduler thread only ever looks at the next one, and all
+# schedules falling due together go out as one transmit job.
+#
+# A schedule runs at a local time of day or at sunrise or sunset, moved by an
+# offset in minutes, on some days of the week. A run missed while Kraft was
+# down is made up for once at start if it is no older than catch_up seconds.
+
+import re
+import heapq
+import logging
+import calendar
+from datetime import date, timedelta
+from itertools import count
+from math import sin, cos, tan, asin, acos, atan, floor, radians, degrees
+from threading import Thread, Condition
+from time import time, localtime, mktime
+
+import db
+import td
+
+# Longest sleep between checking the heap, so that clock changes are noticed
+MAX_SLEEP = 60
+
+# Default seconds a missed run may be late and still be made up for
+DEFAULT_CATCH_UP = 900
+
+# Source of scheduled commands in the audit log
+SOURCE = 'schedule'
+
+# Commands a schedule can send
+COMMANDS = ('on', 'off')
+
+SUN_EVENTS = ('sunrise', 'sunset')
+_TIME_OF_DAY = re.compile(r'^([01]?[0-9]|2[0-3]):([0-5][0-9])$')
+
+# Sun below the horizon at sunrise and sunset, with refraction
+_ZENITH = 90.833
+
+log = logging.getLogger(__name__)
+
+# Sunrise or sunset on a day as a Unix timestamp, None when the sun doesn't
+# rise or set that day. The sunrise equation from the Almanac for Computers,
+# good to a couple of minutes.
+def sun_time(day, latitude, longitude, rising=True):
+    lng_hour = longitude / 15.0
+    t = day.timetuple().tm_yday + ((6 if rising else 18) - lng_hour) / 24.0
+
+    # Mean anomaly and true longitude of the sun
+    m = 0.9856 * t - 3.289
+    l = (m + 1.916 * sin(radians(m)) + 0.020 * sin(radians(2 * m)) +
+         282.634) % 360
+
+    # Right ascension in hours, in the same quadrant as l
+    ra = degrees(atan(0.91764 * tan(radians(l)))) % 360
+    ra = (ra + floor(l / 90) * 90 - floor(ra / 90) * 90) / 15.0
+
+    sin_dec = 0.39782 * sin(radians(l))
+    cos_dec = cos(asin(sin_dec))
+    cos_h = ((cos(radians(_ZENITH)) - sin_dec * sin(radians(latitude))) /
+             (cos_dec * cos(radians(latitude))))
+    if not -1 <= cos_h <= 1:
+        return None
+
+    h = degrees(acos(cos_h))
+    if rising:
+        h = 360 - h
+
+    ut = h / 15.0 + ra - 0.06571 * t - 6.622 - lng_hour
+
+    # Keep the hour within half a day of solar noon of the same day
+    noon = 12 - lng_hour
+    ut = (ut - (noon - 12)) % 24 + (noon - 12)
+
+    return calendar.timegm(day.timetuple()) + ut * 3600
+
+# Check and normalize a schedule entry from a client, raises ValueError
+def validate(entry, latitude=None, longitude=None):
+    try:
+        checked = dict(
+            device_id = int(entry['device_id']),
+            command = str(entry.get('command', 'on')),
+            time = str(entry['time']),
+            offset = int(entry.get('offset', 0)),
+            days = sorted(set(int(day) for day in entry.get(
+                'days', range(7)
+            ))),
+            enabled = bool(entry.get('enabled', True)),
+            catch_up = int(entry.get('catch_up', DEFAULT_CATCH_UP))
+        )
+    except(KeyError, TypeError, UnicodeError), e:
+        raise ValueError('Invalid schedule: %s' % e)
+
+    if checked['command'] not in COMMANDS:
+        raise ValueError('Unknown command "%s"' % checked['command'])
+    if (checked['time'] not in SUN_EVENTS and
+            not _TIME_OF_DAY.match(checked['time'])):
+        raise ValueError('Time must be HH:MM, sunrise or sunset')
+    if checked['time'] in SUN_EVENTS and latitude is None:
+        raise ValueError('No location set for sunrise and sunset')
+    if not checked['days'] or not set(checked['days']) <= set(range(7)):
+        raise ValueError('Days must be weekdays 0-6, Monday being 0')
+    if checked['catch_up'] < 0:
+        raise ValueError('catch_up must not be negative')
+    return checked
+
+# Runs stored schedules through a Telldus transmitter
+class Scheduler(object):
+    def __init__(self, telldus, store, latitude=None, longitude=None):
+        self.telldus = telldus
+        self.store = store
+        self.latitude = latitude
+        self.longitude = longitude
+
+        # Schedule ID => entry, and the heap of upcoming runs as (timestamp,
+        # sequence, schedule ID, entry). Entries replaced or removed are left
+        # in the heap and skipped when they come up.
+        self._schedules = {}
+        self._heap = []
+        self._sequence = count()
+        self._condition = Condition()
+        self._thread = None
+        self._stopped = False
+
+    # First run of entry after the timestamp after, None if there is none
+    # within a year.
+    def next_run(self, entry, after):
+        day = date(*localtime(after)[:3])
+
+        for i in xrange(367):
+            if day.weekday() in entry['days']:
+                when = self._run_time(entry, day)
+                if when is not None and when > after:
+                    return when
+            day += timedelta(days=1)
+        return None
+
+    # Last run of entry at or before the timestamp before, None if there is
+    # none within a year. Starts a day ahead for offsets crossing midnight.
+    def previous_run(self, entry, before):
+        day = date(*localtime(before)[:3]) + timedelta(days=1)
+
+        for i in xrange(368):
+            if day.weekday() in entry['days']:
+                when = self._run_time(entry, day)
+                if when is not None and when <= before:
+                    return when
+            day -= timedelta(days=1)
+        return None
+
+    def _run_time(self, entry, day):
+        if entry['time'] in SUN_EVENTS:
+            when = sun_time(
+                day,
+                self.latitude,
+                self.longitude,
+                entry['time'] == 'sunrise'
+            )
+            if when is None:
+                return None
+        else:
+            hour, minute = entry['time'].split(':')
+            when = mktime((day.year, day.month, day.day, int(hour),
+                           int(minute), 0, 0, 0, -1))
+        return when + entry['offset'] * 60
+
+    def _push(self, entry, after):
+        if not entry['enabled']:
+            return
+
+        when = self.next_run(entry, after)
+        if when is not None:
+            heapq.heappush(
+                self._heap,
+                (when, next(self._sequence), entry['id'], entry)
+            )
+
+    # Load the stored schedules and start the scheduler thread. The latest
+    # run missed is due right away if it is within its catch up window, one
+    # run however long Kraft was down.
+    def start(self):
+        if self._thread is not None:
+            return
+
+        now = time()
+        with self._condition:
+            for entry in self.store.all():
+                self._schedules[entry['id']] = entry
+                if not entry['enabled'] or entry['last_run'] is None:
+                    self._push(entry, now)
+                    continue
+
+                missed = self.previous_run(entry, now)
+                if (missed is not None and missed > entry['last_run'] and
+                        now - missed <= entry['catch_up']):
+                    heapq.heappush(
+                        self._heap,
+                        (missed, next(self._sequence), entry['id'], entry)
+                    )
+                else:
+                    self._push(entry, now)
+
+        self._thread = Thread(target=self._run, name='scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            due = self._wait_due()
+            if due is None:
+                return
+            try:
+                self._fire(due)
+            except(Exception):
+                log.exception('Running schedules %s failed',
+                              ', '.join(str(entry['id']) for entry in due))
+
+    # End the scheduler thread, waiting up to timeout seconds for it
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join(timeout)
+
+    # Block until runs are due and return their entries, after queueing their
+    # next runs. Returns None once stopped.
+    def _wait_due(self):
+        with self._condition:
+            while True:
+                if self._stopped:
+                    return None
+
+                # Skip runs of replaced and removed schedules
+                while self._heap and (
+                        self._schedules.get(self._heap[0][2]) is not
+                        self._heap[0][3]):
+                    heapq.heappop(self._heap)
+
+                now = time()
+                if self._heap and self._heap[0][0] <= now:
+                    break
+
+                timeout = MAX_SLEEP
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now)
+                self._condition.wait(timeout)
+
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                when, seq, schedule_id, entry = heapq.heappop(self._heap)
+                if self._schedules.get(schedule_id) is entry:
+                    due.append(entry)
+                    self._push(entry, max(now, when))
+            return due
+
+    # Send the commands of all due schedules as one transmit job
+    def _fire(self, due):
+        if not due:
+            return
+
+        now = time()
+        plan = [(entry['device_id'], entry['command']) for entry in due]
+        self.telldus.submit(plan, td.PRIORITY_SCHEDULED, SOURCE)
+
+        for entry in due:
+            entry['last_run'] = now
+        self.store.set_last_run([entry['id'] for entry in due], now)
+
+    ## Managing schedules, entries are handed out as copies with next_run
+
+    def _public(self, entry):
+        entry = dict(entry, days=list(entry['days']))
+        entry['next_run'] = None
+        if entry['enabled']:
+            entry['next_run'] = self.next_run(entry, time())
+        return entry
+
+    def schedules(self):
+        with self._condition:
+            entries = sorted(self._schedules.values(),
+                             key=lambda entry: entry['id'])
+        return [self._public(entry) for entry in entries]
+
+    def get(self, schedule_id):
+        entry = self._schedules.get(schedule_id)
+        return entry and self._public(entry)
+
+    # Store a new schedule from client input, raises ValueError
+    def add(self, entry):
+        entry = validate(entry, self.latitude, self.longitude)
+
+        # Runs are only made up for from now on
+        entry['last_run'] = time()
+        entry['id'] = self.store.add(entry)
+
+        with self._condition:
+            self._schedules[entry['id']] = entry
+            self._push(entry, time())
+            self._condition.notify()
+        return self._public(entry)
+
+    # Change fields of a schedule, returns None for unknown IDs
+    def update(self, schedule_id, fields):
+        current = self._schedules.get(schedule_id)
+        if current is None:
+            return None
+
+        entry = validate(dict(current, **fields), self.latitude,
+                         self.longitude)
+        entry['id'] = schedule_id
+        entry['last_run'] = current['last_run']
+        self.store.update(entry)
+
+        with self._condition:
+            self._schedules[schedule_id] = entry
+            self._push(entry, time())
+            self._condition.notify()
+        return self._public(entry)
+
+    def remove(self, schedule_id):
+        if not self.store.remove(schedule_id):
+            return False
+
+        with self._condition:
+            self._schedules.pop(schedule_id, None)
+            self._condition.notify()
+        return True
+
+# Stands in for the Scheduler of another process, see db.OwnerLock. Lists the
+# stored schedules and refuses changes.
+class ReadOnlyScheduler(Scheduler):
+    def start(self):
+        pass
+
+    def schedules(self):
+        entries = sorted(self.store.all(), key=lambda entry: entry['id'])
+        return [self._public(entry) for entry in entries]
+
+    def get(self, schedule_id):
+        for entry in self.store.all():
+            if entry['id'] == schedule_id:
+                return self._public(entry)
+        return None
+
+    def add(self, entry):
+        raise db.ReadOnlyError('Schedules are run by another process')
+
+    def update(self, schedule_id, fields):
+        raise db.ReadOnlyError('Schedules are run by another process')
+
+    def remove(self, schedule_id):
+        raise db.ReadOnlyError('Schedules are run by another process')
@@ -6,7 +6,19 @@ config = {
     'template_path': 'templates',
     'static_path': 'static',
     'i18n_path': 'i18n',
+    'catalog_path': 'kraft.db',
+    'series_path': 'series',
     'locale': 'sv_SE',
+    'metrics': True,
+    # Load telldus-core and fill its caches in the background on the first
+    # request of each process
+    'warm_up': True,
+    # Talk to broker.py over broker_path instead of loading telldus-core
+    'broker': False,
+    'broker_path': 'kraft-broker.sock',
+    # Where sunrise and sunset schedules are run, in decimal degrees
+    'latitude': None,
+    'longitude': None,
 }
 
 # Try to avoid editing anything below this line, unless you're a nerd. 
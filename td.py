@@ -5,19 +5,51 @@
 # This was made for the Kraft web interface so the plan is to let this library
 # grow organically with features added as I need/gain access to more devices
 # and sensors.
-# On the wishlist are sensors for humidity and temperature.
+# Sensors for humidity and temperature are read through Telldus.Sensors and
+# sensor events.
 
 ## Changelog
 # 2013-03-29
 #   Starting with regular selflearning on/off switches
 
+import os
+import logging
 from platform import system as OS
-from ctypes import c_int, c_char_p, c_void_p, CDLL
+from time import time, sleep
+from collections import OrderedDict, deque
+from itertools import count
+from threading import Thread, Condition, Event, Lock
+import heapq
+from array import array
+from unicodedata import normalize
+from ctypes import c_bool, c_int, c_char_p, c_void_p, CDLL, CFUNCTYPE
+from ctypes import POINTER, byref, create_string_buffer
+
+import metrics
 
 # Default library locations
 _DEFAULT_LIBRARY_MACOS = '/Library/Frameworks/TelldusCore.framework/TelldusCore'
 _DEFAULT_LIBRARY_LINUX = 'libtelldus-core.so.2'
 
+# Library used when Telldus() is not given one, overrides the defaults above.
+# Either a path or an already loaded library such as fakecore.FakeCore.
+default_library = None
+
+# One Telldus instance per process, see shared()
+_shared = None
+_shared_lock = Lock()
+
+log = logging.getLogger(__name__)
+
+# The Telldus instance shared by all modules of the process, created by the
+# first call with its arguments. The library is only loaded on first use.
+def shared(**kw):
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Telldus(**kw)
+    return _shared
+
 ## Defining pre-proc macros from the telldus-core lib
 TELLSTICK_SUCCESS = 0
 
@@ -31,43 +63,340 @@ TYPE_DEVICE = 1
 TYPE_GROUP = 2
 TYPE_SCENE = 3
 
+# Sensor data types
+TELLSTICK_TEMPERATURE = 1
+TELLSTICK_HUMIDITY = 2
+
+# Device change events
+TELLSTICK_DEVICE_ADDED = 1
+TELLSTICK_DEVICE_CHANGED = 2
+TELLSTICK_DEVICE_REMOVED = 3
+
+# Change types of TELLSTICK_DEVICE_CHANGED
+TELLSTICK_CHANGE_NAME = 1
+TELLSTICK_CHANGE_PROTOCOL = 2
+TELLSTICK_CHANGE_MODEL = 3
+TELLSTICK_CHANGE_METHOD = 4
+
+# Callback types
+# void (int deviceId, int method, const char *data, int callbackId, void *ctx)
+DEVICE_EVENT = CFUNCTYPE(None, c_int, c_int, c_char_p, c_int, c_void_p)
+# void (int deviceId, int changeEvent, int changeType, int callbackId,
+#       void *ctx)
+DEVICE_CHANGE_EVENT = CFUNCTYPE(None, c_int, c_int, c_int, c_int, c_void_p)
+# void (const char *protocol, const char *model, int id, int dataType,
+#       const char *value, int timestamp, int callbackId, void *ctx)
+SENSOR_EVENT = CFUNCTYPE(
+    None,
+    c_char_p, c_char_p, c_int, c_int, c_char_p, c_int, c_int, c_void_p
+)
+# void (const char *data, int controllerId, int callbackId, void *ctx)
+RAW_DEVICE_EVENT = CFUNCTYPE(None, c_char_p, c_int, c_int, c_void_p)
+
+# Signatures of the libtelldus-core symbols we use as (restype, argtypes).
+# Functions returning char* are typed as void* so the pointer can be handed
+# back to tdReleaseString, see Telldus._owned_string.
+_SIGNATURES = {
+    'tdInit': (None, []),
+    'tdReleaseString': (None, [c_void_p]),
+    'tdAddDevice': (c_int, []),
+    'tdRemoveDevice': (c_bool, [c_int]),
+    'tdGetNumberOfDevices': (c_int, []),
+    'tdGetDeviceId': (c_int, [c_int]),
+    'tdGetName': (c_void_p, [c_int]),
+    'tdSetName': (c_bool, [c_int, c_char_p]),
+    'tdGetDeviceParameter': (c_void_p, [c_int, c_char_p, c_char_p]),
+    'tdSetDeviceParameter': (c_bool, [c_int, c_char_p, c_char_p]),
+    'tdGetProtocol': (c_void_p, [c_int]),
+    'tdSetProtocol': (c_bool, [c_int, c_char_p]),
+    'tdGetModel': (c_void_p, [c_int]),
+    'tdSetModel': (c_bool, [c_int, c_char_p]),
+    'tdGetDeviceType': (c_int, [c_int]),
+    'tdMethods': (c_int, [c_int, c_int]),
+    'tdTurnOn': (c_int, [c_int]),
+    'tdTurnOff': (c_int, [c_int]),
+    'tdLearn': (c_int, [c_int]),
+    'tdLastSentCommand': (c_int, [c_int, c_int]),
+    'tdRegisterDeviceEvent': (c_int, [DEVICE_EVENT, c_void_p]),
+    'tdRegisterDeviceChangeEvent': (c_int, [DEVICE_CHANGE_EVENT, c_void_p]),
+    'tdUnregisterCallback': (c_int, [c_int]),
+    'tdSensor': (c_int, [
+        c_char_p, c_int, c_char_p, c_int, POINTER(c_int), POINTER(c_int)
+    ]),
+    'tdSensorValue': (c_int, [
+        c_char_p, c_char_p, c_int, c_int, c_char_p, c_int, POINTER(c_int)
+    ]),
+    'tdRegisterSensorEvent': (c_int, [SENSOR_EVENT, c_void_p]),
+    'tdRegisterRawDeviceEvent': (c_int, [RAW_DEVICE_EVENT, c_void_p]),
+}
+
+# Commands accepted by Telldus.execute_batch
+COMMANDS = ('on', 'off', 'learn')
+
+# Names of device types, see Device.type_name
+TYPE_NAMES = {
+    TYPE_DEVICE: 'Device',
+    TYPE_GROUP: 'Group',
+    TYPE_SCENE: 'Scene',
+}
+
+# Scene member actions as written in the "devices" parameter of a scene,
+# mapped to COMMANDS.
+_SCENE_ACTIONS = {
+    'on': 'on',
+    'turnon': 'on',
+    str(METHOD_TURNON): 'on',
+    'off': 'off',
+    'turnoff': 'off',
+    str(METHOD_TURNOFF): 'off',
+    'learn': 'learn',
+    str(METHOD_LEARN): 'learn',
+}
+
+# Device states by the method last sent to a device
+STATES = {
+    METHOD_TURNON: 'on',
+    METHOD_TURNOFF: 'off',
+}
+
+# Names of sensor data types
+SENSOR_TYPES = {
+    TELLSTICK_TEMPERATURE: 'temperature',
+    TELLSTICK_HUMIDITY: 'humidity',
+}
+
+# Readings kept per sensor and data type
+_DEFAULT_SENSOR_HISTORY = 1024
+
+# Sensors repeat every reading over RF, the same value within this many
+# seconds is taken as a repeat.
+_SENSOR_REPEAT_WINDOW = 5
+
+# Every RF frame is sent several times, raw events with the same data from
+# the same controller within this many seconds are taken as repeats.
+_RAW_REPEAT_WINDOW = 1.0
+
+# Raw events kept for consumers
+_DEFAULT_RAW_EVENTS = 1000
+
+# Size of the string buffers handed to tdSensor and tdSensorValue
+_SENSOR_BUFFER = 20
+
+# Transmit priorities, lower numbers are sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SCHEDULED = 1
+PRIORITY_BULK = 2
+
+# Transmitter token bucket, commands per second and the size of bursts
+_DEFAULT_TRANSMIT_RATE = 4.0
+_DEFAULT_TRANSMIT_BURST = 4
+
+# Number of finished transmit jobs kept around for polling
+_FINISHED_JOBS = 1000
+
+# Device metadata kept in the Telldus metadata cache, house and unit are
+# device parameters.
+METADATA_FIELDS = ('name', 'model', 'protocol', 'house', 'unit')
+_METADATA_PARAMETERS = ('house', 'unit')
+
+# Seconds before cached metadata is fetched again, None never expires.
+_DEFAULT_METADATA_TTL = 300
+
 # Class constructor, for handling input validation before calling lower
 # layered C-API wrappers.
 class Telldus(object):
-    # Class initialiser, load the shared object and its symbols, do some
-    # pre-processing.
-    def __init__(self, *kw):
+    # Class initialiser. The shared object is loaded on first use of the
+    # C-API, see _load, so creating an instance costs next to nothing.
+    def __init__(self, **kw):
         # Support to pass custom library name/path to class
-        if kw:
-            library = kw.get('library', _DEFAULT_LIBRARY_LINUX)
+        if kw.get('library'):
+            library = kw.get('library')
+        elif default_library is not None:
+            library = default_library
         else: # Load some defaults based on system
             if OS() == 'Darwin':
                 library = _DEFAULT_LIBRARY_MACOS
             else: # Default fallback is always Linux
                 library = _DEFAULT_LIBRARY_LINUX
+        self.library = library
 
-        # Load telldus-core library. Also makes C interface available to
-        # higher level.
-        self.tdso = CDLL(library)
+        # Time library calls for /metrics, see metrics.instrument
+        self._instrument = kw.get('instrument', metrics.enabled)
 
-        # Initiate library
-        self._init_telldus()
-        self.number_of_devices = self._get_number_of_devices()
+        # For some reason it crashes everytime it tries to free memory on Mac,
+        # so I hope I can just skip that step because it's not working.
+        self._release_strings = OS() != 'Darwin'
+
+        self._events = bool(kw.get('events'))
+        self._load_lock = Lock()
+        self._warm_up_pid = None
+
+        # Internal registry of devices, device id => Device
+        self.devices = DeviceRegistry()
+
+        # Metadata cache, device id => (fetched timestamp, metadata dict)
+        self.metadata_ttl = kw.get('metadata_ttl', _DEFAULT_METADATA_TTL)
+        self._metadata = {}
+
+        # Bumped whenever devices are added, removed or their metadata
+        # changes, for caching anything built from the device list.
+        self.catalog_version = 0
+        self.catalog_changed = time()
+
+        # Last snapshot, ((catalog version, state version), taken, devices)
+        self._snapshot = None
+
+        # Name index, kept up to date by the metadata cache. Built on first
+        # lookup.
+        self.index = DeviceIndex()
+        self._index_built = False
+
+        # Guards the metadata cache, the name index and _stale, which request
+        # threads, the callback thread, catalog sync and warm-up all share.
+        # Never held during C-API calls. Bulk refreshes are built aside and
+        # swapped in, one at a time.
+        self._metadata_lock = Lock()
+        self._refresh_lock = Lock()
+        self._refreshes = 0
+
+        # Transmit scheduler, started on first use
+        self._transmit_rate = kw.get('transmit_rate', _DEFAULT_TRANSMIT_RATE)
+        self._transmit_burst = kw.get(
+            'transmit_burst',
+            _DEFAULT_TRANSMIT_BURST
+        )
+        self._transmitter = None
+        self._transmitter_pid = None
+
+        # Expanded members of groups and scenes, device id => list of
+        # (member id, command)
+        self._members = {}
+
+        # Device states, fed by telldusd events when they are registered
+        self.states = DeviceStates()
+        self._listeners = []
+        self._callbacks = []
+        self._callback_ids = []
+
+        # Raw RF events, repeats dropped
+        self.raw_events = RawEvents(
+            kw.get('raw_events', _DEFAULT_RAW_EVENTS)
+        )
+
+        # Sensors, (protocol, model, id) => Sensor
+        self.sensors = {}
+        self.sensor_history = kw.get(
+            'sensor_history',
+            _DEFAULT_SENSOR_HISTORY
+        )
+
+        # IDs of devices changed by other clients, their metadata is fetched
+        # again before the next name lookup.
+        self._stale = set()
+
+    # tdso and number_of_devices are only set once the library is loaded
+    def __getattr__(self, name):
+        if name in ('tdso', 'number_of_devices'):
+            self._load()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    # Load telldus-core library, also makes C interface available to higher
+    # level. Anything but a path is taken as loaded already. Other threads
+    # only see tdso once it is typed and initiated.
+    def _load(self):
+        with self._load_lock:
+            if 'tdso' in self.__dict__:
+                return
+
+            if isinstance(self.library, basestring):
+                tdso = CDLL(self.library)
+            else:
+                tdso = self.library
+            self._bind_library(tdso)
+
+            # Initiate library
+            tdso.tdInit()
+            self.tdso = tdso
+            self.number_of_devices = self._get_number_of_devices()
 
-        # Internal list of devices
-        self.devices = []
+            if self._events:
+                self.register_events()
+
+    @property
+    def loaded(self):
+        return 'tdso' in self.__dict__
+
+    # Load the library and fill the caches in a background thread, once per
+    # process since threads don't survive a fork.
+    def warm_up(self):
+        pid = os.getpid()
+        if self._warm_up_pid == pid:
+            return
+        self._warm_up_pid = pid
+
+        thread = Thread(target=self._warm_up, name='telldus-warm-up')
+        thread.daemon = True
+        thread.start()
+
+    def _warm_up(self):
+        try:
+            self.snapshot()
+        except(TDError):
+            pass
 
     ## Wrappers for functions in libtelldus-core, for handling type conversions 
     # and freeing up memory. These should stay as true to the C API as possible
     # while converting values to Python objects.
-    def _init_telldus(self):
-        return self.tdso.tdInit()
+
+    # Type every symbol in _SIGNATURES once, the typed function pointers are
+    # kept by CDLL so the wrappers below can call them directly. With
+    # instrumentation the library gets a timing wrapper in place of each
+    # symbol, otherwise the ctypes functions are called as they are.
+    def _bind_library(self, tdso):
+        for symbol, (restype, argtypes) in _SIGNATURES.items():
+            # A library shared with another instance may be wrapped already
+            func = getattr(tdso, symbol)
+            func = getattr(func, 'func', func)
+            func.restype = restype
+            func.argtypes = argtypes
+
+            if self._instrument:
+                func = metrics.instrument(symbol, func)
+            setattr(tdso, symbol, func)
+
+    # Call a symbol returning a char* owned by us, copy it to a Python str and
+    # free it in the C library.
+    def _owned_string(self, func, *args):
+        string_p = func(*args)
+
+        # Convert void* to char* and copy char* from C library to local
+        # Python str.
+        value = c_char_p(string_p).value
+
+        if string_p is not None and self._release_strings:
+            self.tdso.tdReleaseString(string_p)
+
+        return value
 
     def _add_device(self):
-        return self.tdso.tdAddDevice()
+        dev_id = self.tdso.tdAddDevice()
+        if dev_id > 0:
+            self._catalog_change()
+            with self._metadata_lock:
+                if self._index_built:
+                    self.index.add(dev_id, '')
+        return dev_id
 
     def _remove_device(self, device_id):
-        return self.tdso.tdRemoveDevice(device_id)
+        res = self.tdso.tdRemoveDevice(device_id)
+        if res:
+            self._catalog_change()
+            self.invalidate_metadata(device_id)
+            self.invalidate_members()
+            with self._metadata_lock:
+                self.index.remove(device_id)
+        return res
 
     def _get_number_of_devices(self):
         return self.tdso.tdGetNumberOfDevices()
@@ -77,99 +406,61 @@ class Telldus(object):
         return self.tdso.tdGetDeviceId(device_index)
 
     def _get_name(self, device_id):
-        # Because tdGetName returns a char* we first receive a void*
-        get_name_func = self.tdso.tdGetName
-        get_name_func.restype = c_void_p
-
-        name_p = get_name_func(device_id)
-
-        # Convert void* to char* and copy char* from C library to local
-        # Python str.
-        name = c_char_p(name_p).value
-
-        # Free void* from memory of C library
-        # For some reason it crashes everytime it tries to free memory on Mac,
-        # so I hope I can just skip that step because it's not working.
-        if OS() != 'Darwin':
-            self.tdso.tdReleaseString(name_p)
-            name_p = None
-
-        # Return the copied Python str
-        return name
+        return self._owned_string(self.tdso.tdGetName, device_id)
 
     def _set_name(self, device_id, device_name):
-        set_name_func = self.tdso.tdSetName
-        set_name_func.argtypes = [c_int, c_char_p]
-
-        return set_name_func(device_id, device_name)
+        res = self.tdso.tdSetName(device_id, device_name)
+        if res:
+            self._update_metadata(device_id, 'name', device_name)
+        return res
 
     # Gets parameters from device
     def _get_device_parameter(self, device_id, param_key='', default_value=''):
-        get_parameter_func = self.tdso.tdGetDeviceParameter
-        get_parameter_func.restype = c_void_p
-        get_parameter_func.argtypes = [c_int, c_char_p, c_char_p]
-
-        param_p = get_parameter_func(device_id, param_key, default_value)
-        param = c_char_p(param_p).value
-
-        if OS() != 'Darwin':
-            self.tdso.tdReleaseString(param_p)
-            param_p = None
-
-        return param
+        return self._owned_string(
+            self.tdso.tdGetDeviceParameter,
+            device_id,
+            param_key,
+            default_value
+        )
 
     # Sets the various parameters (see Device.house property)
     def _set_device_parameter(self, device_id, param_key='', param_value=''):
-        set_parameter_func = self.tdso.tdSetDeviceParameter
-
         # Both parameter and parm_value need to be strings, if an integer is 
         # passed to parm_value it results in a segfault. NOT GOOD!
-        return set_parameter_func(device_id, str(param_key), str(param_value))
+        res = self.tdso.tdSetDeviceParameter(
+            device_id,
+            str(param_key),
+            str(param_value)
+        )
+        if res and param_key in _METADATA_PARAMETERS:
+            self._update_metadata(device_id, param_key, str(param_value))
+        if res and param_key == 'devices':
+            self.invalidate_members()
+        return res
 
-    # Largely same concept as _get_name
     def _get_protocol(self, device_id):
-        get_protocol_func = self.tdso.tdGetProtocol
-        get_protocol_func.restype = c_void_p
-
-        protocol_p = get_protocol_func(device_id)
-        protocol = c_char_p(protocol_p).value
-
-        if OS() != 'Darwin':
-            self.tdso.tdReleaseString(protocol_p)
-            protocol_p = None
-
-        return protocol
+        return self._owned_string(self.tdso.tdGetProtocol, device_id)
 
     def _set_protocol(self, device_id, protocol):
-        set_protocol_func = self.tdso.tdSetProtocol
-        set_protocol_func.restype = c_void_p
-        set_protocol_func.argtypes = [c_int, c_char_p]
-
-        return set_protocol_func(device_id, protocol)
+        res = self.tdso.tdSetProtocol(device_id, protocol)
+        if res:
+            self._update_metadata(device_id, 'protocol', protocol)
+        return res
 
     def _get_device_type(self, device_id):
         return self.tdso.tdGetDeviceType(device_id)
 
     def _get_model(self, device_id):
-        get_model_func = self.tdso.tdGetModel
-        get_model_func.restype = c_void_p
-
-        model_p = get_model_func(device_id)
-        model = c_char_p(model_p).value
-
-        if OS() != 'Darwin':
-            self.tdso.tdReleaseString(model_p)
-            model_p = None
-
-        return model
+        return self._owned_string(self.tdso.tdGetModel, device_id)
 
     def _set_model(self, device_id, model_name=''):
         if not len(model_name):
             raise ValueError('"model_name" cannot be empty string')
-        set_model_func = self.tdso.tdSetModel
-        set_model_func.argtypes = [c_int, c_char_p]
 
-        return set_model_func(device_id, str(model_name))
+        res = self.tdso.tdSetModel(device_id, str(model_name))
+        if res:
+            self._update_metadata(device_id, 'model', str(model_name))
+        return res
 
     def _methods(self, device_id, methods):
         return self.tdso.tdMethods(device_id, methods)
@@ -186,6 +477,61 @@ class Telldus(object):
     def _last_sent_command(self, device_id, methods):
         return self.tdso.tdLastSentCommand(device_id, methods)
 
+    # The callback must be a DEVICE_EVENT and kept referenced for as long as
+    # it is registered.
+    def _register_device_event(self, callback):
+        return self.tdso.tdRegisterDeviceEvent(callback, None)
+
+    def _register_device_change_event(self, callback):
+        return self.tdso.tdRegisterDeviceChangeEvent(callback, None)
+
+    def _unregister_callback(self, callback_id):
+        return self.tdso.tdUnregisterCallback(callback_id)
+
+    def _register_sensor_event(self, callback):
+        return self.tdso.tdRegisterSensorEvent(callback, None)
+
+    def _register_raw_device_event(self, callback):
+        return self.tdso.tdRegisterRawDeviceEvent(callback, None)
+
+    # Returns (protocol, model, id, data types) of the next sensor, or None
+    # when all sensors have been listed.
+    def _sensor(self):
+        protocol = create_string_buffer(_SENSOR_BUFFER)
+        model = create_string_buffer(_SENSOR_BUFFER)
+        sensor_id = c_int()
+        data_types = c_int()
+
+        res = self.tdso.tdSensor(
+            protocol,
+            _SENSOR_BUFFER,
+            model,
+            _SENSOR_BUFFER,
+            byref(sensor_id),
+            byref(data_types)
+        )
+        if res != TELLSTICK_SUCCESS:
+            return None
+        return (protocol.value, model.value, sensor_id.value, data_types.value)
+
+    # Returns (value, timestamp) of the last reading, or None
+    def _sensor_value(self, protocol, model, sensor_id, data_type):
+        value = create_string_buffer(_SENSOR_BUFFER)
+        timestamp = c_int()
+
+        res = self.tdso.tdSensorValue(
+            protocol,
+            model,
+            sensor_id,
+            data_type,
+            value,
+            _SENSOR_BUFFER,
+            byref(timestamp)
+        )
+        if res != TELLSTICK_SUCCESS:
+            return None
+        return (value.value, timestamp.value)
+
     ## End of wrapper functions for libtelldus-core
 
     ## "Public" methods here, for use by higher levels. These should
@@ -205,49 +551,644 @@ class Telldus(object):
     def recount_devices(self):
         self.number_of_devices = self._get_number_of_devices()
 
-    # Generator to iterate through all devices. This returns a class instance
-    # of Device, which contains more Device-specific methods.
-    def Devices(self):
-        # Re-count devices in internal counter
-        self.recount_devices()
+    ## Metadata cache. Reading name, model, protocol, house and unit through
+    # here costs no C-API calls as long as the cached entry is fresh. The
+    # setter wrappers above write through to the cache.
+
+    # Read all metadata of a device from telldusd in one go, without touching
+    # the cache.
+    def _read_metadata(self, device_id):
+        metadata = {
+            'name': self._get_name(device_id),
+            'model': self._get_model(device_id),
+            'protocol': self._get_protocol(device_id),
+        }
+        for param_key in _METADATA_PARAMETERS:
+            metadata[param_key] = self._get_device_parameter(
+                device_id,
+                param_key,
+                ''
+            )
+        return metadata
+
+    # Fetch all metadata of a device and cache it
+    def _fetch_metadata(self, device_id):
+        metadata = self._read_metadata(device_id)
+
+        with self._metadata_lock:
+            cached = self._metadata.get(device_id)
+            if cached is None or cached[1] != metadata:
+                self._catalog_change()
+
+            self._metadata[device_id] = (time(), metadata)
+            self.index.add(device_id, metadata['name'])
+        return metadata
+
+    # Only updates devices that are already cached, others will be fetched
+    # in full on their next read anyway.
+    def _update_metadata(self, device_id, field, value):
+        with self._metadata_lock:
+            self._catalog_change()
+
+            cached = self._metadata.get(device_id)
+            if cached is not None:
+                cached[1][field] = value
+
+            if field == 'name':
+                self.index.add(device_id, value)
+
+    def _catalog_change(self):
+        self.catalog_version += 1
+        self.catalog_changed = time()
+
+    def _metadata_expired(self, fetched):
+        if self.metadata_ttl is None:
+            return False
+        return time() - fetched > self.metadata_ttl
 
-        device = None
-        current = 0
-        high = self.number_of_devices
+    # Returns a copy of all cached metadata for a device, or the value of a
+    # single field.
+    def get_metadata(self, device_id, field=None):
+        if field is not None and field not in METADATA_FIELDS:
+            raise ValueError('Unknown metadata field "%s"' % field)
 
-        # Loop every device index
-        while current != high:
-            if self.number_of_devices < 1:
-                # No devices, need to add some.
-                raise StopIteration
+        cached = self._metadata.get(device_id)
+        if cached is None or self._metadata_expired(cached[0]):
+            metadata = self._fetch_metadata(device_id)
+        else:
+            metadata = cached[1]
+
+        if field is None:
+            return dict(metadata)
+        return metadata[field]
+
+    # Re-fetch metadata for one device, or for every device in bulk. Bulk
+    # refresh also drops entries of devices that no longer exist. The new
+    # cache and index replace the old ones when complete, so lookups meanwhile
+    # see the old ones. Threads asking while a bulk refresh runs wait for it
+    # instead of starting another.
+    def refresh_metadata(self, device_id=None):
+        if device_id is not None:
+            return self._fetch_metadata(device_id)
+
+        refreshes = self._refreshes
+        with self._refresh_lock:
+            if self._refreshes != refreshes:
+                return
+
+            self.recount_devices()
+            fetched = time()
+            metadata = {}
+            index = DeviceIndex()
+            for device_index in range(self.number_of_devices):
+                dev_id = self.get_device_by_index(device_index)
+                if dev_id:
+                    metadata[dev_id] = (fetched, self._read_metadata(dev_id))
+                    index.add(dev_id, metadata[dev_id][1]['name'])
+
+            with self._metadata_lock:
+                current = dict(
+                    (dev_id, cached[1])
+                    for dev_id, cached in self._metadata.items()
+                )
+                if current != dict(
+                        (dev_id, cached[1])
+                        for dev_id, cached in metadata.items()):
+                    self._catalog_change()
+
+                self._metadata = metadata
+                self.index = index
+                self._index_built = True
+                self._refreshes += 1
+
+    # Drop cached metadata for one device, or for all devices.
+    def invalidate_metadata(self, device_id=None):
+        with self._metadata_lock:
+            if device_id is None:
+                self._metadata = {}
             else:
-                device_index = current
+                self._metadata.pop(device_id, None)
+
+    ## Snapshots
+
+    # Everything known about all devices as a list of dicts sorted by ID,
+    # served from the caches. The list is shared until something changes, so
+    # don't modify it.
+    def snapshot(self):
+        cached = self._snapshot
+        if (cached is not None and
+                cached[0] == (self.catalog_version, self.states.version) and
+                not self._metadata_expired(cached[1])):
+            return cached[2]
+
+        devices = []
+        for device in self.Devices():
+            entry = self.get_metadata(device.id)
+            state = self.get_state(device.id)
+            entry.update(
+                id = device.id,
+                methods = device.methods,
+                type = device.type_name,
+                state = state['state'],
+                changed = state['changed']
+            )
+            devices.append(entry)
+        devices.sort(key=lambda entry: entry['id'])
+
+        # Filling the caches counts as changes, so versions are read after
+        self._snapshot = (
+            (self.catalog_version, self.states.version),
+            time(),
+            devices
+        )
+        return devices
+
+    # Prime the metadata cache, name index and snapshot from stored device
+    # entries, see db.Catalog. Lets a new process answer lookups and listings
+    # before it has asked telldusd about every device.
+    def seed(self, devices):
+        now = time()
+
+        snapshot = []
+        with self._metadata_lock:
+            for entry in devices:
+                metadata = {}
+                for field in METADATA_FIELDS:
+                    metadata[field] = entry.get(field) or ''
+                self._metadata[entry['id']] = (now, metadata)
+                self.index.add(entry['id'], metadata['name'])
+
+                entry = dict(entry, state=None, changed=None)
+                snapshot.append(entry)
+            self._index_built = True
+        snapshot.sort(key=lambda entry: entry['id'])
+
+        self._snapshot = (
+            (self.catalog_version, self.states.version),
+            now,
+            snapshot
+        )
+
+    ## Device lookups through the name index.
+
+    # Returns a list of device IDs matching name. Exact matches of the
+    # normalized name win, otherwise name is used as a prefix. A trailing *
+    # always means prefix.
+    def find_device_ids(self, name):
+        if not self._index_built:
+            self.refresh_metadata()
+
+        with self._metadata_lock:
+            stale = list(self._stale)
+            self._stale.clear()
+        for dev_id in stale:
+            self._fetch_metadata(dev_id)
+
+        ids = self._lookup_ids(name)
+
+        # Devices may have been added or removed by other telldusd clients
+        if not ids and self._get_number_of_devices() != len(self.index):
+            self.refresh_metadata()
+            ids = self._lookup_ids(name)
+
+        return sorted(ids)
+
+    def _lookup_ids(self, name):
+        with self._metadata_lock:
+            if name.endswith('*'):
+                return self.index.prefix(name[:-1])
+            return self.index.get(name) or self.index.prefix(name)
+
+    # Find a single device by name, see find_device_ids. Returns None when
+    # nothing matches and raises TDAmbiguousNameError for several matches.
+    def find_device(self, name):
+        ids = self.find_device_ids(name)
+
+        if not ids:
+            return None
+        if len(ids) > 1:
+            raise TDAmbiguousNameError(
+                'Name "%s" matches several devices' % name,
+                ids
+            )
+        return self.get_device(ids[0])
+
+    # Whether telldusd has a device with this ID. Cached devices count,
+    # otherwise the device list is walked by index, integer calls only.
+    def has_device(self, device_id):
+        if device_id in self.devices or device_id in self._metadata:
+            return True
+
+        for device_index in xrange(self._get_number_of_devices()):
+            if self._get_id(device_index) == device_id:
+                return True
+        return False
 
-            # Decide on using internal devices list or building a new one.
-            if self.number_of_devices == len(self.devices):
-                device = self.devices[current]
+    # The registered Device of an ID, raises TDDeviceError for unknown IDs
+    def get_device(self, device_id):
+        device = self.devices.get(device_id)
+        if device is None:
+            device = Device(self, id=device_id)
+        return device
+
+    ## Batch commands
+
+    # Run a list of (device, command) pairs in one pass, device being a Device
+    # or a device ID and command one of COMMANDS. Several commands for the
+    # same device collapse into the last one. Source tells listeners who sent
+    # the commands. Returns a result dict for every
+    # device in the order their last command was given.
+    def execute_batch(self, commands, source=None):
+        results = []
+        for dev_id, command in self._coalesce(commands):
+            results.append(self._execute(dev_id, command, source))
+        return results
+
+    # Collapse (device, command) pairs into a list of (device id, command)
+    # with the last command for each device.
+    def _coalesce(self, commands):
+        plan = OrderedDict()
+        for device, command in commands:
+            if command not in COMMANDS:
+                raise ValueError('Unknown command "%s"' % command)
+
+            if isinstance(device, Device):
+                dev_id = device.id
             else:
-                # Init the Device class
-                device = Device(
-                    self,
-                    index = device_index
+                dev_id = int(device)
+
+            plan.pop(dev_id, None)
+            plan[dev_id] = command
+        return plan.items()
+
+    def _execute(self, device_id, command, source=None):
+        result = dict(id=device_id, method=command, success=False)
+        started = time()
+
+        try:
+            device = self.get_device(device_id)
+            if command == 'on':
+                result['success'] = device.turn_on(source)
+            elif command == 'off':
+                result['success'] = device.turn_off(source)
+            elif command == 'learn':
+                result['success'] = device.learn(source)
+        except(TDError), e:
+            result['error'] = e.errstr
+        except(Exception), e:
+            log.exception('Command %s to device %s failed', command, device_id)
+            result['error'] = str(e) or e.__class__.__name__
+
+        # Without events telldusd won't tell us about our own commands
+        if result['success'] and not self._callback_ids:
+            if command == 'on':
+                self._set_state(device_id, METHOD_TURNON)
+            elif command == 'off':
+                self._set_state(device_id, METHOD_TURNOFF)
+
+        result['elapsed'] = time() - started
+        return result
+
+    ## Transmit scheduler
+
+    # All RF commands from the web layer should go through here so that only
+    # one command at a time reaches the Tellstick. A process forked after the
+    # transmitter was started gets one of its own, the thread stays behind.
+    @property
+    def transmitter(self):
+        pid = os.getpid()
+        if self._transmitter is None or self._transmitter_pid != pid:
+            self._transmitter_pid = pid
+            self._transmitter = Transmitter(
+                self,
+                rate = self._transmit_rate,
+                burst = self._transmit_burst
+            )
+            self._transmitter.start()
+        return self._transmitter
+
+    # Queue (device, command) pairs, see execute_batch. Returns a
+    # TransmitJob that can be waited on or polled by its ID.
+    def submit(self, commands, priority=PRIORITY_INTERACTIVE, source=None):
+        return self.transmitter.submit(commands, priority, source)
+
+    ## Device states and events from telldusd. Callbacks run in a thread of
+    # telldus-core so they only touch the state table and our caches, never
+    # the C-API.
+
+    def register_events(self):
+        self._events = True
+        if not self.loaded:
+            self._load()
+        if self._callback_ids:
+            return
+
+        self._callbacks = [
+            DEVICE_EVENT(self._on_device_event),
+            DEVICE_CHANGE_EVENT(self._on_device_change_event),
+            SENSOR_EVENT(self._on_sensor_event),
+            RAW_DEVICE_EVENT(self._on_raw_device_event),
+        ]
+        self._callback_ids = [
+            self._register_device_event(self._callbacks[0]),
+            self._register_device_change_event(self._callbacks[1]),
+            self._register_sensor_event(self._callbacks[2]),
+            self._register_raw_device_event(self._callbacks[3]),
+        ]
+
+    def unregister_events(self):
+        self._events = False
+        for callback_id in self._callback_ids:
+            self._unregister_callback(callback_id)
+        self._callback_ids = []
+        self._callbacks = []
+
+    # Listeners are called as listener(event, device_id, entry) with event
+    # one of 'state', 'added', 'changed' or 'removed' and entry the state
+    # table entry of the device. Commands sent through Device are 'command'
+    # events with an entry of id, method, success, source and time. Sensor
+    # readings are 'sensor' events with the sensor ID and an entry of
+    # protocol, model, id, data_type, value and timestamp.
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, event, device_id, entry):
+        for listener in list(self._listeners):
+            try:
+                listener(event, device_id, entry)
+            except(Exception):
+                log.exception('Listener %r failed on %s event of %s',
+                              listener, event, device_id)
+
+    def _command_sent(self, device_id, method, success, source=None):
+        self._notify('command', device_id, dict(
+            id = device_id,
+            method = method,
+            success = success,
+            source = source,
+            time = time()
+        ))
+
+    def _set_state(self, device_id, method, data=None):
+        entry = self.states.update(
+            device_id,
+            event = 'state',
+            state = STATES.get(method, str(method)),
+            method = method,
+            data = data
+        )
+        self._notify('state', device_id, entry)
+
+    def _on_device_event(self, device_id, method, data, callback_id, ctx):
+        self._set_state(device_id, method, data)
+
+    # Raw events go to raw_events only, every RF frame heard would be too
+    # much for the listeners.
+    def _on_raw_device_event(self, data, controller_id, callback_id, ctx):
+        self.raw_events.add(data, controller_id)
+
+    def _on_device_change_event(self, device_id, change_event, change_type,
+                                callback_id, ctx):
+        if change_event in (TELLSTICK_DEVICE_ADDED, TELLSTICK_DEVICE_CHANGED,
+                            TELLSTICK_DEVICE_REMOVED):
+            self._catalog_change()
+
+        if change_event == TELLSTICK_DEVICE_ADDED:
+            with self._metadata_lock:
+                self._stale.add(device_id)
+            entry = self.states.update(
+                device_id,
+                event = 'added',
+                removed = False
+            )
+            self._notify('added', device_id, entry)
+
+        elif change_event == TELLSTICK_DEVICE_CHANGED:
+            self.invalidate_metadata(device_id)
+            self.invalidate_members()
+            with self._metadata_lock:
+                self._stale.add(device_id)
+            entry = self.states.update(device_id, event='changed')
+            self._notify('changed', device_id, entry)
+
+        elif change_event == TELLSTICK_DEVICE_REMOVED:
+            self.invalidate_metadata(device_id)
+            self.invalidate_members()
+            with self._metadata_lock:
+                self.index.remove(device_id)
+                self._stale.discard(device_id)
+            self.devices.remove(device_id)
+            entry = self.states.remove(device_id)
+            self._notify('removed', device_id, entry)
+
+    # State table entry of a device, the first read for a device without
+    # events asks telldusd for the last sent command.
+    def get_state(self, device_id):
+        entry = self.states.get(device_id)
+        if entry is None:
+            method = self._last_sent_command(
+                device_id,
+                METHOD_TURNON | METHOD_TURNOFF
+            )
+            entry = self.states.update(
+                device_id,
+                event = 'state',
+                state = STATES.get(method),
+                method = method,
+                data = None,
+                changed = None
+            )
+        return entry
+
+    ## Sensors. Readings arrive through the sensor event callback once events
+    # are registered and are kept in a ring buffer per sensor and data type.
+
+    # List sensors known to telldusd, and read their last values
+    def Sensors(self):
+        while True:
+            sensor = self._sensor()
+            if sensor is None:
+                break
+            protocol, model, sensor_id, data_types = sensor
+
+            for data_type in SENSOR_TYPES:
+                if not data_types & data_type:
+                    continue
+                reading = self._sensor_value(
+                    protocol,
+                    model,
+                    sensor_id,
+                    data_type
                 )
+                if reading is not None:
+                    self.ingest_sensor_value(
+                        protocol,
+                        model,
+                        sensor_id,
+                        data_type,
+                        reading[0],
+                        reading[1]
+                    )
+
+        return sorted(self.sensors.values(), key=lambda sensor: sensor.id)
+
+    # First sensor with this ID, sensor IDs are only unique per protocol and
+    # model.
+    def get_sensor(self, sensor_id):
+        for key, sensor in self.sensors.items():
+            if key[2] == sensor_id:
+                return sensor
+        return None
+
+    # Store a reading, returns False for RF repeats and unreadable values.
+    def ingest_sensor_value(self, protocol, model, sensor_id, data_type,
+                            value, timestamp):
+        try:
+            value = float(value)
+        except(TypeError, ValueError):
+            return False
+
+        key = (protocol, model, sensor_id)
+        sensor = self.sensors.get(key)
+        if sensor is None:
+            sensor = Sensor(protocol, model, sensor_id, self.sensor_history)
+            self.sensors[key] = sensor
+
+        if not sensor.add(data_type, timestamp, value):
+            return False
+
+        self._notify('sensor', sensor_id, dict(
+            protocol = protocol,
+            model = model,
+            id = sensor_id,
+            data_type = data_type,
+            value = value,
+            timestamp = timestamp
+        ))
+        return True
+
+    def _on_sensor_event(self, protocol, model, sensor_id, data_type, value,
+                         timestamp, callback_id, ctx):
+        self.ingest_sensor_value(
+            protocol,
+            model,
+            sensor_id,
+            data_type,
+            value,
+            timestamp
+        )
+
+    ## Groups and scenes. Both keep their members in the "devices" parameter,
+    # groups as a list of device IDs and scenes as a list of id:action.
+    # Members are expanded into plain devices once and cached until a
+    # "devices" parameter changes or a device is removed.
+
+    # Returns the expanded members of a group or scene as a list of
+    # (device id, command). Group members have no command of their own, so
+    # command is None for them.
+    def get_members(self, device_id):
+        members = self._members.get(device_id)
+        if members is None:
+            members = self._expand_members(device_id, frozenset())
+            self._members[device_id] = members
+        return list(members)
+
+    def _expand_members(self, device_id, parents):
+        parents = parents | set([device_id])
+
+        device_type = self._get_device_type(device_id)
+        if device_type not in (TYPE_GROUP, TYPE_SCENE):
+            return [(device_id, None)]
+
+        members = []
+        param = self._get_device_parameter(device_id, 'devices', '')
+        for member in param.split(','):
+            member = member.strip()
+            if not member:
+                continue
+
+            parts = member.split(':')
+            try:
+                member_id = int(parts[0])
+            except(ValueError):
+                continue
+
+            command = None
+            if device_type == TYPE_SCENE:
+                action = parts[1].lower() if len(parts) > 1 else 'on'
+                command = _SCENE_ACTIONS.get(action)
+                if command is None:
+                    continue
+
+            # Guard against groups including themselves
+            if member_id in parents:
+                continue
+
+            for sub_id, sub_command in self._expand_members(member_id,
+                                                            parents):
+                members.append((sub_id, command or sub_command))
+
+        return members
+
+    def invalidate_members(self, device_id=None):
+        if device_id is None:
+            self._members = {}
+        else:
+            self._members.pop(device_id, None)
+
+    # Send command to every member of a group as one transmit job
+    def run_group(self, device_id, command='on',
+                  priority=PRIORITY_INTERACTIVE, source=None):
+        plan = []
+        for member_id, member_command in self.get_members(device_id):
+            plan.append((member_id, command))
+        return self.submit(plan, priority, source)
+
+    # Run a scene as one transmit job, in the order the scene lists its
+    # members. A member listed twice only gets its last action.
+    def run_scene(self, device_id, priority=PRIORITY_INTERACTIVE,
+                  source=None):
+        plan = []
+        for member_id, member_command in self.get_members(device_id):
+            plan.append((member_id, member_command or 'on'))
+        return self.submit(plan, priority, source)
+
+    # Generator to iterate through all devices. This returns a class instance
+    # of Device, which contains more Device-specific methods.
+    def Devices(self):
+        # Re-count devices in internal counter
+        self.recount_devices()
 
-                # If the device index exists in the list, simply update it.
-                try:
-                    self.devices[current] = device
-                except(IndexError):
-                    # If not, append it.
-                    self.devices.append(device)
+        # Resolve all IDs first, they are only cheap integer calls. Devices
+        # removed behind our back are dropped from the registry.
+        device_ids = []
+        for device_index in range(self.number_of_devices):
+            dev_id = self.get_device_by_index(device_index)
+            if dev_id:
+                device_ids.append((device_index, dev_id))
 
-            # Increment counter
-            current += 1
+        self.devices.retain([dev_id for device_index, dev_id in device_ids])
+
+        # The IDs were just listed, new Devices skip the existence check
+        for device_index, dev_id in device_ids:
+            device = self.devices.get(dev_id)
+            if device is None:
+                device = Device(self, id=dev_id, index=device_index)
+            device._index = device_index
 
             # Return the class
             yield device
 
 # This class will create the device if it does not exist.
 class Device(object):
+    # One Device per ID is kept in Telldus.devices, keep them small.
+    __slots__ = (
+        '_td', '_index', '_device_id', 'parameters', '_methods', '_type'
+    )
+
     def __init__(self, telldus, **kw):
         # Telldus class instance for use in this class. It's not quite
         # subclassing but it does the job. 
@@ -259,8 +1200,17 @@ class Device(object):
         # Get device arguments, with default values
         self._index = kw.get('index', 0)
 
-        # Check if device exists based on index given
-        dev_id = self._td.get_device_by_index(self.index)
+        # Check if device exists based on ID or index given. An ID given
+        # with its index comes from the device list and is known to exist.
+        if kw.get('id'):
+            dev_id = int(kw.get('id'))
+            if 'index' not in kw:
+                self._index = None
+                if not self._td.has_device(dev_id):
+                    raise TDDeviceError('Device %d not found' % dev_id)
+        else:
+            dev_id = self._td.get_device_by_index(self.index)
+
         if not dev_id:
             # Device does not exist, attempt to create with parameters given.
             dev_id = self._td._add_device()
@@ -275,6 +1225,9 @@ class Device(object):
             # on new devices.
             self._index = None
             # TODO: Perhaps recount_devices and guess the index?
+
+            # Recount the number of devices in the superclass
+            self._td.recount_devices()
         else:
             # Device does exist, save/update its device ID
             self._device_id = dev_id
@@ -282,6 +1235,9 @@ class Device(object):
         # Init parameters dictionary
         self.parameters = {}
 
+        # Device type, read on first use
+        self._type = None
+
         # Check supported methods
         self._methods = self._td._methods(self.id, (
             METHOD_TURNON |
@@ -289,15 +1245,10 @@ class Device(object):
             METHOD_LEARN
         ))
 
-        # Append this new device to the internal list of the "superclass"
-        self._td.devices.append(self)
-
-        # The index position will be needed if the device were to be deleted
-        self._devices_index = len(self._td.devices)-1
+        # Register this device in the "superclass", replacing any earlier
+        # Device with the same ID.
+        self._td.devices.add(self)
 
-        # Lastly recount the number of devices in the superclass
-        self._td.recount_devices()
-        
     ## Methods here
 
     # Set parameters for the device
@@ -320,33 +1271,40 @@ class Device(object):
         if not parameter:
             raise ValueError('"parameter is required argument')
 
-        value = self._td._get_device_parameter(device_id, parameter, '')
+        if parameter in _METADATA_PARAMETERS:
+            value = self._td.get_metadata(device_id, parameter)
+        else:
+            value = self._td._get_device_parameter(device_id, parameter, '')
 
         if bool(value) is False:
             return default_value
         return value
 
-    def turn_on(self):
+    # Source is passed on to listeners of the Telldus instance, to tell who
+    # sent the command.
+    def turn_on(self, source=None):
         device_id = self._device_id
 
         res = self._td._turn_on(device_id)
-        if res == TELLSTICK_SUCCESS:
-            return True
-        return False
+        success = res == TELLSTICK_SUCCESS
+        self._td._command_sent(device_id, 'on', success, source)
+        return success
 
-    def turn_off(self):
+    def turn_off(self, source=None):
         device_id = self._device_id
 
         res = self._td._turn_off(device_id)
-        if res == TELLSTICK_SUCCESS:
-            return True
-        return False
+        success = res == TELLSTICK_SUCCESS
+        self._td._command_sent(device_id, 'off', success, source)
+        return success
 
-    def learn(self):
+    def learn(self, source=None):
         method = self._td._methods(self._device_id, METHOD_LEARN)
         if method == METHOD_LEARN:
             res = self._td._learn(self._device_id)
-            if res == TELLSTICK_SUCCESS:
+            success = res == TELLSTICK_SUCCESS
+            self._td._command_sent(self._device_id, 'learn', success, source)
+            if success:
                 return True
             else:
                 raise TDDeviceError('Could not teach device')
@@ -354,12 +1312,14 @@ class Device(object):
 
     def remove(self):
         device_id = self._device_id
-        super_device_id = self._td.devices[self._devices_index].id
 
-        if device_id != super_device_id:
-            raise TDDeviceError('Unmatched device IDs, refusing to remove')
+        if device_id not in self._td.devices:
+            raise TDDeviceError('Unregistered device ID, refusing to remove')
 
         res = self._td._remove_device(device_id)
+        if res:
+            self._td.devices.remove(device_id)
+            self._td.recount_devices()
         return bool(res)
 
     ## Define all properties here
@@ -369,7 +1329,7 @@ class Device(object):
     def name(self):
         device_id = self._device_id
 
-        device_name = self._td._get_name(device_id)
+        device_name = self._td.get_metadata(device_id, 'name')
         return device_name
 
     @name.setter
@@ -389,7 +1349,7 @@ class Device(object):
     @property
     def model(self):
         device_id = self._device_id
-        return self._td._get_model(device_id)
+        return self._td.get_metadata(device_id, 'model')
 
     @model.setter
     def model(self, model):
@@ -402,7 +1362,7 @@ class Device(object):
     @property
     def protocol(self):
         device_id = self._device_id
-        return self._td._get_protocol(device_id)
+        return self._td.get_metadata(device_id, 'protocol')
 
     @protocol.setter
     def protocol(self, protocol):
@@ -446,17 +1406,535 @@ class Device(object):
     def methods(self):
         return self._methods
 
+    # 'on', 'off' or None when unknown, see Telldus.get_state
+    @property
+    def state(self):
+        return self._td.get_state(self._device_id)['state']
+
     @property
     def type(self):
-        # Neat trick since everything is an object and str() calls the
-        # __str__ method in any object, not just classes.
-        def __str__(self):
-            if self.type == 2:
-                return 'Group'
-            if self.type == 3:
-                return 'Scene'
-            return 'Device'
-        return self.type
+        if self._type is None:
+            self._type = self._td._get_device_type(self._device_id)
+        return self._type
+
+    @property
+    def type_name(self):
+        return TYPE_NAMES.get(self.type, 'Device')
+
+    # Expanded members of groups and scenes, see Telldus.get_members
+    @property
+    def members(self):
+        if self.type not in (TYPE_GROUP, TYPE_SCENE):
+            return []
+        return self._td.get_members(self._device_id)
+
+# A queued set of commands, see Telldus.submit. Results are filled in as the
+# transmitter works through the commands.
+class TransmitJob(object):
+    __slots__ = (
+        'id', 'priority', 'source', 'status', 'results', 'submitted',
+        'finished', '_pending', '_done'
+    )
+
+    def __init__(self, job_id, priority, pending, source=None):
+        self.id = job_id
+        self.priority = priority
+        self.source = source
+        self.status = 'queued'
+        self.results = []
+        self.submitted = time()
+        self.finished = None
+        self._pending = pending
+        self._done = Event()
+
+        if not pending:
+            self._finish()
+
+    def _finish(self):
+        self.status = 'done'
+        self.finished = time()
+        self._done.set()
+
+    # Returns True when the job has finished within timeout
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def as_dict(self):
+        return dict(
+            id = self.id,
+            priority = self.priority,
+            status = self.status,
+            submitted = self.submitted,
+            finished = self.finished,
+            results = list(self.results)
+        )
+
+# Single worker thread sending queued commands in priority order, limited by
+# a token bucket so bursts of commands don't flood the air. Every command is
+# its own queue entry so interactive commands get in between the commands of
+# a long bulk job.
+class Transmitter(object):
+    def __init__(self, telldus, rate=_DEFAULT_TRANSMIT_RATE,
+                 burst=_DEFAULT_TRANSMIT_BURST):
+        self._td = telldus
+        self.rate = float(rate)
+        self.burst = burst
+
+        self._tokens = float(burst)
+        self._refilled = time()
+
+        # Heap of (priority, sequence, job, device id, command)
+        self._queue = []
+        self._sequence = count()
+        self._job_ids = count(1)
+        self._jobs = OrderedDict()
+        self._condition = Condition()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = Thread(target=self._run, name='td-transmitter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, commands, priority=PRIORITY_INTERACTIVE, source=None):
+        plan = self._td._coalesce(commands)
+
+        with self._condition:
+            job = TransmitJob(
+                next(self._job_ids),
+                priority,
+                len(plan),
+                source
+            )
+            self._jobs[job.id] = job
+
+            # Forget the oldest jobs, finished or not
+            while len(self._jobs) > _FINISHED_JOBS:
+                self._jobs.popitem(last=False)
+
+            for dev_id, command in plan:
+                heapq.heappush(
+                    self._queue,
+                    (priority, next(self._sequence), job, dev_id, command)
+                )
+            self._condition.notify()
+
+        return job
+
+    def job(self, job_id):
+        return self._jobs.get(job_id)
+
+    def __len__(self):
+        return len(self._queue)
+
+    # Sleep until a token is available and take it
+    def _take_token(self):
+        now = time()
+        self._tokens = min(
+            self.burst,
+            self._tokens + (now - self._refilled) * self.rate
+        )
+        self._refilled = now
+
+        if self._tokens < 1:
+            sleep((1 - self._tokens) / self.rate)
+            self._tokens = 1
+            self._refilled = time()
+
+        self._tokens -= 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+
+            # Pick the command once there is a token, so that interactive
+            # commands queued during the wait go first. Only this thread
+            # takes commands off the queue.
+            self._take_token()
+            with self._condition:
+                priority, seq, job, dev_id, command = heapq.heappop(
+                    self._queue
+                )
+            job.status = 'running'
+
+            # Nothing may end this thread, every job waits on it
+            try:
+                result = self._td._execute(dev_id, command, job.source)
+            except(Exception), e:
+                log.exception('Command %s to device %s failed', command,
+                              dev_id)
+                result = dict(
+                    id = dev_id,
+                    method = command,
+                    success = False,
+                    error = str(e) or e.__class__.__name__
+                )
+            job.results.append(result)
+
+            job._pending -= 1
+            if not job._pending:
+                job._finish()
+
+# Thread safe table of device states. Every update bumps a global version
+# counter and stamps the entry with it, so readers can ask for everything that
+# changed since a version they have seen.
+class DeviceStates(object):
+    def __init__(self):
+        self.version = 0
+        self._states = {}
+        self._condition = Condition()
+
+    def __len__(self):
+        return len(self._states)
+
+    # Returns a copy of the entry for a device, or None
+    def get(self, device_id):
+        with self._condition:
+            entry = self._states.get(device_id)
+            if entry is not None:
+                entry = dict(entry)
+            return entry
+
+    # Update fields of a device entry and return a copy of it. The change
+    # timestamp is set to now unless given.
+    def update(self, device_id, **fields):
+        with self._condition:
+            entry = self._states.get(device_id)
+            if entry is None:
+                entry = dict(
+                    id = device_id,
+                    state = None,
+                    method = None,
+                    data = None,
+                    removed = False
+                )
+                self._states[device_id] = entry
+
+            entry['changed'] = time()
+            entry.update(fields)
+
+            self.version += 1
+            entry['version'] = self.version
+            self._condition.notify_all()
+            return dict(entry)
+
+    # Removed devices stay in the table, marked, so that readers catching up
+    # see the removal.
+    def remove(self, device_id):
+        return self.update(device_id, event='removed', removed=True)
+
+    # Entries changed after version, oldest change first
+    def since(self, version=0):
+        with self._condition:
+            entries = [
+                dict(entry) for entry in self._states.values()
+                if entry['version'] > version
+            ]
+        return sorted(entries, key=lambda entry: entry['version'])
+
+    # Block until something changed after version, or timeout passed. Returns
+    # the current version.
+    def wait(self, version, timeout=None):
+        with self._condition:
+            if self.version <= version:
+                self._condition.wait(timeout)
+            return self.version
+
+# Parse the data of a raw event, "class:command;protocol:arctech;house:A;",
+# into a dict. Pairs without a colon are skipped.
+def parse_raw_event(data):
+    fields = {}
+    for pair in data.split(';'):
+        key, sep, value = pair.partition(':')
+        if sep:
+            fields[key] = value
+    return fields
+
+# Bounded buffer of raw RF events for consumers polling by version. Repeats
+# are recognized by their unparsed data, so only the first copy of a frame
+# is parsed and stored. Entries have version, time, controller, the raw data
+# and its parsed fields, and are shared with every reader so they must not be
+# changed.
+class RawEvents(object):
+    def __init__(self, size=_DEFAULT_RAW_EVENTS, window=_RAW_REPEAT_WINDOW):
+        self.version = 0
+        self.repeats = 0
+        self.window = window
+        self._events = deque(maxlen=size)
+        self._condition = Condition()
+
+        # (data, controller id) => when it was last accepted, pruned once
+        # every window
+        self._heard = {}
+        self._pruned = time()
+
+    def __len__(self):
+        return len(self._events)
+
+    # Store an event unless it repeats one accepted within the window, so a
+    # frame repeated for longer than that is stored once per window. Returns
+    # the entry, or None for repeats.
+    def add(self, data, controller_id, when=None):
+        if when is None:
+            when = time()
+        key = (data, controller_id)
+
+        with self._condition:
+            last = self._heard.get(key)
+            if last is not None and when - last <= self.window:
+                self.repeats += 1
+                return None
+            self._heard[key] = when
+
+            if when - self._pruned > self.window:
+                self._heard = dict(
+                    (heard_key, heard) for heard_key, heard in
+                    self._heard.iteritems() if when - heard <= self.window
+                )
+                self._pruned = when
+
+            self.version += 1
+            entry = dict(
+                version = self.version,
+                time = when,
+                controller = controller_id,
+                data = data,
+                fields = parse_raw_event(data)
+            )
+            self._events.append(entry)
+            self._condition.notify_all()
+            return entry
+
+    # Entries after version still in the buffer, oldest first
+    def since(self, version=0):
+        with self._condition:
+            entries = []
+            for entry in reversed(self._events):
+                if entry['version'] <= version:
+                    break
+                entries.append(entry)
+        entries.reverse()
+        return entries
+
+    # Block until an event arrived after version, or timeout passed. Returns
+    # the current version.
+    def wait(self, version, timeout=None):
+        with self._condition:
+            if self.version <= version:
+                self._condition.wait(timeout)
+            return self.version
+
+# Fixed size buffer of (timestamp, value) readings, kept in two arrays of
+# doubles so memory stays the same however many readings come in.
+class RingBuffer(object):
+    __slots__ = ('capacity', 'timestamps', 'values', '_next', '_count')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value):
+        self.timestamps[self._next] = timestamp
+        self.values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    # Last (timestamp, value), or None when empty
+    def latest(self):
+        if not self._count:
+            return None
+        last = (self._next - 1) % self.capacity
+        return (self.timestamps[last], self.values[last])
+
+    # Readings oldest first, optionally only those at or after since
+    def readings(self, since=None):
+        start = (self._next - self._count) % self.capacity
+        readings = []
+        for i in xrange(self._count):
+            pos = (start + i) % self.capacity
+            if since is None or self.timestamps[pos] >= since:
+                readings.append((self.timestamps[pos], self.values[pos]))
+        return readings
+
+# A sensor with a ring buffer of readings per data type
+class Sensor(object):
+    __slots__ = ('protocol', 'model', 'id', 'history', 'buffers')
+
+    def __init__(self, protocol, model, sensor_id, history):
+        self.protocol = protocol
+        self.model = model
+        self.id = sensor_id
+        self.history = history
+        self.buffers = {}
+
+    @property
+    def data_types(self):
+        return sorted(self.buffers)
+
+    # Store a reading unless it repeats the last one
+    def add(self, data_type, timestamp, value):
+        buf = self.buffers.get(data_type)
+        if buf is None:
+            buf = RingBuffer(self.history)
+            self.buffers[data_type] = buf
+
+        last = buf.latest()
+        if (last is not None and last[1] == value and
+                abs(timestamp - last[0]) <= _SENSOR_REPEAT_WINDOW):
+            return False
+
+        buf.append(timestamp, value)
+        return True
+
+    # Last (timestamp, value) of a data type, or None
+    def value(self, data_type=TELLSTICK_TEMPERATURE):
+        buf = self.buffers.get(data_type)
+        if buf is None:
+            return None
+        return buf.latest()
+
+    def readings(self, data_type=TELLSTICK_TEMPERATURE, since=None):
+        buf = self.buffers.get(data_type)
+        if buf is None:
+            return []
+        return buf.readings(since)
+
+    @property
+    def temperature(self):
+        reading = self.value(TELLSTICK_TEMPERATURE)
+        return reading and reading[1]
+
+    @property
+    def humidity(self):
+        reading = self.value(TELLSTICK_HUMIDITY)
+        return reading and reading[1]
+
+# Registry of Device instances keyed by device ID. Holds at most one Device
+# per ID so repeated lookups reuse the same object.
+class DeviceRegistry(object):
+    def __init__(self):
+        self._devices = {}
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, device_id):
+        return device_id in self._devices
+
+    def __iter__(self):
+        return iter(sorted(self._devices.values(), key=lambda d: d.id))
+
+    def get(self, device_id, default=None):
+        return self._devices.get(device_id, default)
+
+    def add(self, device):
+        self._devices[device.id] = device
+
+    def remove(self, device_id):
+        return self._devices.pop(device_id, None)
+
+    # Drop every device not in device_ids
+    def retain(self, device_ids):
+        keep = set(device_ids)
+        for device_id in self._devices.keys():
+            if device_id not in keep:
+                del self._devices[device_id]
+
+    def clear(self):
+        self._devices = {}
+
+# Fold case and Unicode forms of device names so that lookups for non-ASCII
+# names match whether they were typed composed, decomposed or in upper case.
+# Names come from the C-API as UTF-8 encoded str.
+def normalize_name(name):
+    if not name:
+        return u''
+    if isinstance(name, str):
+        name = name.decode('utf-8', 'replace')
+    return normalize('NFKC', name).lower().strip()
+
+# Index of device names, normalized name => device IDs plus a prefix trie.
+# Every trie node keeps the set of device IDs below it so a prefix lookup is
+# a walk of len(prefix) nodes.
+class DeviceIndex(object):
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self._names)
+
+    def clear(self):
+        # device id => normalized name
+        self._names = {}
+        # normalized name => set of device IDs
+        self._by_name = {}
+        # char => [set of device IDs, child nodes]
+        self._trie = [set(), {}]
+
+    # Add or rename a device
+    def add(self, device_id, name):
+        name = normalize_name(name)
+
+        if device_id in self._names:
+            if self._names[device_id] == name:
+                return
+            self.remove(device_id)
+
+        self._names[device_id] = name
+        self._by_name.setdefault(name, set()).add(device_id)
+
+        node = self._trie
+        node[0].add(device_id)
+        for char in name:
+            node = node[1].setdefault(char, [set(), {}])
+            node[0].add(device_id)
+
+    def remove(self, device_id):
+        name = self._names.pop(device_id, None)
+        if name is None:
+            return
+
+        ids = self._by_name[name]
+        ids.discard(device_id)
+        if not ids:
+            del self._by_name[name]
+
+        # Prune the trie path behind us
+        node = self._trie
+        node[0].discard(device_id)
+        for char in name:
+            child = node[1][char]
+            child[0].discard(device_id)
+            if not child[0]:
+                del node[1][char]
+                break
+            node = child
+
+    # Device IDs with exactly this name
+    def get(self, name):
+        return set(self._by_name.get(normalize_name(name), ()))
+
+    # Device IDs with names starting with prefix
+    def prefix(self, prefix):
+        node = self._trie
+        for char in normalize_name(prefix):
+            node = node[1].get(char)
+            if node is None:
+                return set()
+        return set(node[0])
 
 # Exception for TD class, handling errors thrown by C-API or internal errors.
 class TDError(Exception):
@@ -472,3 +1950,11 @@ class TDDeviceError(TDError):
 
     def __str__(self):
         return repr(self.errstr)
+
+class TDAmbiguousNameError(TDDeviceError):
+    def __init__(self, errstr, device_ids):
+        self.errstr = errstr
+        self.device_ids = device_ids
+
+    def __str__(self):
+        return repr(self.errstr)
@@ -0,0 +1,347 @@
+# Kraft sensor time series
+#
+# Rolls sensor readings up into min/max/sum/count per minute, hour and day and
+# keeps every tier in fixed-width segment files, one record slot per bucket,
+# which are read through mmap. Queries are answered from the coarsest tier
+# that still has the resolution asked for. NumPy is used for the rollups when
+# it is installed.
+
+import os
+import mmap
+import struct
+import logging
+from array import array
+from threading import Thread, Lock, Event
+from time import time
+
+# NumPy takes a good while to import on small machines, it is imported on the
+# first rollup instead. None until then, False when it isn't installed.
+numpy = None
+
+def _numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+            numpy = module
+        except ImportError:
+            numpy = False
+    return numpy
+
+log = logging.getLogger(__name__)
+
+# One rollup record: bucket start, min, max, sum, count. Empty buckets have a
+# count of 0.
+RECORD = struct.Struct('=5d')
+_FIELDS = 5
+
+# Seconds between writing pending readings to disk
+DEFAULT_FLUSH_INTERVAL = 60
+
+# Seconds between removing segments past their retention
+COMPACT_INTERVAL = 3600
+
+# A rollup tier, step is the bucket size and segment the time span of one
+# file, both in seconds. Segments older than retention are removed.
+class Tier(object):
+    __slots__ = ('name', 'step', 'segment', 'retention')
+
+    def __init__(self, name, step, segment, retention=None):
+        self.name = name
+        self.step = step
+        self.segment = segment
+        self.retention = retention
+
+    # Number of records in a segment file
+    @property
+    def records(self):
+        return self.segment // self.step
+
+TIERS = (
+    Tier('1m', 60, 86400, 7 * 86400),
+    Tier('1h', 3600, 30 * 86400, 400 * 86400),
+    Tier('1d', 86400, 360 * 86400),
+)
+
+# Group records into buckets of step seconds. Takes sequences of bucket
+# starts, mins, maxes, sums and counts and returns the same five for the
+# buckets, sorted by start. Raw readings are records with a count of 1.
+def aggregate(starts, mins, maxs, sums, counts, step):
+    if not len(starts):
+        return ([], [], [], [], [])
+
+    if _numpy():
+        starts = numpy.asarray(starts, dtype='f8')
+        order = numpy.argsort(starts, kind='mergesort')
+        buckets = numpy.floor(starts[order] / step) * step
+        keys, first = numpy.unique(buckets, return_index=True)
+        return (
+            keys,
+            numpy.minimum.reduceat(numpy.asarray(mins, 'f8')[order], first),
+            numpy.maximum.reduceat(numpy.asarray(maxs, 'f8')[order], first),
+            numpy.add.reduceat(numpy.asarray(sums, 'f8')[order], first),
+            numpy.add.reduceat(numpy.asarray(counts, 'f8')[order], first),
+        )
+
+    buckets = {}
+    for i in xrange(len(starts)):
+        key = (starts[i] // step) * step
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [mins[i], maxs[i], sums[i], counts[i]]
+        else:
+            bucket[0] = min(bucket[0], mins[i])
+            bucket[1] = max(bucket[1], maxs[i])
+            bucket[2] += sums[i]
+            bucket[3] += counts[i]
+
+    keys = sorted(buckets)
+    return (
+        keys,
+        [buckets[key][0] for key in keys],
+        [buckets[key][1] for key in keys],
+        [buckets[key][2] for key in keys],
+        [buckets[key][3] for key in keys],
+    )
+
+# Rollups of sensor readings, fed by a td.Telldus sensor listener
+class SeriesStore(object):
+    def __init__(self, path, tiers=TIERS,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.path = path
+        self.tiers = tiers
+        self.flush_interval = flush_interval
+
+        # (sensor id, data type) => (timestamps, values) not yet on disk
+        self._pending = {}
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._thread = None
+        self._stopped = Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = Thread(target=self._flush_loop, name='series-flush')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # For td.Telldus.subscribe
+    def listener(self, event, sensor_id, entry):
+        if event == 'sensor':
+            self.add(
+                sensor_id,
+                entry['data_type'],
+                entry['timestamp'],
+                entry['value']
+            )
+
+    def add(self, sensor_id, data_type, timestamp, value):
+        with self._lock:
+            pending = self._pending.get((sensor_id, data_type))
+            if pending is None:
+                pending = (array('d'), array('d'))
+                self._pending[(sensor_id, data_type)] = pending
+            pending[0].append(timestamp)
+            pending[1].append(value)
+
+    def _segment_path(self, sensor_id, data_type, tier, segment_start):
+        return os.path.join(
+            self.path,
+            '%d-%d' % (sensor_id, data_type),
+            tier.name,
+            '%d.seg' % segment_start
+        )
+
+    # Roll pending readings up into every tier and merge them into their
+    # segment files.
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+
+        with self._write_lock:
+            for (sensor_id, data_type), (stamps, values) in pending.items():
+                for tier in self.tiers:
+                    rollup = aggregate(
+                        stamps,
+                        values,
+                        values,
+                        values,
+                        [1] * len(values),
+                        tier.step
+                    )
+                    self._merge(sensor_id, data_type, tier, rollup)
+
+    def _merge(self, sensor_id, data_type, tier, rollup):
+        starts, mins, maxs, sums, counts = rollup
+
+        segments = {}
+        for i in xrange(len(starts)):
+            segment_start = int(starts[i] // tier.segment) * tier.segment
+            segments.setdefault(segment_start, []).append(i)
+
+        for segment_start, rows in segments.items():
+            path = self._segment_path(sensor_id, data_type, tier,
+                                      segment_start)
+            if not os.path.exists(path):
+                directory = os.path.dirname(path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with open(path, 'wb') as f:
+                    f.truncate(tier.records * RECORD.size)
+
+            with open(path, 'r+b') as f:
+                for i in rows:
+                    slot = int((starts[i] - segment_start) // tier.step)
+                    f.seek(slot * RECORD.size)
+                    record = RECORD.unpack(f.read(RECORD.size))
+
+                    if record[4]:
+                        record = (
+                            starts[i],
+                            min(record[1], mins[i]),
+                            max(record[2], maxs[i]),
+                            record[3] + sums[i],
+                            record[4] + counts[i]
+                        )
+                    else:
+                        record = (
+                            starts[i], mins[i], maxs[i], sums[i], counts[i]
+                        )
+
+                    f.seek(slot * RECORD.size)
+                    f.write(RECORD.pack(*[float(v) for v in record]))
+
+    # Remove segments past the retention of their tier
+    def compact(self, now=None):
+        now = now or time()
+        if not os.path.isdir(self.path):
+            return
+
+        for series in os.listdir(self.path):
+            for tier in self.tiers:
+                if tier.retention is None:
+                    continue
+
+                directory = os.path.join(self.path, series, tier.name)
+                if not os.path.isdir(directory):
+                    continue
+
+                for name in os.listdir(directory):
+                    segment_start = int(name.split('.')[0])
+                    if segment_start + tier.segment < now - tier.retention:
+                        os.remove(os.path.join(directory, name))
+
+    def _flush_loop(self):
+        compacted = 0
+        while not self._stopped.is_set():
+            self._stopped.wait(self.flush_interval)
+            try:
+                self.flush()
+                if time() - compacted > COMPACT_INTERVAL:
+                    self.compact()
+                    compacted = time()
+            except(Exception):
+                log.exception('Writing sensor series failed')
+
+    # Write what is pending and end the flush thread, waiting up to timeout
+    # seconds for it
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+
+        self._stopped.set()
+        self._thread.join(timeout)
+
+    # The coarsest tier with a step no larger than step that still keeps
+    # data from start.
+    def tier_for(self, start, step, now=None):
+        now = now or time()
+
+        chosen = None
+        for tier in self.tiers:
+            if (tier.retention is not None and
+                    start < now - tier.retention - tier.segment):
+                continue
+            if tier.step <= step or chosen is None:
+                chosen = tier
+        return chosen or self.tiers[-1]
+
+    # Records of a tier between start and end, as five sequences like
+    # aggregate() returns.
+    def _read(self, sensor_id, data_type, tier, start, end):
+        columns = [[], [], [], [], []]
+
+        segment_start = int(start // tier.segment) * tier.segment
+        while segment_start < end:
+            path = self._segment_path(sensor_id, data_type, tier,
+                                      segment_start)
+            if os.path.exists(path):
+                first = max(0, int((start - segment_start) // tier.step))
+                last = min(
+                    tier.records,
+                    int((end - segment_start + tier.step - 1) // tier.step)
+                )
+                self._read_segment(path, first, last, columns)
+            segment_start += tier.segment
+
+        return columns
+
+    def _read_segment(self, path, first, last, columns):
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data = mm[first * RECORD.size:last * RECORD.size]
+            finally:
+                mm.close()
+
+        if _numpy():
+            records = numpy.frombuffer(data, dtype='=f8').reshape(-1, _FIELDS)
+            records = records[records[:, 4] > 0]
+            for field in range(_FIELDS):
+                columns[field].extend(records[:, field])
+            return
+
+        values = array('d')
+        values.fromstring(data)
+        for i in xrange(0, len(values), _FIELDS):
+            if values[i + 4] > 0:
+                for field in range(_FIELDS):
+                    columns[field].append(values[i + field])
+
+    # Min, max and mean per step seconds between start and end. Pending
+    # readings not yet flushed are left out.
+    def query(self, sensor_id, data_type, start, end, step, now=None):
+        now = now or time()
+        tier = self.tier_for(start, step, now)
+        step = max(step, tier.step)
+
+        # Only walk the segments that can exist, from the epoch or the
+        # retention of the tier up to now
+        start = max(start, 0)
+        if tier.retention is not None:
+            start = max(start, now - tier.retention - tier.segment)
+        end = min(end, now)
+
+        columns = self._read(sensor_id, data_type, tier, start, end)
+        starts, mins, maxs, sums, counts = aggregate(
+            columns[0],
+            columns[1],
+            columns[2],
+            columns[3],
+            columns[4],
+            step
+        )
+
+        points = []
+        for i in xrange(len(starts)):
+            points.append(dict(
+                time = int(starts[i]),
+                min = float(mins[i]),
+                max = float(maxs[i]),
+                mean = float(sums[i]) / float(counts[i]),
+                count = int(counts[i])
+            ))
+        return dict(tier=tier.name, step=step, points=points)